@@ -1,78 +1,197 @@
+import argparse
+import asyncio
 import logging
 import sys
+import threading
+from email.utils import parseaddr
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from services.gmail import GmailAPI
-from llm.langgraph import workflow
-from config import setup_logging
+from services.distill import distill_question
+from llm.langgraph import workflow, email_workflow, initial_state
+from llm.async_langgraph import async_workflow, async_email_workflow
+from llm.answer_cache import answer_cache
+from llm.cache import llm_cache
+from llm.client import limiter, warm_up
+from llm.tools import search_cache
+from database.vectorstore import corpus_version, get_vectorstore
+from config import settings, setup_logging, singleton
+from tracing import Tracer, span, serve_metrics
 
 setup_logging("app")
 logger = logging.getLogger(__name__)
 
+tracer = Tracer(settings.TRACE_FILE, enabled=settings.TRACING)
+tracer.metrics.add_gauges(
+    lambda: {f"ragmail_llm_{name}": value for name, value in limiter.stats().items()}
+)
+
+
+def cache_stats():
+    """Returns the hit and miss counters of the LLM, answer, embedding and web search caches"""
+    caches = {
+        "llm": llm_cache,
+        "answer": answer_cache,
+        "embedding": settings.EMBEDDING_MODEL,
+        "web_search": search_cache,
+    }
+    # the embedding model can be replaced by one without a cache, e.g. in the benchmark
+    return {name: cache.stats() for name, cache in caches.items() if hasattr(cache, "stats")}
+
+
+tracer.metrics.add_gauges(
+    lambda: {
+        f"ragmail_{cache}_cache_{name}": value
+        for cache, stats in cache_stats().items()
+        for name, value in stats.items()
+    }
+)
+
 # == COMPILE LANGGRAPH == #
-app = workflow.compile()
+@singleton
+def get_app():
+    """
+    Compiles the LangGraph workflow on first use, the one splitting emails into their questions if
+    FAN_OUT is set
+    """
+    return (email_workflow if settings.FAN_OUT else workflow).compile()
+
+
+@singleton
+def get_async_app():
+    """Compiles the LangGraph workflow with async nodes on first use"""
+    return (async_email_workflow if settings.FAN_OUT else async_workflow).compile()
 
 
 # == GET EMAIL MESSAGE == #
 type SenderInfo = tuple[str, str]
-type EmailMessage = tuple[SenderInfo, str, str]
+type EmailMessage = tuple[str, SenderInfo, str, str]
 
 
-def get_email_message() -> EmailMessage:
+def get_email_messages(max_results=3, incremental=False) -> tuple[list[EmailMessage], str | None]:
     """
     Gets email messages from the authenticated user's inbox and returns information about
-    the message(s), including the name and email address of the sender, the subject, and
-    contents of the email message(s). The number of messages to fetch is defined in the
-    GmailAPI class which wraps the Gmail API's service calls.
+    each message, including the message id, the name and email address of the sender, the
+    subject, and contents of the email message. At most max_results messages are fetched,
+    unless incremental is set, in which case every message since the last sync is fetched.
+    Also returns the mailbox history id reached, to be stored once the messages are answered.
+    Messages that cannot be parsed are logged and left out.
     """
-    if (response := GmailAPI.get_messages()) is None:
+    responses, history_id = GmailAPI.get_messages(max_results=max_results, incremental=incremental)
+    if responses is None:
         logger.error("failed to get email")
         sys.exit(1)
 
+    messages = []
+    for response in responses:
+        try:
+            messages.append(to_email_message(response))
+        except Exception as e:
+            logger.error(f"failed to parse message {response.get('Id')}: {e}")
+    return messages, history_id
+
+
+def to_email_message(response) -> EmailMessage:
+    """Converts a message parsed by the GmailAPI class into an email message tuple"""
+    message_id = response["Id"]
     sender = parse_sender(response["Sender"])
     subject = response["Subject"]
     body = response["Body"]
 
-    logger.info(
-        f"""
-        Sender: {sender},
-        Subject: {subject},
-        Body: {body},
-    """
-    )
-    return sender, subject, body
+    # email bodies can hold personal data, so they are only logged when debugging
+    logger.info(f"Id: {message_id}, Sender: {sender}, Subject: {subject}, Body: {len(body)} chars")
+    logger.debug(f"Body: {body}")
+    return message_id, sender, subject, body
+
+
+def get_email_message() -> EmailMessage:
+    """Gets the most recent email message from the authenticated user's inbox"""
+    messages, _ = get_email_messages()
+    if not messages:
+        logger.error("no email messages in inbox")
+        sys.exit(1)
+    return messages[0]
 
 
 def parse_sender(sender) -> SenderInfo:
-    """Helper function to parse the sender info into name and email address"""
-    sender = sender.strip()
-    parts = sender.rsplit(" ", 1)
-    name = parts[0]
-    email = parts[1].strip("<>")
-    return name, email
+    """
+    Helper function to parse the sender info into name and email address. A sender without a
+    display name is named by their address. Raises a ValueError if there is no address.
+    """
+    name, email = parseaddr(sender or "")
+    if "@" not in email:
+        raise ValueError(f"no email address in sender {sender!r}")
+    return name or email, email
 
 
 # == PASS EMAIL QUESTION TO LANGGRAPH == #
-def answer_question(question) -> str | None:
+def answer_question(body) -> str | None:
+    """
+    Given an email body, distill the question out of it and pass it through the
+    LangGraph nodes which route the question to the appropriate nodes, generate an
+    answer, check for hallucinations, grade the answer, and return an approriate
+    response. Answers to questions similar enough to one answered before are served
+    from the answer cache. Each run is traced.
+    """
+    question = distill_question(body)
+    with tracer.run(body_chars=len(body), question_chars=len(question)) as trace:
+        # syncs the vectorstore on first use, so the cache is checked against the synced corpus
+        get_vectorstore()
+        corpus = corpus_version()
+        with span("answer_cache"):
+            answer = answer_cache.get(question, corpus)
+        if answer is not None:
+            trace.outcome = "cached"
+            logger.info(answer)
+            return answer
+
+        inputs = initial_state(question)
+        state = None
+        for state in get_app().stream(inputs, config=trace.config(), stream_mode="values"):
+            pass
+        trace.record_state(state)
+        return final_answer(question, state, corpus)
+
+
+async def aanswer_question(body) -> str | None:
     """
-    Given a question, pass it through the LangGraph nodes which route the question
-    to the appropriate nodes, generate an answer, check for hallucinations, grade
-    the answer, and return an approriate response
+    Async version of answer_question, which streams the graph with async nodes so that
+    many questions can be in flight at once on one event loop
     """
-    inputs = {"question": question}
-    answer = None
-    has_output = False
-    for output in app.stream(inputs):
-        for _, value in output.items():
-            has_output = True
+    question = distill_question(body)
+    with tracer.run(body_chars=len(body), question_chars=len(question)) as trace:
+        await asyncio.to_thread(get_vectorstore)
+        corpus = corpus_version()
+        with span("answer_cache"):
+            answer = await asyncio.to_thread(answer_cache.get, question, corpus)
+        if answer is not None:
+            trace.outcome = "cached"
+            logger.info(answer)
+            return answer
+
+        inputs = initial_state(question)
+        state = None
+        async for state in get_async_app().astream(
+            inputs, config=trace.config(), stream_mode="values"
+        ):
+            pass
+        trace.record_state(state)
+        return final_answer(question, state, corpus)
 
-    if not has_output:
+
+def final_answer(question, state, corpus) -> str | None:
+    """Returns the answer in the graph's final state, caching it if it was graded useful"""
+    if state is None:
         logger.error("failed to get output from langgraph")
-        sys.exit(1)
+        return None
 
-    if (answer := value["generation"]) is None:
+    if (answer := state.get("generation")) is None:
         logger.error("failed to generate answer from langgraph")
-        sys.exit(1)
+        return None
 
+    # only answers graded as useful are reused, not ones a run settled for when its budget ran out
+    if state.get("generation_grade") == "useful":
+        answer_cache.put(question, answer, corpus)
     logger.info(answer)
     return answer
 
@@ -89,10 +208,152 @@ def create_draft(reciever, subject, content) -> bool:
     return True if draft else False
 
 
+async def acreate_draft(reciever, subject, content) -> bool:
+    """Async version of create_draft"""
+    draft = await GmailAPI.acreate_draft(receiver=reciever, subject=subject, content=content)
+    if draft is None:
+        logger.error("failed to generate draft")
+    return True if draft else False
+
+
+# == BATCH PROCESSING == #
+def process_batch(messages, max_workers=settings.MAX_WORKERS) -> dict[str, bool]:
+    """
+    Answers a batch of email messages concurrently with a bounded pool of workers. A draft is
+    created as soon as each answer finishes, and a failure on one message does not stop the
+    rest of the batch. Returns whether a draft was created for each message id.
+    """
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(answer_question, body): (message_id, sender, subject)
+            for message_id, sender, subject, body in messages
+        }
+        for future in as_completed(futures):
+            message_id, (sender_name, sender_email_address), subject = futures[future]
+            try:
+                answer = future.result()
+            except Exception as e:
+                logger.error(f"failed to answer message {message_id}: {e}")
+                answer = None
+
+            if answer is None:
+                results[message_id] = False
+                continue
+
+            results[message_id] = create_draft(
+                reciever=sender_email_address,
+                subject=f"Re: {subject}",
+                content=answer,
+            )
+            if results[message_id]:
+                logger.info(f"Generated reply to {sender_name} for message {message_id}")
+
+    succeeded = sum(results.values())
+    logger.info(f"batch complete: {succeeded} succeeded, {len(results) - succeeded} failed")
+    return results
+
+
+async def aprocess_batch(messages, max_concurrency=settings.MAX_WORKERS) -> dict[str, bool]:
+    """
+    Async version of process_batch, which keeps up to max_concurrency messages in flight on
+    one event loop instead of using a thread per message
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def reply(message):
+        message_id, (sender_name, sender_email_address), subject, body = message
+        async with semaphore:
+            try:
+                answer = await aanswer_question(body)
+            except Exception as e:
+                logger.error(f"failed to answer message {message_id}: {e}")
+                answer = None
+
+        if answer is None:
+            return message_id, False
+        created_draft = await acreate_draft(
+            reciever=sender_email_address,
+            subject=f"Re: {subject}",
+            content=answer,
+        )
+        if created_draft:
+            logger.info(f"Generated reply to {sender_name} for message {message_id}")
+        return message_id, created_draft
+
+    results = dict(await asyncio.gather(*(reply(message) for message in messages)))
+    succeeded = sum(results.values())
+    logger.info(f"batch complete: {succeeded} succeeded, {len(results) - succeeded} failed")
+    return results
+
+
+def parse_args(argv=None):
+    """Parses the command line arguments"""
+    parser = argparse.ArgumentParser(description="Draft replies to inbox emails")
+    parser.add_argument(
+        "--batch",
+        type=int,
+        nargs="?",
+        const=settings.BATCH_SIZE,
+        default=None,
+        metavar="N",
+        help=f"answer the N most recent emails (default N: {settings.BATCH_SIZE})",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="in batch mode, only answer emails that arrived since the last run",
+    )
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="in batch mode, answer emails concurrently on an asyncio event loop",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=settings.MAX_WORKERS,
+        help="maximum number of emails to answer concurrently in batch mode",
+    )
+    return parser.parse_args(argv)
+
+
 if __name__ == "__main__":
-    sender_info, subject, body = get_email_message()
+    args = parse_args()
+
+    if args.batch is not None:
+        if settings.METRICS_PORT:
+            serve_metrics(tracer, settings.DAEMON_HOST, settings.METRICS_PORT)
+        # load the model while the vectorstore is synced and the emails are fetched
+        threading.Thread(target=warm_up, daemon=True).start()
+        get_vectorstore()
+        messages, history_id = get_email_messages(
+            max_results=args.batch, incremental=args.incremental
+        )
+        # messages drafted by an earlier run that did not advance the history id are listed again
+        drafted = GmailAPI.drafted_ids()
+        messages = [message for message in messages if message[0] not in drafted]
+        if args.use_async:
+            results = asyncio.run(aprocess_batch(messages, max_concurrency=args.workers))
+        else:
+            results = process_batch(messages, max_workers=args.workers)
+        # the next incremental run only starts after this batch if every message was drafted,
+        # otherwise it lists the batch again and skips the messages recorded as drafted
+        if all(results.values()):
+            GmailAPI.save_history(history_id)
+        else:
+            logger.warning("not advancing the history id, the next incremental run retries failures")
+            GmailAPI.save_drafted(i for i, created_draft in results.items() if created_draft)
+        for message_id, created_draft in results.items():
+            print(f"{message_id}: {'drafted' if created_draft else 'failed'}")
+        logger.info(f"caches: {cache_stats()}")
+        sys.exit(0 if all(results.values()) else 1)
+
+    _, sender_info, subject, body = get_email_message()
     sender_name, sender_email_address = sender_info
-    answer = answer_question(body)
+    if (answer := answer_question(body)) is None:
+        sys.exit(1)
     created_draft = create_draft(
         reciever=sender_email_address,
         subject=f"Re: {subject}",
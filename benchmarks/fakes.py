@@ -0,0 +1,306 @@
+import re
+import json
+import math
+import time
+import random
+import asyncio
+import hashlib
+import threading
+from collections import defaultdict
+from typing import Any
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+# every synthetic email mentions its ticket number, which the scripted LLM uses to look up its scenario
+TICKET_PATTERN = re.compile(r"ticket #(\d+)", re.IGNORECASE)
+COUNT_PATTERN = re.compile(r"Here are the (\d+) retrieved documents")
+QUESTION_PATTERN = re.compile(r"[^.!?\n:]*\?")
+
+# how the scripted LLM answers each kind of prompt for an email, which decides the path the email takes
+# through the graph. Grades are given per attempt, the last one repeating.
+SCENARIOS = {
+    "vectorstore": {
+        "route": "vectorstore",
+        "relevant": True,
+        "grounded": ["yes"],
+        "useful": ["yes"],
+    },
+    "websearch": {
+        "route": "web_search",
+        "relevant": True,
+        "grounded": ["yes"],
+        "useful": ["yes"],
+    },
+    "fallback": {
+        "route": "vectorstore",
+        "relevant": False,
+        "grounded": ["yes"],
+        "useful": ["yes"],
+    },
+    "hallucination": {
+        "route": "vectorstore",
+        "relevant": True,
+        "grounded": ["no", "yes"],
+        "useful": ["yes"],
+    },
+    "not_useful": {
+        "route": "vectorstore",
+        "relevant": True,
+        "grounded": ["yes"],
+        "useful": ["no", "yes"],
+    },
+    # emails asking several questions, which the splitter answers one by one
+    "split": {
+        "route": "vectorstore",
+        "relevant": True,
+        "grounded": ["yes"],
+        "useful": ["yes"],
+        "questions": 2,
+    },
+}
+
+# phrases that tell the prompts of the router, graders and RAG chain apart
+PROMPT_KINDS = [
+    ("split", "split a customer email into"),
+    ("route", "expert at routing"),
+    ("grade_documents", "numbered list of retrieved documents"),
+    ("grade_document", "of a retrieved document to a user question"),
+    ("grounded", "grounded in / supported by"),
+    ("useful", "useful to resolve a question"),
+    ("generate", "question-answering tasks"),
+]
+
+
+def count_tokens(text):
+    """Approximates the number of tokens in a text"""
+    return max(1, len(text) // 4)
+
+
+class FakeEncoder:
+    """Stand-in for the tiktoken encoder, which downloads its vocabulary, counting words as tokens"""
+
+    def encode(self, text):
+        return re.findall(r"\s*\S+", text)
+
+    def decode(self, tokens):
+        return "".join(tokens)
+
+
+class LatencyModel:
+    """Seeded latency of a fake service: a base latency per call plus a latency per token, with jitter"""
+
+    def __init__(self, latency=0.0, token_latency=0.0, jitter=0.0, seed=0):
+        self.latency = latency
+        self.token_latency = token_latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay(self, tokens=0):
+        with self._lock:
+            noise = self.random.uniform(-self.jitter, self.jitter) if self.jitter else 0
+        return max(0.0, (self.latency + self.token_latency * tokens) * (1 + noise))
+
+
+class Script:
+    """
+    Decides what the fake LLM replies to each prompt from the scenario of the email the prompt is about,
+    counting the attempts at each kind of prompt so grades can change between retries
+    """
+
+    def __init__(self, scenarios):
+        self.scenarios = scenarios
+        self.attempts = defaultdict(int)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def ticket(text):
+        """Returns the ticket number a prompt or email mentions, or None"""
+        return match.group(1) if (match := TICKET_PATTERN.search(text)) else None
+
+    def respond(self, text):
+        kind = next((kind for kind, phrase in PROMPT_KINDS if phrase in text), "generate")
+        ticket = self.ticket(text)
+        scenario = SCENARIOS[self.scenarios.get(ticket, "vectorstore")]
+        with self._lock:
+            attempt = self.attempts[ticket, kind]
+            self.attempts[ticket, kind] += 1
+
+        if kind == "split":
+            # each sub-question keeps the ticket number, so it is answered in the email's scenario
+            email = text.partition("Here is the email:")[2]
+            questions = [q.strip() for q in QUESTION_PATTERN.findall(email)]
+            return json.dumps({"questions": [f"About ticket #{ticket}: {q}" for q in questions]})
+        if kind == "route":
+            return json.dumps({"datasource": scenario["route"]})
+        if kind == "grade_document":
+            return json.dumps({"score": "yes" if scenario["relevant"] else "no"})
+        if kind == "grade_documents":
+            count = int(match.group(1)) if (match := COUNT_PATTERN.search(text)) else 1
+            return json.dumps({"scores": ["yes" if scenario["relevant"] else "no"] * count})
+        if kind in ("grounded", "useful"):
+            grades = scenario[kind]
+            return json.dumps({"score": grades[min(attempt, len(grades) - 1)]})
+        return (
+            f"Hi,\n\nThanks for reaching out about ticket #{ticket}. "
+            f"(draft {attempt + 1})\n\nBest regards"
+        )
+
+
+class FakeChatModel(BaseChatModel):
+    """Stand-in for ChatOllama that replies from a script after a simulated latency"""
+
+    script: Any
+    latency: Any
+    model: str = "fake-llama3"
+    format: str | None = None
+    temperature: float = 0
+
+    @property
+    def _llm_type(self):
+        return "fake-chat"
+
+    def reply(self, messages):
+        text = "\n".join(str(message.content) for message in messages)
+        content = self.script.respond(text)
+        prompt_tokens, completion_tokens = count_tokens(text), count_tokens(content)
+        result = ChatResult(
+            generations=[
+                ChatGeneration(
+                    message=AIMessage(content=content),
+                    generation_info={
+                        "prompt_eval_count": prompt_tokens,
+                        "eval_count": completion_tokens,
+                    },
+                )
+            ]
+        )
+        return result, self.latency.delay(prompt_tokens + completion_tokens)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        result, delay = self.reply(messages)
+        time.sleep(delay)
+        return result
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        result, delay = self.reply(messages)
+        await asyncio.sleep(delay)
+        return result
+
+
+class HashEmbeddings(Embeddings):
+    """
+    Deterministic embedder that hashes the words of a text into a fixed number of signed buckets, so texts
+    sharing words have similar vectors, after a simulated latency per call
+    """
+
+    def __init__(self, dimensions=384, latency=None):
+        self.dimensions = dimensions
+        self.latency = latency or LatencyModel()
+
+    def embed(self, text):
+        vector = [0.0] * self.dimensions
+        for word in re.findall(r"\w+", text.lower()):
+            digest = hashlib.blake2b(word.encode(), digest_size=8).digest()
+            bucket = int.from_bytes(digest[:4], "little") % self.dimensions
+            vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+        norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+        return [x / norm for x in vector]
+
+    def embed_documents(self, texts):
+        time.sleep(self.latency.delay(sum(count_tokens(text) for text in texts)))
+        return [self.embed(text) for text in texts]
+
+    def embed_query(self, text):
+        time.sleep(self.latency.delay(count_tokens(text)))
+        return self.embed(text)
+
+
+class FakeSearchTool:
+    """Stand-in for the Tavily search tool returning deterministic results after a simulated latency"""
+
+    def __init__(self, max_results=3, latency=None):
+        self.max_results = max_results
+        self.latency = latency or LatencyModel()
+        self.calls = 0
+
+    def results(self, query):
+        self.calls += 1
+        digest = hashlib.sha256(query.encode()).hexdigest()
+        return [
+            {
+                "url": f"https://example.com/{digest[:12]}/{i}",
+                "content": (
+                    f"Result {i} for '{query[:80]}': "
+                    f"security advisory {digest[i * 8 : i * 8 + 8]}."
+                ),
+            }
+            for i in range(self.max_results)
+        ]
+
+    def invoke(self, inputs, config=None):
+        time.sleep(self.latency.delay())
+        return self.results(inputs["query"])
+
+    async def ainvoke(self, inputs, config=None):
+        await asyncio.sleep(self.latency.delay())
+        return self.results(inputs["query"])
+
+
+class FakeGmailAPI:
+    """Stand-in for the GmailAPI class serving synthetic messages from memory after a simulated latency"""
+
+    messages = []
+    drafts = []
+    latency = LatencyModel()
+    lock = threading.Lock()
+
+    @classmethod
+    def get_messages(cls, max_results=3, incremental=False):
+        message_ids, history_id = cls.list_messages(max_results, incremental)
+        return cls.get_messages_by_id(message_ids), history_id
+
+    @classmethod
+    def list_messages(cls, max_results=3, incremental=False):
+        time.sleep(cls.latency.delay())
+        return [message["Id"] for message in cls.messages[:max_results]], None
+
+    @staticmethod
+    def save_history(history_id):
+        pass
+
+    @staticmethod
+    def drafted_ids():
+        return set()
+
+    @staticmethod
+    def save_drafted(message_ids):
+        pass
+
+    @classmethod
+    def get_messages_by_id(cls, ids):
+        time.sleep(cls.latency.delay())
+        by_id = {message["Id"]: message for message in cls.messages}
+        return [dict(by_id[i]) for i in ids if i in by_id]
+
+    @classmethod
+    def create_draft(cls, receiver, subject, content):
+        time.sleep(cls.latency.delay())
+        draft = {"id": f"draft-{len(cls.drafts)}", "to": receiver, "subject": subject}
+        cls.drafts.append(draft)
+        return draft
+
+    @classmethod
+    async def aget_messages(cls, max_results=3, incremental=False):
+        return await asyncio.to_thread(cls.get_messages, max_results, incremental)
+
+    @classmethod
+    async def aget_messages_by_id(cls, ids):
+        return await asyncio.to_thread(cls.get_messages_by_id, ids)
+
+    @classmethod
+    async def acreate_draft(cls, receiver, subject, content):
+        return await asyncio.to_thread(cls.create_draft, receiver, subject, content)
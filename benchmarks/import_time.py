@@ -0,0 +1,75 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+# seconds importing the application may take
+BUDGET = 2.0
+# the application is imported from the repository root, wherever the check runs from
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules that load models, open the vectorstore or create LLM clients; none of them
+# should be imported just by importing the application
+HEAVY_MODULES = [
+    "gpt4all",
+    "chromadb",
+    "tiktoken",
+    "langchain_community.chat_models",
+    "langchain_ollama",
+    "ollama",
+    "langchain_community.embeddings",
+    "langchain_community.vectorstores",
+    "langchain_community.document_loaders",
+    "langchain_community.tools",
+    "unstructured",
+]
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import app
+elapsed = time.perf_counter() - start
+print(json.dumps({"elapsed": elapsed, "modules": sorted(sys.modules)}))
+"""
+
+
+def measure_import():
+    """Imports the application in a fresh interpreter, returning the import time and the modules it loaded"""
+    start = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE], capture_output=True, text=True, check=True, cwd=ROOT
+    ).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result["total"] = time.perf_counter() - start
+    return result
+
+
+def check_import_time(budget=BUDGET):
+    """
+    Checks that importing the application finishes within the budget (in seconds) without
+    loading any heavy modules. Returns a list of the problems found.
+    """
+    result = measure_import()
+    problems = [
+        f"{module} imported at import time"
+        for module in HEAVY_MODULES
+        if any(m == module or m.startswith(f"{module}.") for m in result["modules"])
+    ]
+    if result["elapsed"] > budget:
+        problems.append(f"import took {result['elapsed']:.2f}s, budget is {budget:.2f}s")
+    print(f"import app: {result['elapsed']:.2f}s (interpreter total {result['total']:.2f}s)")
+    return problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the application's import time budget")
+    parser.add_argument("--budget", type=float, default=BUDGET, help="budget in seconds")
+    args = parser.parse_args()
+
+    if problems := check_import_time(args.budget):
+        for problem in problems:
+            print(f"FAIL: {problem}")
+        sys.exit(1)
+    print("OK")
@@ -0,0 +1,391 @@
+import os
+import sys
+import json
+import math
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from config import settings
+from benchmarks.fakes import (
+    SCENARIOS,
+    FakeChatModel,
+    FakeEncoder,
+    FakeGmailAPI,
+    FakeSearchTool,
+    HashEmbeddings,
+    LatencyModel,
+    Script,
+)
+
+logger = logging.getLogger(__name__)
+
+# the path of runs that raised
+ERROR = "error"
+
+TOPICS = {
+    "phishing": (
+        "Report suspicious emails, never enter credentials from a link and check the sender domain."
+    ),
+    "ransomware": "Isolate infected machines, keep offline backups and do not pay the ransom.",
+    "buffer overflow": (
+        "Validate input lengths and compile with stack protection to stop overflows."
+    ),
+    "password reset": (
+        "Reset passwords through the account portal and enable multi-factor authentication."
+    ),
+    "malware": (
+        "Run the endpoint scanner, remove unknown extensions and update the operating system."
+    ),
+    "adversarial attacks": (
+        "Adversarial inputs are perturbed to fool models, so validate and monitor inputs."
+    ),
+    "vpn": "Connect through the company VPN on public networks and keep the client up to date.",
+    "data breach": "Rotate exposed credentials, notify the security team and review access logs.",
+}
+
+QUESTIONS = [
+    "Hi, about ticket #{ticket}: I received an email that looks like {topic}. What should I do?",
+    "Hello, regarding ticket #{ticket}, how do I protect my laptop against {topic}?",
+    "Ticket #{ticket} - can you explain what {topic} is and whether I am affected?",
+]
+# asked by the emails of scenarios with several questions
+SPLIT_QUESTION = (
+    "Hi, about ticket #{ticket}: how do I protect my laptop against {topic}? "
+    "Separately, what should I do about {other}?"
+)
+
+
+def synthetic_corpus(documents_per_topic, seed=0):
+    """Returns (file name, text) pairs of synthetic knowledge base documents"""
+    rng = random.Random(seed)
+    corpus = []
+    for topic, advice in TOPICS.items():
+        for i in range(documents_per_topic):
+            filler = " ".join(rng.choice(advice.split()) for _ in range(40))
+            name = f"{topic.replace(' ', '_')}_{i}.md"
+            corpus.append((name, f"{topic.title()} guide {i}. {advice} {filler}"))
+    return corpus
+
+
+def synthetic_emails(count, mix, seed=0):
+    """Returns synthetic messages, each assigned a scenario drawn from the mix of scenario weights"""
+    rng = random.Random(seed)
+    scenarios, weights = zip(*mix.items())
+    messages = []
+    for i in range(count):
+        ticket = f"{i:04d}"
+        topic, other = rng.sample(list(TOPICS), 2)
+        scenario = rng.choices(scenarios, weights)[0]
+        template = (
+            SPLIT_QUESTION if SCENARIOS[scenario].get("questions", 1) > 1 else rng.choice(QUESTIONS)
+        )
+        messages.append(
+            {
+                "Id": f"msg-{ticket}",
+                "Sender": f"User {i} <user{i}@example.com>",
+                "Subject": f"Question about {topic}",
+                "Body": template.format(ticket=ticket, topic=topic, other=other),
+                "Scenario": scenario,
+                "Ticket": ticket,
+            }
+        )
+    return messages
+
+
+def configure(workdir, args):
+    """
+    Points the application's caches, index, data and traces at workdir and replaces the embedding model,
+    LLM, search tool and Gmail with fakes. Must run before the application modules are imported.
+    """
+    settings.DATA_DIR = os.path.join(workdir, "data")
+    settings.PERSIST_DIR = os.path.join(workdir, "index")
+    settings.NUMPY_INDEX_DIR = os.path.join(workdir, "index", "numpy")
+    settings.VECTOR_BACKEND = "numpy"
+    settings.PARSE_CACHE_DIR = os.path.join(workdir, "parse_cache")
+    settings.LLM_CACHE_FILE = os.path.join(workdir, "cache", "llm.sqlite")
+    settings.ANSWER_CACHE_FILE = os.path.join(workdir, "cache", "answers.sqlite")
+    settings.TRACE_FILE = os.path.join(workdir, "traces.jsonl")
+    settings.FAST_ROUTER = args.fast_router
+    settings.EMBEDDING_MODEL = HashEmbeddings(
+        latency=LatencyModel(args.embedding_latency, seed=args.seed)
+    )
+
+
+def install_fakes(messages, args):
+    """Replaces the LLM clients, web search tool, token encoder and Gmail service with fakes"""
+    import app
+    import llm.client
+    import llm.context
+    import llm.tools
+    import database.vectorstore
+
+    script = Script({message["Ticket"]: message["Scenario"] for message in messages})
+    # an email whose ticket the script cannot find would silently take the default path
+    unmatched = [m["Id"] for m in messages if script.ticket(m["Body"]) != m["Ticket"]]
+    if unmatched:
+        raise ValueError(f"no ticket number found in synthetic emails: {unmatched}")
+    latency = LatencyModel(args.llm_latency, args.llm_token_latency, args.jitter, seed=args.seed)
+    llm.client._clients[False] = FakeChatModel(script=script, latency=latency)
+    llm.client._clients[True] = FakeChatModel(script=script, latency=latency, format="json")
+
+    search = FakeSearchTool(
+        latency=LatencyModel(args.search_latency, jitter=args.jitter, seed=args.seed)
+    )
+    llm.tools.get_web_search_tool = lambda: search
+
+    encoder = FakeEncoder()
+    database.vectorstore.get_encoder = lambda: encoder
+    llm.context.get_encoder = lambda: encoder
+
+    FakeGmailAPI.messages = messages
+    FakeGmailAPI.latency = LatencyModel(args.gmail_latency, jitter=args.jitter, seed=args.seed)
+    app.GmailAPI = FakeGmailAPI
+    return search
+
+
+def seed_index(corpus):
+    """
+    Writes the corpus to the data directory and indexes one chunk per document, recording them in the
+    manifest so that opening the vectorstore finds it in sync instead of parsing the files
+    """
+    from database.loader import file_hash
+    from database.numpy_store import NumpyVectorStore
+    from database.vectorstore import chunk_id, save_manifest
+
+    os.makedirs(settings.DATA_DIR, exist_ok=True)
+    manifest = {
+        "chunking": {"chunk_size": settings.CHUNK_SIZE, "chunk_overlap": settings.CHUNK_OVERLAP},
+        "backend": settings.VECTOR_BACKEND,
+        "files": {},
+    }
+    texts, metadatas, ids = [], [], []
+    for name, text in corpus:
+        path = os.path.join(settings.DATA_DIR, name)
+        with open(path, "w") as f:
+            f.write(text)
+        texts.append(text)
+        metadatas.append({"source": path})
+        ids.append(chunk_id(name, text))
+        manifest["files"][name] = {"hash": file_hash(path), "chunks": [ids[-1]]}
+
+    store = NumpyVectorStore(
+        settings.NUMPY_INDEX_DIR, settings.EMBEDDING_MODEL, dtype=settings.NUMPY_INDEX_DTYPE
+    )
+    store.add_texts(texts, metadatas=metadatas, ids=ids)
+    save_manifest(manifest)
+
+
+def path_label(state):
+    """
+    Names the path an email took through the graph, from the graph's final state or a trace. Runs
+    that raised are labelled ERROR.
+    """
+    if str(state.get("outcome")).startswith("error"):
+        return ERROR
+    label = state.get("datasource") or "unrouted"
+    if label == "vectorstore" and state.get("web_searches"):
+        label = "vectorstore+websearch"
+    if (generations := state.get("generations") or 0) > 1:
+        label += f" ({generations} generations)"
+    return label
+
+
+def run_graph(messages, concurrency):
+    """
+    Streams each message through the compiled graph the application runs, returning (path, seconds)
+    per message
+    """
+    from llm.langgraph import workflow, email_workflow, initial_state
+
+    graph = (email_workflow if settings.FAN_OUT else workflow).compile()
+
+    def run(message):
+        start = time.perf_counter()
+        state = None
+        try:
+            for state in graph.stream(initial_state(message["Body"]), stream_mode="values"):
+                pass
+        except Exception as e:
+            logger.error(f"{message['Id']} ({message['Scenario']}) failed: {e!r}")
+            return ERROR, time.perf_counter() - start
+        return path_label(state or {}), time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(run, messages))
+
+
+def run_async_graph(messages, concurrency):
+    """Async version of run_graph, streaming the graph with async nodes on one event loop"""
+    from llm.async_langgraph import async_workflow, async_email_workflow
+    from llm.langgraph import initial_state
+
+    graph = (async_email_workflow if settings.FAN_OUT else async_workflow).compile()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(message):
+        async with semaphore:
+            start = time.perf_counter()
+            state = None
+            inputs = initial_state(message["Body"])
+            try:
+                async for state in graph.astream(inputs, stream_mode="values"):
+                    pass
+            except Exception as e:
+                logger.error(f"{message['Id']} ({message['Scenario']}) failed: {e!r}")
+                return ERROR, time.perf_counter() - start
+            return path_label(state or {}), time.perf_counter() - start
+
+    async def run_all():
+        return await asyncio.gather(*(run(message) for message in messages))
+
+    return asyncio.run(run_all())
+
+
+def run_end_to_end(messages, concurrency, use_async):
+    """
+    Fetches the messages from the fake Gmail service and drafts replies through the application's batch
+    processing, returning (path, seconds) per message read back from the run traces. Messages without a
+    trace are counted as errors.
+    """
+    import app
+
+    emails, _ = app.get_email_messages(max_results=len(messages))
+    if use_async:
+        asyncio.run(app.aprocess_batch(emails, max_concurrency=concurrency))
+    else:
+        app.process_batch(emails, max_workers=concurrency)
+
+    with open(settings.TRACE_FILE) as f:
+        traces = [json.loads(line) for line in f]
+    results = [(path_label(trace), trace["duration"]) for trace in traces]
+    return results + [(ERROR, 0.0)] * (len(messages) - len(results))
+
+
+def percentile(values, p):
+    """Returns the p-th percentile of the values by the nearest rank method"""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def summarize(results, elapsed):
+    """Returns the throughput and the latency percentiles of every path and of all messages"""
+    by_path = defaultdict(list)
+    for path, seconds in results:
+        by_path[path].append(seconds)
+        by_path["all"].append(seconds)
+
+    return {
+        "messages": len(results),
+        "errors": len(by_path.get(ERROR, [])),
+        "elapsed": elapsed,
+        "throughput": len(results) / elapsed if elapsed else 0.0,
+        "paths": {
+            path: {
+                "count": len(latencies),
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+                "p99": percentile(latencies, 99),
+            }
+            for path, latencies in sorted(by_path.items())
+        },
+    }
+
+
+def print_report(report):
+    print(
+        f"{report['messages']} messages in {report['elapsed']:.2f}s "
+        f"({report['throughput']:.2f} messages/s), {report['errors']} failed"
+    )
+    print(f"{'path':<40} {'count':>6} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for path, stats in report["paths"].items():
+        print(
+            f"{path:<40} {stats['count']:>6} {stats['p50']:>8.3f} "
+            f"{stats['p95']:>8.3f} {stats['p99']:>8.3f}"
+        )
+
+
+def parse_mix(text):
+    """Parses a scenario mix such as 'vectorstore=6,websearch=2,fallback=1'"""
+    mix = {}
+    for item in text.split(","):
+        scenario, _, weight = item.partition("=")
+        if scenario not in SCENARIOS:
+            raise argparse.ArgumentTypeError(
+                f"unknown scenario {scenario}, expected one of {', '.join(SCENARIOS)}"
+            )
+        mix[scenario] = float(weight or 1)
+    return mix
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the answering pipeline offline against a fake LLM, embedder, Gmail and search"
+    )
+    parser.add_argument("--emails", type=int, default=50)
+    parser.add_argument("--documents-per-topic", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=settings.MAX_WORKERS)
+    parser.add_argument(
+        "--mix",
+        type=parse_mix,
+        default=parse_mix(
+            "vectorstore=5,websearch=2,fallback=1,hallucination=1,not_useful=1,split=1"
+        ),
+        help=f"scenario weights, scenarios: {', '.join(SCENARIOS)}",
+    )
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="seconds per LLM call")
+    parser.add_argument("--llm-token-latency", type=float, default=0.0, help="seconds per token")
+    parser.add_argument("--embedding-latency", type=float, default=0.005)
+    parser.add_argument("--search-latency", type=float, default=0.2)
+    parser.add_argument("--gmail-latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.1, help="relative latency jitter")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--fast-router", action="store_true", help="route by vectorstore similarity")
+    parser.add_argument("--async", dest="use_async", action="store_true")
+    parser.add_argument(
+        "--end-to-end",
+        action="store_true",
+        help="fetch emails from fake Gmail and draft replies through the app's batch processing",
+    )
+    parser.add_argument("--json", metavar="FILE", help="also write the report as JSON to FILE")
+    parser.add_argument("--verbose", action="store_true", help="keep the application's INFO logs")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory(prefix="ragmail-bench-") as workdir:
+        configure(workdir, args)
+        messages = synthetic_emails(args.emails, args.mix, seed=args.seed)
+        install_fakes(messages, args)
+        if not args.verbose:
+            logging.getLogger().setLevel(logging.WARNING)
+        seed_index(synthetic_corpus(args.documents_per_topic, seed=args.seed))
+
+        from database.vectorstore import get_vectorstore
+
+        get_vectorstore()
+        start = time.perf_counter()
+        if args.end_to_end:
+            results = run_end_to_end(messages, args.concurrency, args.use_async)
+        elif args.use_async:
+            results = run_async_graph(messages, args.concurrency)
+        else:
+            results = run_graph(messages, args.concurrency)
+        report = summarize(results, time.perf_counter() - start)
+
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    # a benchmark with failed runs measures the failures, not the pipeline
+    sys.exit(1 if main()["errors"] else 0)
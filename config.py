@@ -1,8 +1,42 @@
 import os
 import logging
 import logging.config
+import functools
+import threading
 
-from langchain_community.embeddings import GPT4AllEmbeddings
+from database.embeddings import CachedEmbeddings
+
+
+def load_embedding_model():
+    """Loads the GPT4All embedding model"""
+    from langchain_community.embeddings import GPT4AllEmbeddings
+
+    return GPT4AllEmbeddings(
+        model_name=Settings.EMBEDDING_MODEL_NAME,
+        gpt4all_kwargs={"allow_download": "True"},
+    )
+
+
+def load_embeddings():
+    """
+    Returns the embedding model that texts missing the embedding cache are sent to: the model loaded in
+    process behind a micro-batcher, or a client of the shared embedding service if EMBEDDING_SERVICE is
+    "socket", which loads the model in process if the service is not running
+    """
+    from database.embedding_service import BatchingEmbeddings, SocketEmbeddings
+
+    def load_batching():
+        return BatchingEmbeddings(
+            load_embedding_model(),
+            max_batch_size=Settings.EMBEDDING_BATCH_SIZE,
+            max_wait=Settings.EMBEDDING_MAX_WAIT,
+        )
+
+    if Settings.EMBEDDING_SERVICE == "socket":
+        return SocketEmbeddings(Settings.EMBEDDING_SOCKET, fallback=load_batching)
+    if Settings.EMBEDDING_SERVICE != "local":
+        raise ValueError(f"unknown embedding service: {Settings.EMBEDDING_SERVICE}")
+    return load_batching()
 
 
 class Settings:
@@ -14,19 +48,130 @@ class Settings:
 
     # Vectorstore
     PERSIST_DIR = os.path.join(BASE_DIR, "database/.chromadb")
-    EMBEDDING_MODEL = GPT4AllEmbeddings(
-        model_name="all-MiniLM-L6-v2.gguf2.f16.gguf",
-        gpt4all_kwargs={"allow_download": "True"},
+    # "chroma", or "numpy" for an in-process, memory-mapped index of float16 or int8 vectors
+    VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chroma")
+    NUMPY_INDEX_DIR = os.path.join(BASE_DIR, "database/.numpy_index")
+    # "float32" is scored in place, "float16" and "int8" take less memory and are converted while scoring
+    NUMPY_INDEX_DTYPE = "float16"
+    CHUNK_SIZE = 250
+    CHUNK_OVERLAP = 0
+    # tiktoken encoding used to count tokens when chunking documents and packing prompt context
+    TOKEN_ENCODING = "gpt2"
+    PARSE_CACHE_DIR = os.path.join(BASE_DIR, "database/.parse_cache")
+    LOADER_WORKERS = os.cpu_count() or 1
+    RETRIEVER_K = 4
+    HYBRID_RETRIEVAL = True
+    RETRIEVER_FETCH_K = 10
+    RRF_K = 60
+    BM25_K1 = 1.5
+    BM25_B = 0.75
+    EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2.gguf2.f16.gguf"
+    EMBEDDING_CACHE_FILE = os.path.join(BASE_DIR, "database/.cache/embeddings.sqlite")
+    EMBEDDING_CACHE_SIZE = 200_000
+    EMBEDDING_BATCH_SIZE = 64
+    # "local" micro-batches the embed requests of all threads in process, "socket" sends them to the
+    # embedding service shared by all processes (python -m database.embedding_service)
+    EMBEDDING_SERVICE = os.getenv("EMBEDDING_SERVICE", "local")
+    EMBEDDING_SOCKET = os.getenv(
+        "EMBEDDING_SOCKET", os.path.join(BASE_DIR, "database/.cache/embeddings.sock")
+    )
+    # how long a micro-batch waits for more requests after its first one, in seconds
+    EMBEDDING_MAX_WAIT = 0.005
+    EMBEDDING_MODEL = CachedEmbeddings(
+        load_embeddings,
+        model_name=EMBEDDING_MODEL_NAME,
+        path=EMBEDDING_CACHE_FILE,
+        max_entries=EMBEDDING_CACHE_SIZE,
+        batch_size=EMBEDDING_BATCH_SIZE,
     )
 
     # LLM
     LLM_MODEL = "llama3"
+    OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
+    # how long Ollama keeps the model loaded after each request
+    LLM_KEEP_ALIVE = "30m"
+    # maximum number of requests sent to Ollama at once, across all threads
+    LLM_CONCURRENCY = 4
+    CONTEXT_MAX_TOKENS = 1500
+    GRADER_CONCURRENCY = 4
+    GRADE_DOCUMENTS_IN_ONE_CALL = False
+    LLM_CACHE_FILE = os.path.join(BASE_DIR, "database/.cache/llm.sqlite")
+    LLM_CACHE_SIZE = 100_000
+
+    # Router: the nearest chunk's relevance score decides the route when it falls outside
+    # the ambiguous band between these thresholds, otherwise the LLM router decides
+    FAST_ROUTER = True
+    ROUTER_VECTORSTORE_THRESHOLD = 0.5
+    ROUTER_WEB_SEARCH_THRESHOLD = 0.25
+    # start the web search while retrieving and grading when the LLM decides an ambiguous route
+    SPECULATIVE_WEB_SEARCH = True
+
+    # Web search
+    WEB_SEARCH_CACHE_TTL = 3600
+    WEB_SEARCH_CACHE_SIZE = 1000
+
+    # Per email budgets. MAX_LLM_CALLS is checked after each graded generation, and every
+    # sub-question of a split email may use enough calls to answer and retry once
+    MAX_GENERATIONS = 3
+    MAX_WEB_SEARCHES = 2
+    MAX_LLM_CALLS = 20
+    RUN_TIMEOUT = 120
+
+    # Answer cache
+    ANSWER_CACHE_FILE = os.path.join(BASE_DIR, "database/.cache/answers.sqlite")
+    ANSWER_CACHE_THRESHOLD = 0.95
+    ANSWER_CACHE_TTL = 7 * 24 * 3600
+    ANSWER_CACHE_SIZE = 1000
+
+    # Tracing: one JSON line per answered question, and Prometheus metrics on METRICS_PORT if set
+    TRACING = True
+    TRACE_FILE = os.path.join(BASE_DIR, "traces.jsonl")
+    METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+
+    # Question distillation: longer questions are cut down to their question sentences
+    MAX_QUESTION_CHARS = 1000
+    # split emails asking several unrelated questions and answer the questions in parallel
+    FAN_OUT = True
+    MAX_SUB_QUESTIONS = 3
+
+    # Batch processing
+    BATCH_SIZE = 10
+    MAX_WORKERS = 4
+
+    # Daemon
+    POLL_INTERVAL = 30
+    # after failed polls the interval doubles, up to this many times the poll interval
+    MAX_POLL_BACKOFF = 32
+    QUEUE_SIZE = 100
+    DAEMON_HOST = "127.0.0.1"
+    DAEMON_PORT = 8765
 
     # Gmail
     SCOPES = [
         "https://www.googleapis.com/auth/gmail.readonly",
         "https://www.googleapis.com/auth/gmail.compose",
     ]
+    GMAIL_BATCH_SIZE = 50
+    GMAIL_DISCOVERY_URL = os.getenv("GMAIL_DISCOVERY_URL")
+
+
+def singleton(factory):
+    """
+    Decorates a function without arguments so the object it creates is only created on the
+    first call and shared by every later call, from any thread
+    """
+    lock = threading.Lock()
+    instances = []
+
+    @functools.wraps(factory)
+    def get_instance():
+        if not instances:
+            with lock:
+                if not instances:
+                    instances.append(factory())
+        return instances[0]
+
+    return get_instance
 
 
 def setup_logging(service_name):
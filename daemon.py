@@ -0,0 +1,271 @@
+import json
+import queue
+import signal
+import logging
+import argparse
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from services.gmail import GmailAPI
+from database.vectorstore import get_vectorstore
+from llm.client import get_llm, limiter, warm_up
+from app import answer_question, cache_stats, create_draft, get_app, to_email_message, tracer
+from config import settings, setup_logging
+
+setup_logging("daemon")
+logger = logging.getLogger(__name__)
+
+
+class Daemon:
+    """
+    Long-running service that keeps the compiled graph, embedding model and vectorstore warm and drafts
+    replies to emails from an in-process work queue. Message ids are queued by a Gmail poller and by a
+    local HTTP endpoint; when the queue is full, the poller waits and the endpoint rejects new ids.
+    """
+
+    def __init__(self, workers=settings.MAX_WORKERS, poll_interval=settings.POLL_INTERVAL):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.queue = queue.Queue(maxsize=settings.QUEUE_SIZE)
+        self.stopping = threading.Event()
+        self.poll_now = threading.Event()
+        self.lock = threading.Lock()
+        # notified whenever a worker finishes a message
+        self.finished = threading.Condition(self.lock)
+        self.seen = OrderedDict()
+        self.in_flight = set()
+        self.processed = 0
+        self.failed = 0
+        self.threads = []
+        self.server = None
+
+    def warm_up(self):
+        """Loads the models and opens the vectorstore so the first email does not pay for it"""
+        logger.info("warming up")
+        get_app()
+        get_vectorstore()
+        settings.EMBEDDING_MODEL.embeddings
+        get_llm()
+        get_llm(json_mode=True)
+        warm_up()
+
+    def enqueue(self, message_id, block=True):
+        """
+        Queues a message id unless it was queued recently and did not fail. Blocks while the queue is
+        full unless block is unset, in which case returns False if the queue is full.
+        """
+        with self.lock:
+            if message_id in self.seen:
+                return True
+            self.seen[message_id] = None
+            self.in_flight.add(message_id)
+            while len(self.seen) > settings.QUEUE_SIZE * 100:
+                self.seen.popitem(last=False)
+
+        while not self.stopping.is_set():
+            try:
+                self.queue.put(message_id, block=block, timeout=1 if block else None)
+                return True
+            except queue.Full:
+                if not block:
+                    break
+        with self.lock:
+            self.seen.pop(message_id, None)
+            self.in_flight.discard(message_id)
+        return False
+
+    def poll(self):
+        """
+        Queues the messages added to the inbox, every poll_interval seconds or when asked to. After a
+        failed poll the interval is doubled, up to MAX_POLL_BACKOFF times, until a poll succeeds.
+        """
+        errors = 0
+        while not self.stopping.is_set():
+            try:
+                self.sync()
+                errors = 0
+            except Exception as e:
+                errors += 1
+                logger.error(f"polling Gmail failed ({errors} in a row): {e}")
+            backoff = min(2 ** errors, settings.MAX_POLL_BACKOFF) if errors else 1
+            self.poll_now.wait(self.poll_interval * backoff)
+            self.poll_now.clear()
+
+    def sync(self):
+        """
+        Queues the messages added since the stored history id and waits for them to be processed. The
+        history id only advances once every listed message has been drafted, so messages that failed or
+        could not be queued, e.g. during shutdown, are listed again by the next poll, while the ones
+        drafted are skipped as seen.
+        """
+        with GmailAPI.lock:
+            message_ids, history_id = GmailAPI.list_messages(
+                max_results=settings.BATCH_SIZE, incremental=True
+            )
+        if message_ids is None:
+            return
+        for message_id in message_ids:
+            self.enqueue(message_id)
+        with self.lock:
+            self.finished.wait_for(lambda: self.in_flight.isdisjoint(message_ids))
+            # failed messages are dropped from the seen ids
+            drafted = all(i in self.seen for i in message_ids)
+        if drafted:
+            with GmailAPI.lock:
+                GmailAPI.save_history(history_id)
+        else:
+            logger.warning("not advancing the history id, the next poll lists the failed messages again")
+
+    def work(self):
+        """Drafts replies to queued messages until stopped and the queue is drained"""
+        while not (self.stopping.is_set() and self.queue.empty()):
+            try:
+                message_id = self.queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            succeeded = False
+            try:
+                succeeded = self.reply(message_id)
+            except Exception as e:
+                logger.error(f"failed to reply to message {message_id}: {e}")
+            finally:
+                with self.lock:
+                    self.in_flight.discard(message_id)
+                    if succeeded:
+                        self.processed += 1
+                    else:
+                        self.failed += 1
+                        # so the message can be queued again, by a push or the next poll
+                        self.seen.pop(message_id, None)
+                    self.finished.notify_all()
+                self.queue.task_done()
+
+    def reply(self, message_id):
+        """Drafts a reply to a message, returning whether a draft was created"""
+        with GmailAPI.lock:
+            responses = GmailAPI.get_messages_by_id([message_id])
+        if not responses:
+            logger.error(f"failed to get message {message_id}")
+            return False
+
+        _, (sender_name, sender_email_address), subject, body = to_email_message(responses[0])
+        if (answer := answer_question(body)) is None:
+            return False
+
+        with GmailAPI.lock:
+            created_draft = create_draft(
+                reciever=sender_email_address,
+                subject=f"Re: {subject}",
+                content=answer,
+            )
+        if created_draft:
+            logger.info(f"Generated reply to {sender_name} for message {message_id}")
+        return created_draft
+
+    def status(self):
+        """Returns the daemon's queue and throughput counters"""
+        return {
+            "queued": self.queue.qsize(),
+            "in_flight": len(self.in_flight),
+            "capacity": self.queue.maxsize,
+            "processed": self.processed,
+            "failed": self.failed,
+            "stopping": self.stopping.is_set(),
+            "llm": limiter.stats(),
+            "caches": cache_stats(),
+        }
+
+    def start(self, poll=True, host=settings.DAEMON_HOST, port=settings.DAEMON_PORT):
+        """Starts the workers, the Gmail poller and the HTTP endpoint"""
+        self.warm_up()
+        targets = [self.work] * self.workers + ([self.poll] if poll else [])
+        for target in targets:
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+        if port:
+            self.server = ThreadingHTTPServer((host, port), make_handler(self))
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            logger.info(f"accepting message ids on http://{host}:{port}/messages")
+
+    def stop(self):
+        """Stops accepting messages and waits for the workers to drain the queue"""
+        if self.stopping.is_set():
+            return
+        logger.info(f"shutting down, {self.queue.qsize()} queued messages left to process")
+        self.stopping.set()
+        self.poll_now.set()
+        if self.server is not None:
+            self.server.shutdown()
+        for thread in self.threads:
+            thread.join()
+        logger.info(f"stopped: {self.status()}")
+
+
+def make_handler(daemon):
+    """Returns the HTTP request handler class serving the daemon"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                payload = tracer.metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                return self.wfile.write(payload)
+            if self.path != "/status":
+                return self.respond(404, {"error": "not found"})
+            self.respond(200, daemon.status())
+
+        def do_POST(self):
+            if daemon.stopping.is_set():
+                return self.respond(503, {"error": "shutting down"})
+            if self.path == "/sync":
+                daemon.poll_now.set()
+                return self.respond(202, {"sync": True})
+            if self.path != "/messages":
+                return self.respond(404, {"error": "not found"})
+
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                message_ids = json.loads(self.rfile.read(length))["ids"]
+            except (ValueError, KeyError, TypeError):
+                return self.respond(400, {"error": 'expected {"ids": [...]}'})
+
+            accepted = [i for i in message_ids if daemon.enqueue(str(i), block=False)]
+            rejected = [i for i in message_ids if i not in accepted]
+            self.respond(503 if rejected else 202, {"accepted": accepted, "rejected": rejected})
+
+        def respond(self, code, body):
+            payload = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Draft replies to inbox emails as they arrive")
+    parser.add_argument("--workers", type=int, default=settings.MAX_WORKERS)
+    parser.add_argument("--poll-interval", type=float, default=settings.POLL_INTERVAL)
+    parser.add_argument("--no-poll", action="store_true", help="only accept pushed message ids")
+    parser.add_argument("--port", type=int, default=settings.DAEMON_PORT, help="0 disables HTTP")
+    args = parser.parse_args()
+
+    daemon = Daemon(workers=args.workers, poll_interval=args.poll_interval)
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+
+    daemon.start(poll=not args.no_poll, port=args.port)
+    stop.wait()
+    daemon.stop()
@@ -0,0 +1,168 @@
+import os
+import re
+import json
+import math
+import logging
+import threading
+from pathlib import Path
+from typing import Any
+from collections import Counter, defaultdict
+
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+logger = logging.getLogger(__name__)
+
+# keeps identifiers such as CVE-2021-44228, log4j-core or 0x80070005 as single tokens
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[._\-][a-z0-9]+)*")
+SEPARATOR_PATTERN = re.compile(r"[._\-]")
+
+
+def tokenize(text):
+    """
+    Splits text into lowercase terms. Compound identifiers are emitted whole and as their parts, so
+    "log4j-core" also matches "log4j" and "CVE 2021-44228" matches "CVE-2021-44228".
+    """
+    terms = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        terms.append(token)
+        if SEPARATOR_PATTERN.search(token):
+            terms.extend(SEPARATOR_PATTERN.split(token))
+    return terms
+
+
+class BM25Index:
+    """
+    In-process inverted index over the vectorstore's chunks, scored with Okapi BM25. Chunks are
+    keyed by the same chunk ids as in the vectorstore, and the index is saved as JSON next to it.
+    """
+
+    def __init__(self, path, k1=1.5, b=0.75):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.documents = {}
+        self.lengths = {}
+        self.postings = defaultdict(dict)
+        self.total_length = 0
+        self._lock = threading.RLock()
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        """Loads the index saved at path, or returns an empty index if there is none"""
+        index = cls(path, **kwargs)
+        if os.path.exists(path):
+            with open(path) as f:
+                for chunk_id, entry in json.load(f).items():
+                    index.add(chunk_id, entry["text"], entry["metadata"])
+        return index
+
+    def save(self):
+        """Saves the index"""
+        with self._lock:
+            entries = {
+                chunk_id: {"text": document.page_content, "metadata": document.metadata}
+                for chunk_id, document in self.documents.items()
+            }
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # write to a temporary file first so concurrent readers never see a partial index
+        with open(f"{self.path}.{os.getpid()}.tmp", "w") as f:
+            json.dump(entries, f)
+        os.replace(f"{self.path}.{os.getpid()}.tmp", self.path)
+
+    def add(self, chunk_id, text, metadata=None):
+        """Adds a chunk to the index, replacing the chunk with the same id if there is one"""
+        with self._lock:
+            self.remove(chunk_id)
+            terms = Counter(tokenize(text))
+            for term, count in terms.items():
+                self.postings[term][chunk_id] = count
+            self.documents[chunk_id] = Document(page_content=text, metadata=metadata or {})
+            self.lengths[chunk_id] = sum(terms.values())
+            self.total_length += self.lengths[chunk_id]
+
+    def remove(self, chunk_id):
+        """Removes a chunk from the index"""
+        with self._lock:
+            if (document := self.documents.pop(chunk_id, None)) is None:
+                return
+            for term in set(tokenize(document.page_content)):
+                self.postings[term].pop(chunk_id, None)
+                if not self.postings[term]:
+                    del self.postings[term]
+            self.total_length -= self.lengths.pop(chunk_id)
+
+    def reconcile(self, vectorstore, chunk_ids):
+        """
+        Makes the index hold exactly the given chunk ids, removing other chunks and copying missing
+        chunks from the vectorstore. Returns whether the index changed.
+        """
+        chunk_ids = set(chunk_ids)
+        with self._lock:
+            stale = [i for i in self.documents if i not in chunk_ids]
+            missing = [i for i in chunk_ids if i not in self.documents]
+            for chunk_id in stale:
+                self.remove(chunk_id)
+            # stay under the vectorstore's limit on the number of ids per query
+            for start in range(0, len(missing), 5000):
+                found = vectorstore.get(
+                    ids=missing[start : start + 5000], include=["documents", "metadatas"]
+                )
+                for chunk_id, text, metadata in zip(
+                    found["ids"], found["documents"], found["metadatas"]
+                ):
+                    self.add(chunk_id, text, metadata)
+        if stale or missing:
+            logger.info(f"BM25 index: {len(missing)} chunks added, {len(stale)} removed")
+        return bool(stale or missing)
+
+    def search(self, query, k=4):
+        """Returns up to k (chunk id, document, score) triples matching the query, best first"""
+        with self._lock:
+            count = len(self.documents)
+            if count == 0:
+                return []
+            average_length = self.total_length / count
+            scores = defaultdict(float)
+            for term in set(tokenize(query)):
+                if not (postings := self.postings.get(term)):
+                    continue
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for chunk_id, frequency in postings.items():
+                    norm = 1 - self.b + self.b * self.lengths[chunk_id] / average_length
+                    scores[chunk_id] += (
+                        idf * frequency * (self.k1 + 1) / (frequency + self.k1 * norm)
+                    )
+            best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+            return [(chunk_id, self.documents[chunk_id], score) for chunk_id, score in best]
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Retrieves chunks from both the vectorstore and the BM25 index, fetching fetch_k candidates from each,
+    and returns the top k chunks by reciprocal rank fusion of the two rankings
+    """
+
+    vectorstore: Any
+    index: Any
+    k: int = 4
+    fetch_k: int = 10
+    rrf_k: int = 60
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        vector_hits = self.vectorstore.similarity_search(query, k=self.fetch_k)
+        keyword_hits = [document for _, document, _ in self.index.search(query, k=self.fetch_k)]
+        return reciprocal_rank_fusion([vector_hits, keyword_hits], k=self.k, rrf_k=self.rrf_k)
+
+
+def reciprocal_rank_fusion(rankings, k=4, rrf_k=60):
+    """Fuses rankings of documents, scoring each document by the sum of 1 / (rrf_k + rank)"""
+    scores = defaultdict(float)
+    documents = {}
+    for ranking in rankings:
+        for rank, document in enumerate(ranking, start=1):
+            key = (Path(document.metadata.get("source", "")).name, document.page_content)
+            scores[key] += 1 / (rrf_k + rank)
+            documents.setdefault(key, document)
+    best = sorted(scores, key=scores.get, reverse=True)[:k]
+    return [documents[key] for key in best]
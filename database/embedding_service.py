@@ -0,0 +1,271 @@
+import os
+import json
+import time
+import queue
+import socket
+import logging
+import argparse
+import threading
+import socketserver
+from array import array
+from concurrent.futures import Future
+
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+
+def embed_batch(model, texts):
+    """
+    Embeds texts in one call to the model. GPT4AllEmbeddings.embed_documents embeds its texts one at a
+    time, so its Embed4All client, which embeds a list of texts as one batch, is called directly.
+    """
+    client = getattr(model, "client", None)
+    if callable(getattr(client, "embed", None)):
+        return client.embed(texts)
+    return model.embed_documents(texts)
+
+
+class MicroBatcher:
+    """
+    Collects concurrent embed requests into micro-batches that a single thread sends to the model. A
+    batch is sent once it holds max_batch_size texts or max_wait seconds after its first request
+    arrived, whichever comes first. Texts requested more than once in a batch are embedded once.
+    """
+
+    def __init__(self, embed, max_batch_size=64, max_wait=0.005):
+        self.embed = embed
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = 0
+        self.texts = 0
+        self.batches = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, texts):
+        """Queues texts to be embedded, returning a future of their vectors"""
+        future = Future()
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self.run, daemon=True)
+                    self._thread.start()
+        self._queue.put((texts, future))
+        return future
+
+    def run(self):
+        while True:
+            batch = [self._queue.get()]
+            size = len(batch[0][0])
+            deadline = time.perf_counter() + self.max_wait
+            while size < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                size += len(request[0])
+            self.process(batch)
+
+    def process(self, batch):
+        """Embeds the texts of a batch of requests and resolves each request's future"""
+        texts = list(dict.fromkeys(text for request, _ in batch for text in request))
+        with self._lock:
+            self.requests += len(batch)
+            self.texts += len(texts)
+            self.batches += 1
+        try:
+            vectors = dict(zip(texts, self.embed(texts)))
+        except Exception as e:
+            logger.error(f"failed to embed a batch of {len(texts)} texts: {e}")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for request, future in batch:
+            future.set_result([list(vectors[text]) for text in request])
+
+    def stats(self):
+        """Returns the batcher's request and batch counters"""
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "texts": self.texts,
+                "batches": self.batches,
+                "waiting": self._queue.qsize(),
+            }
+
+
+class BatchingEmbeddings(Embeddings):
+    """Embeds texts with a model shared by all threads, micro-batching concurrent requests"""
+
+    def __init__(self, model, max_batch_size=64, max_wait=0.005):
+        self.model = model
+        self.batcher = MicroBatcher(lambda texts: embed_batch(model, texts), max_batch_size, max_wait)
+
+    def embed_documents(self, texts):
+        return self.batcher.submit(list(texts)).result() if texts else []
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+# == UNIX SOCKET SERVICE == #
+# A request is a JSON line {"texts": [...]}. The reply is a JSON line {"count": n, "dim": d} followed by
+# the n vectors as n * d float32 values in the machine's byte order, or a JSON line {"error": message}.
+
+
+class EmbeddingHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                texts = json.loads(line)["texts"]
+                vectors = self.server.embeddings.embed_documents(texts)
+            except Exception as e:
+                self.wfile.write(json.dumps({"error": str(e)}).encode() + b"\n")
+                continue
+            dim = len(vectors[0]) if vectors else 0
+            payload = array("f", (value for vector in vectors for value in vector))
+            header = json.dumps({"count": len(vectors), "dim": dim}).encode() + b"\n"
+            self.wfile.write(header + payload.tobytes())
+
+
+class EmbeddingServer(socketserver.ThreadingUnixStreamServer):
+    """Serves embed requests from all local pipeline processes on a Unix socket"""
+
+    daemon_threads = True
+
+    def __init__(self, path, embeddings):
+        self.path = path
+        self.embeddings = embeddings
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, EmbeddingHandler)
+        os.chmod(path, 0o600)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class SocketEmbeddings(Embeddings):
+    """
+    Client of the embedding service, keeping one connection per thread. If the service cannot be
+    reached, the model is loaded in process by calling fallback, if given, and used from then on.
+    """
+
+    def __init__(self, path, fallback=None, timeout=60):
+        self.path = path
+        self.fallback = fallback
+        self.timeout = timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._fallback_embeddings = None
+
+    def connection(self):
+        """Connects this thread to the service on first use"""
+        if getattr(self._local, "file", None) is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.path)
+            except OSError:
+                sock.close()
+                raise
+            self._local.sock = sock
+            self._local.file = sock.makefile("rwb")
+        return self._local.file
+
+    def disconnect(self):
+        if (file := getattr(self._local, "file", None)) is not None:
+            self._local.file = None
+            for closeable in (file, self._local.sock):
+                try:
+                    closeable.close()
+                except OSError:
+                    pass
+
+    def request(self, texts):
+        """Sends texts to the service and returns their vectors"""
+        file = self.connection()
+        file.write(json.dumps({"texts": texts}).encode() + b"\n")
+        file.flush()
+        if not (line := file.readline()):
+            raise ConnectionError("the embedding service closed the connection")
+        header = json.loads(line)
+        if "error" in header:
+            raise RuntimeError(f"embedding service: {header['error']}")
+        count, dim = header["count"], header["dim"]
+        payload = array("f")
+        data = file.read(count * dim * payload.itemsize)
+        if len(data) < count * dim * payload.itemsize:
+            raise ConnectionError("the embedding service closed the connection")
+        payload.frombytes(data)
+        values = payload.tolist()
+        return [values[i * dim : (i + 1) * dim] for i in range(count)]
+
+    @property
+    def fallback_embeddings(self):
+        """Loads the fallback model on first use"""
+        if self._fallback_embeddings is None:
+            with self._lock:
+                if self._fallback_embeddings is None:
+                    logger.warning(f"embedding service not reachable at {self.path}, loading the model")
+                    self._fallback_embeddings = self.fallback()
+        return self._fallback_embeddings
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+        if self._fallback_embeddings is None:
+            try:
+                return self.request(list(texts))
+            except OSError:
+                # the connection may have been broken by a restart of the service, retry on a new one
+                self.disconnect()
+            try:
+                return self.request(list(texts))
+            except OSError:
+                self.disconnect()
+                if self.fallback is None:
+                    raise
+        return self.fallback_embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def main():
+    from config import settings, load_embedding_model, setup_logging
+
+    parser = argparse.ArgumentParser(
+        description="Serve the embedding model to all local pipeline processes on a Unix socket"
+    )
+    parser.add_argument("--socket", default=settings.EMBEDDING_SOCKET, help="socket path")
+    args = parser.parse_args()
+
+    setup_logging("embedding_service")
+    logger.info(f"Loading embedding model: {settings.EMBEDDING_MODEL_NAME}")
+    embeddings = BatchingEmbeddings(
+        load_embedding_model(),
+        max_batch_size=settings.EMBEDDING_BATCH_SIZE,
+        max_wait=settings.EMBEDDING_MAX_WAIT,
+    )
+    with EmbeddingServer(args.socket, embeddings) as server:
+        logger.info(f"serving embeddings on {args.socket}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            logger.info(f"stopped: {embeddings.batcher.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+import time
+import hashlib
+import logging
+import threading
+from array import array
+
+from langchain_core.embeddings import Embeddings
+
+from database.sqlite_cache import LastUsed, connect
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an embedding model with a persistent SQLite cache keyed by model name and text hash.
+    Texts that miss the cache are embedded in batches of batch_size, and the least recently
+    used vectors are evicted once the cache holds more than max_entries vectors. The model is
+    only loaded, by calling load_embeddings, the first time a text misses the cache.
+    """
+
+    def __init__(self, load_embeddings, model_name, path, max_entries=100_000, batch_size=64):
+        self.load_embeddings = load_embeddings
+        self.model_name = model_name
+        self.path = path
+        self.max_entries = max_entries
+        self.batch_size = batch_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        self._embeddings = None
+        self._last_used = LastUsed("embeddings")
+
+    @property
+    def embeddings(self):
+        """Loads the embedding model on first use"""
+        if self._embeddings is None:
+            with self._lock:
+                if self._embeddings is None:
+                    logger.info(f"Loading embedding model: {self.model_name}")
+                    self._embeddings = self.load_embeddings()
+        return self._embeddings
+
+    @property
+    def conn(self):
+        """Opens the cache database on first use"""
+        if self._conn is None:
+            self._conn = connect(self.path)
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS embeddings (
+                    key TEXT PRIMARY KEY,
+                    vector BLOB NOT NULL,
+                    last_used REAL NOT NULL
+                )"""
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+            )
+        return self._conn
+
+    def key(self, text):
+        """Returns the cache key of a text for this model"""
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode()).hexdigest()
+
+    def embed_documents(self, texts):
+        """Embeds texts, only sending the texts that are not cached to the model"""
+        keys = [self.key(text) for text in texts]
+        vectors = self.lookup(set(keys))
+
+        # identical texts are only embedded once
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                missing.setdefault(key, text)
+
+        with self._lock:
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+
+        missing = list(missing.items())
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start : start + self.batch_size]
+            with span("embed", texts=len(batch)):
+                embedded = self.embeddings.embed_documents([text for _, text in batch])
+            computed = {key: vector for (key, _), vector in zip(batch, embedded)}
+            self.store(computed)
+            vectors.update(computed)
+
+        return [vectors[key] for key in keys]
+
+    def embed_query(self, text):
+        """Embeds a query, returning the cached vector if the same text was embedded before"""
+        key = self.key(text)
+        if (vector := self.lookup({key}).get(key)) is not None:
+            with self._lock:
+                self.hits += 1
+            return vector
+
+        with self._lock:
+            self.misses += 1
+        with span("embed", texts=1):
+            vector = self.embeddings.embed_query(text)
+        self.store({key: vector})
+        return vector
+
+    def lookup(self, keys):
+        """Returns the cached vectors of the given keys and marks them as recently used"""
+        if not keys:
+            return {}
+        keys = list(keys)
+        vectors = {}
+        with self._lock:
+            # stay under SQLite's limit on the number of query parameters
+            for start in range(0, len(keys), 500):
+                batch = keys[start : start + 500]
+                rows = self.conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})",
+                    batch,
+                )
+                for key, blob in rows:
+                    vectors[key] = array("f", blob).tolist()
+            self._last_used.touch(self.conn, vectors)
+        return vectors
+
+    def store(self, vectors):
+        """Caches the given vectors, evicting the least recently used ones if the cache is full"""
+        now = time.time()
+        with self._lock:
+            self._last_used.flush(self.conn)
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, array("f", vector).tobytes(), now) for key, vector in vectors.items()],
+            )
+            (count,) = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+            if count > self.max_entries:
+                logger.debug(f"evicting {count - self.max_entries} cached embeddings")
+                self.conn.execute(
+                    """DELETE FROM embeddings WHERE key IN (
+                        SELECT key FROM embeddings ORDER BY last_used LIMIT ?
+                    )""",
+                    (count - self.max_entries,),
+                )
+            self.conn.commit()
+
+    def stats(self):
+        """Returns the cache's hit and miss counters"""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
@@ -1,17 +1,21 @@
+import os
+import json
+import hashlib
 import logging
+import multiprocessing
 from pathlib import Path
-from langchain_community.vectorstores.utils import filter_complex_metadata
-
-from langchain_community.document_loaders import (
-    UnstructuredPDFLoader,
-    UnstructuredMarkdownLoader,
-)
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from config import settings
+from langchain_core.documents import Document
 
 logger = logging.getLogger(__name__)
 
 
 def load_pdf(file_path):
     """Given a file path, loads the pdf file and returns a list of documents"""
+    from langchain_community.document_loaders import UnstructuredPDFLoader
+    from langchain_community.vectorstores.utils import filter_complex_metadata
+
     logger.info(f"Loading PDF file: {file_path}")
     loader = UnstructuredPDFLoader(file_path)
     documents = loader.load()
@@ -21,6 +25,9 @@ def load_pdf(file_path):
 
 def load_markdown(file_path):
     """Given a file path, loads the markdown file and returns a list of documents"""
+    from langchain_community.document_loaders import UnstructuredMarkdownLoader
+    from langchain_community.vectorstores.utils import filter_complex_metadata
+
     logger.info(f"Loading Markdown file: {file_path}")
     loader = UnstructuredMarkdownLoader(file_path)
     documents = loader.load()
@@ -34,19 +41,107 @@ loaders = {
 }
 
 
-def load_data(directory):
+def file_hash(file_path):
+    """Returns the sha256 hash of a file's contents"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_path(file_path, digest):
+    """Returns the path of the parse cache entry for a file with the given content hash"""
+    suffix = Path(file_path).suffix.lower().lstrip(".")
+    return os.path.join(settings.PARSE_CACHE_DIR, f"{digest}.{suffix}.json")
+
+
+def read_cache(file_path, digest):
+    """Returns the cached documents parsed from a file with the given content hash, if any"""
+    try:
+        with open(cache_path(file_path, digest)) as f:
+            entries = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return [
+        Document(
+            page_content=entry["page_content"],
+            metadata={**entry["metadata"], "source": str(file_path)},
+        )
+        for entry in entries
+    ]
+
+
+def write_cache(file_path, digest, documents):
+    """Caches the documents parsed from a file under its content hash"""
+    os.makedirs(settings.PARSE_CACHE_DIR, exist_ok=True)
+    path = cache_path(file_path, digest)
+    entries = [
+        {"page_content": doc.page_content, "metadata": doc.metadata}
+        for doc in documents
+    ]
+    # write to a temporary file first so concurrent readers never see a partial entry
+    with open(f"{path}.{os.getpid()}.tmp", "w") as f:
+        json.dump(entries, f)
+    os.replace(f"{path}.{os.getpid()}.tmp", path)
+
+
+def load_file(file_path, digest=None):
+    """
+    Given a file path, loads the file with the loader for its extension and returns a list of documents.
+    Parsed documents are cached on disk by the file's content hash, so unchanged files are never re-parsed.
+    """
+    loader = loaders.get(Path(file_path).suffix.lower())
+    if loader is None:
+        logger.error(f"No loader available for file: {file_path}")
+        return None
+
+    digest = digest or file_hash(file_path)
+    if (documents := read_cache(file_path, digest)) is not None:
+        logger.info(f"Loaded cached parse of file: {file_path}")
+        return documents
+
+    documents = loader(str(file_path))
+    write_cache(file_path, digest, documents)
+    return documents
+
+
+def load_files(file_paths, digests=None, max_workers=settings.LOADER_WORKERS):
+    """
+    Loads files in a pool of processes, yielding (file path, documents) for each file as soon as it
+    has been parsed so that callers can process documents while the remaining files are still loading
+    """
+    digests = digests or {}
+    file_paths = list(file_paths)
+    if max_workers <= 1 or len(file_paths) <= 1:
+        for file_path in file_paths:
+            yield file_path, load_file(file_path, digests.get(file_path))
+        return
+
+    # workers are spawned rather than forked, since the sync can run while other threads hold locks,
+    # e.g. the logging handler's, that a forked child would inherit locked
+    with ProcessPoolExecutor(
+        max_workers=min(max_workers, len(file_paths)),
+        mp_context=multiprocessing.get_context("spawn"),
+    ) as executor:
+        futures = {
+            executor.submit(load_file, file_path, digests.get(file_path)): file_path
+            for file_path in file_paths
+        }
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+def iter_data(directory):
+    """Yields the documents of every file in a directory, file by file as each one finishes loading"""
     if not Path(directory).is_dir():
         raise NotADirectoryError(f"{directory} is not a valid directory")
 
-    loaded_documents = []
-    for file_path in Path(directory).iterdir():
-        if file_path.is_file():
-            file_extension = file_path.suffix.lower()
-            loader = loaders.get(file_extension)
-            if loader:
-                documents = loader(str(file_path))
-                loaded_documents.append(documents)
-            else:
-                logger.error(f"No loader available for file: {file_path}")
-
-    return loaded_documents
+    file_paths = [file_path for file_path in Path(directory).iterdir() if file_path.is_file()]
+    for _, documents in load_files(file_paths):
+        if documents is not None:
+            yield documents
+
+
+def load_data(directory):
+    return list(iter_data(directory))
@@ -0,0 +1,240 @@
+import os
+import json
+import logging
+import threading
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+logger = logging.getLogger(__name__)
+
+DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+# int8 vectors store unit vectors scaled to the int8 range
+INT8_SCALE = 127
+# float16 and int8 matrices are converted to float32 for scoring this many rows at a time
+SCORE_BLOCK_ROWS = 4096
+
+
+def inner_products(matrix, query):
+    """
+    Returns the inner products of the rows of a matrix with a float32 query. A float32 matrix is scored
+    in place. Other dtypes are converted a block of rows at a time, so a search never copies the whole
+    memory-mapped matrix and its pages stay shared between processes.
+    """
+    if matrix.dtype == np.float32:
+        return matrix @ query
+    products = np.empty(len(matrix), dtype=np.float32)
+    for start in range(0, len(matrix), SCORE_BLOCK_ROWS):
+        block = matrix[start : start + SCORE_BLOCK_ROWS]
+        products[start : start + len(block)] = block.astype(np.float32) @ query
+    return products
+
+
+class NumpyVectorStore(VectorStore):
+    """
+    Vectorstore that keeps unit-normalized embeddings in a memory-mapped float32, float16 or int8 matrix,
+    with the ids, texts and metadata in a JSON sidecar file that names the matrix file of its version.
+    Search is an exact, vectorized top-k over the matrix.
+    Processes opening the same directory share the matrix's pages through the OS page cache, and pick up
+    changes written by another process on their next search.
+
+    Distances are squared euclidean distances between unit vectors, like Chroma's default "l2" space,
+    so relevance scores and thresholds behave the same with either backend.
+    """
+
+    def __init__(self, persist_directory, embedding_function, dtype="float16"):
+        self.persist_directory = persist_directory
+        self.embedding_function = embedding_function
+        self.dtype = dtype
+        self.sidecar_file = os.path.join(persist_directory, "index.json")
+        self._lock = threading.RLock()
+        self._loaded_at = None
+        self.ids, self.texts, self.metadatas = [], [], []
+        self.matrix = None
+        self.load()
+
+    @property
+    def embeddings(self):
+        return self.embedding_function
+
+    def load(self):
+        """
+        (Re)loads the index from disk if it changed since it was last loaded. Raises a ValueError if the
+        matrix does not have a row per id.
+        """
+        with self._lock:
+            while True:
+                try:
+                    modified = os.stat(self.sidecar_file).st_mtime_ns
+                except FileNotFoundError:
+                    return
+                if modified == self._loaded_at:
+                    return
+                with open(self.sidecar_file) as f:
+                    sidecar = json.load(f)
+                # indexes written before matrix files were versioned name none
+                matrix_file = os.path.join(self.persist_directory, sidecar.get("matrix", "vectors.npy"))
+                try:
+                    matrix = np.load(matrix_file, mmap_mode="r") if sidecar["ids"] else None
+                    break
+                except FileNotFoundError:
+                    # unless a newer version replaced the sidecar and removed this version's matrix
+                    if os.stat(self.sidecar_file).st_mtime_ns == modified:
+                        raise
+
+            rows = len(matrix) if matrix is not None else 0
+            if rows != len(sidecar["ids"]):
+                raise ValueError(
+                    f"{matrix_file} has {rows} rows but {self.sidecar_file} lists {len(sidecar['ids'])} ids"
+                )
+            self.ids = sidecar["ids"]
+            self.texts = sidecar["texts"]
+            self.metadatas = sidecar["metadatas"]
+            self.matrix = matrix
+            self._loaded_at = modified
+
+    def save(self, ids, texts, metadatas, matrix):
+        """
+        Writes a new version of the index. The matrix is written to a new file that the sidecar names, and
+        the sidecar is replaced atomically, so readers see either the old or the new version as a whole.
+        The matrix files of older versions are removed; processes that memory-mapped them keep their pages.
+        """
+        os.makedirs(self.persist_directory, exist_ok=True)
+        with self._lock:
+            matrix_name = f"vectors-{os.urandom(8).hex()}.npy"
+            np.save(os.path.join(self.persist_directory, matrix_name), matrix)
+            tmp = f"{self.sidecar_file}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(
+                    {"matrix": matrix_name, "ids": ids, "texts": texts, "metadatas": metadatas}, f
+                )
+            os.replace(tmp, self.sidecar_file)
+            for name in os.listdir(self.persist_directory):
+                if name.startswith("vectors") and name.endswith(".npy") and name != matrix_name:
+                    try:
+                        os.remove(os.path.join(self.persist_directory, name))
+                    except FileNotFoundError:
+                        pass
+            self._loaded_at = None
+            self.load()
+
+    def encode(self, vectors):
+        """Normalizes vectors to unit length and converts them to the storage dtype"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1, norms)
+        if self.dtype == "int8":
+            return np.round(vectors * INT8_SCALE).astype(np.int8)
+        return vectors.astype(DTYPES[self.dtype])
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        """Embeds and adds texts, replacing existing entries with the same ids"""
+        texts = list(texts)
+        metadatas = list(metadatas) if metadatas else [{} for _ in texts]
+        ids = list(ids) if ids else [os.urandom(16).hex() for _ in texts]
+        if not texts:
+            return []
+        vectors = self.encode(self.embedding_function.embed_documents(texts))
+
+        with self._lock:
+            self.load()
+            replaced = set(ids)
+            keep = [i for i, chunk_id in enumerate(self.ids) if chunk_id not in replaced]
+            old = self.matrix[keep] if self.matrix is not None else vectors[:0]
+            self.save(
+                [self.ids[i] for i in keep] + ids,
+                [self.texts[i] for i in keep] + texts,
+                [self.metadatas[i] for i in keep] + metadatas,
+                np.concatenate([old, vectors]),
+            )
+        return ids
+
+    def delete(self, ids=None, **kwargs):
+        """Deletes the entries with the given ids"""
+        if not ids:
+            return None
+        with self._lock:
+            self.load()
+            deleted = set(ids)
+            keep = [i for i, chunk_id in enumerate(self.ids) if chunk_id not in deleted]
+            if len(keep) == len(self.ids):
+                return True
+            matrix = self.matrix[keep] if self.matrix is not None else None
+            self.save(
+                [self.ids[i] for i in keep],
+                [self.texts[i] for i in keep],
+                [self.metadatas[i] for i in keep],
+                matrix if matrix is not None else np.zeros((0, 0), DTYPES[self.dtype]),
+            )
+        return True
+
+    def get(self, ids=None, include=None):
+        """Returns stored entries, in the same format as Chroma's get"""
+        self.load()
+        with self._lock:
+            if ids is None:
+                rows = range(len(self.ids))
+            else:
+                positions = {chunk_id: i for i, chunk_id in enumerate(self.ids)}
+                rows = [positions[i] for i in ids if i in positions]
+            return {
+                "ids": [self.ids[i] for i in rows],
+                "documents": [self.texts[i] for i in rows],
+                "metadatas": [self.metadatas[i] for i in rows],
+            }
+
+    def similarity_search_by_vector_with_score(self, embedding, k=4, filter=None):
+        """
+        Returns the k nearest entries to the embedding with their distances, optionally only among
+        entries whose metadata has all of the key/value pairs in filter
+        """
+        self.load()
+        with self._lock:
+            if self.matrix is None:
+                return []
+            matrix, ids, texts, metadatas = self.matrix, self.ids, self.texts, self.metadatas
+
+        query = self.encode(embedding).astype(np.float32)
+        similarities = inner_products(matrix, query)
+        if self.dtype == "int8":
+            similarities /= INT8_SCALE * INT8_SCALE
+
+        if filter:
+            mask = np.array(
+                [all(m.get(key) == value for key, value in filter.items()) for m in metadatas]
+            )
+            similarities = np.where(mask, similarities, -np.inf)
+
+        k = min(k, int(np.isfinite(similarities).sum()))
+        if k <= 0:
+            return []
+        top = np.argpartition(-similarities, k - 1)[:k]
+        top = top[np.argsort(-similarities[top])]
+        return [
+            (
+                Document(page_content=texts[i], metadata=metadatas[i], id=ids[i]),
+                float(2 - 2 * similarities[i]),
+            )
+            for i in top
+        ]
+
+    def similarity_search_with_score(self, query, k=4, filter=None, **kwargs):
+        embedding = self.embedding_function.embed_query(query)
+        return self.similarity_search_by_vector_with_score(embedding, k=k, filter=filter)
+
+    def similarity_search(self, query, k=4, filter=None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k, filter=filter)]
+
+    def similarity_search_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        results = self.similarity_search_by_vector_with_score(embedding, k=k, filter=filter)
+        return [doc for doc, _ in results]
+
+    def _select_relevance_score_fn(self):
+        return self._euclidean_relevance_score_fn
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, ids=None, **kwargs):
+        store = cls(embedding_function=embedding, **kwargs)
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return store
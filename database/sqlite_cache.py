@@ -0,0 +1,54 @@
+import os
+import time
+import sqlite3
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def connect(path, timeout=30):
+    """
+    Opens a cache database that threads and processes share. In WAL mode readers are not blocked by a
+    writer, and a connection waits up to timeout seconds for another process's write lock.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class LastUsed:
+    """
+    Collects the last use times of cache entries in memory and writes them in bulk, so that cache hits
+    do not write to disk. Pending times are written once max_pending have accumulated or interval
+    seconds after the last write, and should be flushed before evicting. Times not yet written when the
+    process exits are lost, which only makes the eviction order slightly stale.
+    """
+
+    def __init__(self, table, key_column="key", max_pending=256, interval=5.0):
+        self.table = table
+        self.key_column = key_column
+        self.max_pending = max_pending
+        self.interval = interval
+        self.pending = {}
+        self.flushed = time.monotonic()
+
+    def touch(self, conn, keys):
+        """Marks entries as used now, writing the pending times if due. The caller holds the cache's lock."""
+        now = time.time()
+        self.pending.update((key, now) for key in keys)
+        if len(self.pending) >= self.max_pending or time.monotonic() - self.flushed >= self.interval:
+            self.flush(conn)
+
+    def flush(self, conn):
+        """Writes the pending times. The caller holds the cache's lock."""
+        self.flushed = time.monotonic()
+        if not self.pending:
+            return
+        conn.executemany(
+            f"UPDATE {self.table} SET last_used = ? WHERE {self.key_column} = ?",
+            [(used, key) for key, used in self.pending.items()],
+        )
+        conn.commit()
+        self.pending.clear()
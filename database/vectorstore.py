@@ -1,42 +1,202 @@
 import os
+import json
+import hashlib
 import logging
-from config import settings
-from langchain_community.vectorstores import Chroma
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from database.loader import load_data
+from pathlib import Path
+from config import settings, singleton
+from database.loader import load_files, file_hash, loaders
+from database.bm25 import BM25Index, HybridRetriever
 
 logger = logging.getLogger(__name__)
 
+MANIFEST_FILE = os.path.join(settings.PERSIST_DIR, "manifest.json")
+BM25_FILE = os.path.join(settings.PERSIST_DIR, "bm25.json")
 
-def init_vectorstore():
+
+@singleton
+def get_text_splitter():
+    """Returns the shared text splitter, which chunks documents by tiktoken token counts"""
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    return RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+        encoding_name=settings.TOKEN_ENCODING,
+        chunk_size=settings.CHUNK_SIZE,
+        chunk_overlap=settings.CHUNK_OVERLAP,
+    )
+
+
+@singleton
+def get_encoder():
+    """Returns the shared tiktoken encoder, the same one the text splitter counts tokens with"""
+    import tiktoken
+
+    return tiktoken.get_encoding(settings.TOKEN_ENCODING)
+
+
+def chunk_id(source, content):
+    """Returns the id of a chunk, derived from the file it belongs to and its content"""
+    return hashlib.sha256(f"{source}\0{content}".encode()).hexdigest()
+
+
+def load_manifest():
     """
-    Initializes a vectorstore by loading in files in the data directory as documents,
-    chunking up those documents, and saving it as a Chroma vector database into local memory
+    Loads the manifest of ingested files. The manifest maps each file in the data directory to
+    the hash of its contents and the ids of the chunks it was split into.
     """
-    documents = load_data(settings.DATA_DIR)
-    docs_list = [item for sublist in documents for item in sublist]
+    if not os.path.exists(MANIFEST_FILE):
+        return None
+    with open(MANIFEST_FILE) as f:
+        return json.load(f)
 
-    text_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
-        chunk_size=250, chunk_overlap=0
-    )
-    chunked_documents = text_splitter.split_documents(docs_list)
 
-    vectorstore = Chroma.from_documents(
-        documents=chunked_documents,
-        persist_directory=settings.PERSIST_DIR,
-        embedding=settings.EMBEDDING_MODEL,
-    )
+def save_manifest(manifest):
+    """Saves the manifest of ingested files"""
+    os.makedirs(settings.PERSIST_DIR, exist_ok=True)
+    with open(MANIFEST_FILE, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def corpus_version():
+    """Returns a hash identifying the set of chunks currently in the vectorstore"""
+    manifest = load_manifest() or {}
+    files = manifest.get("files", {})
+    digest = hashlib.sha256(json.dumps(manifest.get("chunking")).encode())
+    for source in sorted(files):
+        digest.update(f"{source}\0{files[source]['hash']}\0".encode())
+    return digest.hexdigest()
+
+
+def chunk_documents(documents, source):
+    """Chunks the documents loaded from a file, returning the chunks keyed by chunk id"""
+    chunks = {}
+    for document in get_text_splitter().split_documents(documents or []):
+        chunks.setdefault(chunk_id(source, document.page_content), document)
+    return chunks
+
+
+def sync_vectorstore(vectorstore):
+    """
+    Brings the vectorstore in line with the files in the data directory. Only files whose content hash
+    changed since the last sync are loaded and chunked, only chunks that are new are embedded, and the
+    chunks of changed or removed files that no longer exist are deleted.
+    """
+    manifest = load_manifest()
+    chunking = {"chunk_size": settings.CHUNK_SIZE, "chunk_overlap": settings.CHUNK_OVERLAP}
+    backend = settings.VECTOR_BACKEND
+    if (
+        manifest is None
+        or manifest.get("chunking") != chunking
+        or manifest.get("backend", "chroma") != backend
+    ):
+        # stored chunks have no manifest, were split differently or are in another backend,
+        # so they cannot be diffed
+        if stale_ids := vectorstore.get(include=[])["ids"]:
+            logger.info(f"Re-indexing vectorstore, dropping {len(stale_ids)} chunks")
+            vectorstore.delete(ids=stale_ids)
+        manifest = {"chunking": chunking, "backend": backend, "files": {}}
+
+    files = {
+        file_path.name: file_path
+        for file_path in Path(settings.DATA_DIR).iterdir()
+        if file_path.is_file() and file_path.suffix.lower() in loaders
+    }
+
+    added = deleted = 0
+    for source in list(manifest["files"]):
+        if source not in files:
+            logger.info(f"Removing deleted file from vectorstore: {source}")
+            ids = manifest["files"].pop(source)["chunks"]
+            if ids:
+                vectorstore.delete(ids=ids)
+            deleted += len(ids)
+
+    digests = {file_path: file_hash(file_path) for file_path in files.values()}
+    changed = [
+        file_path
+        for source, file_path in sorted(files.items())
+        if manifest["files"].get(source, {}).get("hash") != digests[file_path]
+    ]
+
+    # files are parsed in parallel and each one is chunked and indexed as soon as it is loaded
+    for file_path, documents in load_files(changed, digests):
+        source = file_path.name
+        entry = manifest["files"].get(source)
+        old_ids = set(entry["chunks"]) if entry else set()
+        chunks = chunk_documents(documents, source)
+        new_ids = [i for i in chunks if i not in old_ids]
+        stale_ids = [i for i in old_ids if i not in chunks]
+
+        if stale_ids:
+            vectorstore.delete(ids=stale_ids)
+        if new_ids:
+            vectorstore.add_documents([chunks[i] for i in new_ids], ids=new_ids)
+        logger.info(
+            f"Indexed {source}: {len(new_ids)} chunks added, {len(stale_ids)} removed"
+        )
+        added += len(new_ids)
+        deleted += len(stale_ids)
+
+        manifest["files"][source] = {"hash": digests[file_path], "chunks": list(chunks)}
+        # save after every file so an interrupted sync does not redo finished files
+        save_manifest(manifest)
+
+    save_manifest(manifest)
+    logger.info(f"Vectorstore in sync: {added} chunks added, {deleted} removed")
+
+    # the keyword index mirrors the vectorstore's chunks
+    chunk_ids = [i for entry in manifest["files"].values() for i in entry["chunks"]]
+    if get_bm25_index().reconcile(vectorstore, chunk_ids):
+        get_bm25_index().save()
     return vectorstore
 
 
-# If the vector database does not exist, initialize it
-if not os.path.exists(settings.PERSIST_DIR):
-    vectorstore = init_vectorstore()
-# otherwise load in the vector store from local memory (avoid ingesting documents on every run)
-else:
-    vectorstore = Chroma(
-        persist_directory=settings.PERSIST_DIR,
-        embedding_function=settings.EMBEDDING_MODEL,
-    )
+@singleton
+def get_bm25_index():
+    """Returns the shared BM25 keyword index over the vectorstore's chunks, loaded on first use"""
+    return BM25Index.load(BM25_FILE, k1=settings.BM25_K1, b=settings.BM25_B)
 
-retriever = vectorstore.as_retriever()
+
+@singleton
+def get_vectorstore():
+    """
+    Opens the vector database saved in local memory, creating it if it does not exist, and syncs it
+    with the files in the data directory so that new or changed files are ingested. VECTOR_BACKEND
+    selects Chroma or the in-process NumPy index. The vectorstore is opened on first use and shared
+    afterwards.
+    """
+    if settings.VECTOR_BACKEND == "numpy":
+        from database.numpy_store import NumpyVectorStore
+
+        vectorstore = NumpyVectorStore(
+            persist_directory=settings.NUMPY_INDEX_DIR,
+            embedding_function=settings.EMBEDDING_MODEL,
+            dtype=settings.NUMPY_INDEX_DTYPE,
+        )
+    elif settings.VECTOR_BACKEND == "chroma":
+        from langchain_community.vectorstores import Chroma
+
+        vectorstore = Chroma(
+            persist_directory=settings.PERSIST_DIR,
+            embedding_function=settings.EMBEDDING_MODEL,
+        )
+    else:
+        raise ValueError(f"unknown vector backend: {settings.VECTOR_BACKEND}")
+    return sync_vectorstore(vectorstore)
+
+
+@singleton
+def get_retriever():
+    """
+    Returns the shared retriever over the vectorstore. With HYBRID_RETRIEVAL set, vector search results
+    are fused with BM25 keyword search results so that exact terms such as CVE ids are not missed.
+    """
+    vectorstore = get_vectorstore()
+    if settings.HYBRID_RETRIEVAL:
+        return HybridRetriever(
+            vectorstore=vectorstore,
+            index=get_bm25_index(),
+            k=settings.RETRIEVER_K,
+            fetch_k=settings.RETRIEVER_FETCH_K,
+            rrf_k=settings.RRF_K,
+        )
+    return vectorstore.as_retriever(search_kwargs={"k": settings.RETRIEVER_K})
@@ -0,0 +1,145 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from config import settings
+from database.sqlite_cache import LastUsed, connect
+
+logger = logging.getLogger(__name__)
+
+
+class SemanticCache:
+    """
+    Caches accepted answers by the embedding of the question they answer. A question whose embedding
+    has a cosine similarity of at least threshold with a cached question gets the cached answer.
+    Entries expire after ttl seconds, the least recently used entries are evicted past max_entries,
+    and entries cached against a different version of the vectorstore corpus are ignored.
+    """
+
+    def __init__(self, embeddings, path, threshold=0.95, ttl=7 * 24 * 3600, max_entries=1000):
+        self.embeddings = embeddings
+        self.path = path
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        self._entries = None
+        self._matrix = None
+        self._ids = None
+        self._last_used = LastUsed("answers", key_column="id")
+
+    @property
+    def conn(self):
+        """Opens the cache database on first use"""
+        if self._conn is None:
+            self._conn = connect(self.path)
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS answers (
+                    id INTEGER PRIMARY KEY,
+                    question TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    answer TEXT NOT NULL,
+                    corpus TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )"""
+            )
+        return self._conn
+
+    @property
+    def entries(self):
+        """Loads the cached entries into memory on first use, least recently used first"""
+        if self._entries is None:
+            rows = self.conn.execute(
+                "SELECT id, vector, answer, corpus, created FROM answers ORDER BY last_used"
+            )
+            self._entries = OrderedDict(
+                (row_id, (np.frombuffer(vector, dtype=np.float32), answer, corpus, created))
+                for row_id, vector, answer, corpus, created in rows
+            )
+        return self._entries
+
+    def embed(self, question):
+        """Embeds a question as a unit vector"""
+        vector = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def get(self, question, corpus):
+        """Returns the cached answer to the most similar cached question, if it is similar enough"""
+        vector = self.embed(question)
+        with self._lock:
+            self.expire(corpus)
+            if not self.entries:
+                self.misses += 1
+                return None
+
+            if self._matrix is None:
+                self._ids = list(self.entries)
+                self._matrix = np.stack([entry[0] for entry in self.entries.values()])
+            similarities = self._matrix @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+
+            row_id = self._ids[best]
+            self.entries.move_to_end(row_id)
+            self._last_used.touch(self.conn, [row_id])
+            self.hits += 1
+            logger.info(f"answer cache hit (similarity {similarities[best]:.3f})")
+            return self.entries[row_id][1]
+
+    def put(self, question, answer, corpus):
+        """Caches an accepted answer to a question"""
+        vector = self.embed(question)
+        now = time.time()
+        with self._lock:
+            self._last_used.flush(self.conn)
+            cursor = self.conn.execute(
+                """INSERT INTO answers (question, vector, answer, corpus, created, last_used)
+                VALUES (?, ?, ?, ?, ?, ?)""",
+                (question, vector.tobytes(), answer, corpus, now, now),
+            )
+            self.entries[cursor.lastrowid] = (vector, answer, corpus, now)
+            while len(self.entries) > self.max_entries:
+                row_id, _ = self.entries.popitem(last=False)
+                self.conn.execute("DELETE FROM answers WHERE id = ?", (row_id,))
+            self.conn.commit()
+            self._matrix = None
+
+    def expire(self, corpus):
+        """Drops entries that are past their ttl or were cached against a different corpus"""
+        cutoff = time.time() - self.ttl
+        stale = [
+            row_id
+            for row_id, (_, _, entry_corpus, created) in self.entries.items()
+            if created < cutoff or entry_corpus != corpus
+        ]
+        if not stale:
+            return
+        logger.debug(f"expiring {len(stale)} cached answers")
+        for row_id in stale:
+            del self.entries[row_id]
+        self.conn.executemany("DELETE FROM answers WHERE id = ?", [(i,) for i in stale])
+        self.conn.commit()
+        self._matrix = None
+
+    def stats(self):
+        """Returns the cache's hit and miss counters"""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries or ())}
+
+
+answer_cache = SemanticCache(
+    embeddings=settings.EMBEDDING_MODEL,
+    path=settings.ANSWER_CACHE_FILE,
+    threshold=settings.ANSWER_CACHE_THRESHOLD,
+    ttl=settings.ANSWER_CACHE_TTL,
+    max_entries=settings.ANSWER_CACHE_SIZE,
+)
@@ -1,14 +1,12 @@
 import logging
-from config import settings
+from llm.client import get_chain, get_llm
+from llm.cache import llm_cache
 
-from langchain_community.chat_models import ChatOllama
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import JsonOutputParser
 
 logger = logging.getLogger(__name__)
 
-llm = ChatOllama(model=settings.LLM_MODEL, format="json", temperature=0)
-
 prompt = PromptTemplate(
     template="""<|begin_of_text|><|start_header_id|>system<|end_header_id|> You are a grader assessing whether an 
     answer is useful to resolve a question. Give a binary score 'yes' or 'no' to indicate whether the answer is 
@@ -22,12 +20,26 @@ prompt = PromptTemplate(
 )
 
 
-def grade_answer(question, generation, llm=llm, prompt=prompt):
+def grade_answer(question, generation, llm=None, prompt=prompt):
     """
     Grades whether the answer generated answers the question asked by the user.
     Returns "yes" if the answer is relevant to the question and "no" otherwise.
     """
-    answer_grader = prompt | llm | JsonOutputParser()
-    score = answer_grader.invoke({"question": question, "generation": generation})
+    llm = llm or get_llm(json_mode=True)
+    answer_grader = get_chain(prompt, llm, JsonOutputParser)
+    score = llm_cache.invoke(
+        answer_grader, {"question": question, "generation": generation}, llm, prompt
+    )
+    logger.debug(score)
+    return score["score"]
+
+
+async def agrade_answer(question, generation, llm=None, prompt=prompt):
+    """Async version of grade_answer"""
+    llm = llm or get_llm(json_mode=True)
+    answer_grader = get_chain(prompt, llm, JsonOutputParser)
+    score = await llm_cache.ainvoke(
+        answer_grader, {"question": question, "generation": generation}, llm, prompt
+    )
     logger.debug(score)
     return score["score"]
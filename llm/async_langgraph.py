@@ -0,0 +1,194 @@
+import logging
+
+from database.vectorstore import get_retriever
+
+from llm.retrieval_grader import agrade_retrievals, agrade_retrievals_in_one_call
+from llm.rag import agenerate_response
+from llm.hallucination_grader import agrade_hallucination
+from llm.answer_grader import agrade_answer
+from llm.router import aroute, afast_route
+from llm.fanout import asplit_question
+from llm.langgraph import (
+    build_workflow,
+    build_email_workflow,
+    sub_question_inputs,
+    sub_answer,
+    merge_answers,
+    filter_documents,
+    add_web_results,
+    routed,
+    speculate_web_search,
+    record_grade,
+    generated,
+)
+
+from config import settings, singleton
+from llm.tools import search_cache
+
+logger = logging.getLogger(__name__)
+
+
+async def aretrieve_documents(state, question):
+    """
+    Async version of retrieve_documents
+    """
+    retrievals = state.get("retrievals") or {}
+    if question not in retrievals:
+        documents = await get_retriever().ainvoke(question)
+        retrievals = {**retrievals, question: documents}
+    return retrievals[question], retrievals
+
+
+async def retrieve(state):
+    """
+    Retrieve documents from vectorstore and add documents to graph state
+    """
+    logger.info("---RETRIEVING DOCUMENTS---")
+    question = state["question"]
+
+    documents, retrievals = await aretrieve_documents(state, question)
+    return {"documents": list(documents), "question": question, "retrievals": retrievals}
+
+
+async def generate(state):
+    """
+    Generate answer using RAG on the graded documents in graph state and add generation to graph state
+    """
+    logger.info("---GENERATING RESPONSE---")
+    generation = await agenerate_response(
+        question=state["question"], documents=state["documents"]
+    )
+    return generated(state, generation)
+
+
+async def grade_documents(state):
+    """
+    Determines whether the retrieved documents are relevant to the question, grading the documents
+    concurrently or, if GRADE_DOCUMENTS_IN_ONE_CALL is set, all in a single LLM call
+    If any document is not relevant, set a flag to run web search
+    """
+    logger.info("---CHECKING DOCUMENT RELEVANCE TO QUESTION---")
+    question = state["question"]
+    contents = [d.page_content for d in state["documents"]]
+
+    grades = None
+    llm_calls = 0
+    if settings.GRADE_DOCUMENTS_IN_ONE_CALL:
+        llm_calls += 1
+        try:
+            grades = await agrade_retrievals_in_one_call(question=question, documents=contents)
+        except Exception as e:
+            logger.warning(f"grading documents in one call failed, grading each: {e}")
+    if grades is None:
+        llm_calls += len(contents)
+        grades = await agrade_retrievals(question=question, documents=contents)
+    return filter_documents(state, grades, llm_calls)
+
+
+async def web_search(state):
+    """
+    Web search based on the question and add results to documents of graph's current state
+    """
+    logger.info("---WEB SEARCH---")
+    docs = await search_cache.asearch(state["question"])
+    return add_web_results(state, docs)
+
+
+async def route_question(state):
+    """
+    Given the current graph state, route question to web search or RAG, like the sync route_question
+    """
+    logger.info("---ROUTE QUESTION---")
+    question = state["question"]
+    retrievals = state.get("retrievals") or {}
+    llm_calls = state.get("llm_calls", 0)
+
+    datasource = None
+    if settings.FAST_ROUTER:
+        datasource, documents = await afast_route(question=question)
+        if not settings.HYBRID_RETRIEVAL:
+            retrievals = {**retrievals, question: documents}
+
+    if datasource is not None:
+        route_path = "embedding"
+    else:
+        source = await aroute(question=question)
+        datasource = source["datasource"]
+        route_path = "llm"
+        llm_calls += 1
+    speculate_web_search(question, datasource, route_path)
+    return routed(question, datasource, route_path, retrievals, llm_calls)
+
+
+async def grade_generation(state):
+    """
+    Grades whether the generation is grounded in the document and answers question,
+    and keeps track of the best graded generation of the run
+    """
+    logger.info("---CHECK HALLUCINATIONS---")
+    generation = state["generation"]
+    llm_calls = state.get("llm_calls", 0) + 1
+
+    grade = await agrade_hallucination(documents=state["documents"], generation=generation)
+
+    if grade == "yes":
+        logger.info("---DECISION: GENERATION IS GROUNDED IN DOCUMENTS---")
+        logger.info("---GRADE GENERATION vs QUESTION---")
+        llm_calls += 1
+        grade = await agrade_answer(question=state["question"], generation=generation)
+        if grade == "yes":
+            logger.info("---DECISION: GENERATION ADDRESSES QUESTION---")
+            generation_grade = "useful"
+        else:
+            logger.info("---DECISION: GENERATION DOES NOT ADDRESS QUESTION---")
+            generation_grade = "not useful"
+    else:
+        logger.info("---DECISION: GENERATION IS NOT GROUNDED IN DOCUMENTS, RE-TRY---")
+        generation_grade = "not supported"
+    return record_grade(state, generation_grade, llm_calls)
+
+
+async_workflow = build_workflow(
+    route_question=route_question,
+    web_search=web_search,
+    retrieve=retrieve,
+    grade_documents=grade_documents,
+    generate=generate,
+    grade_generation=grade_generation,
+)
+
+
+# == FAN OUT OVER THE QUESTIONS OF AN EMAIL == #
+@singleton
+def get_async_question_graph():
+    """Compiles the graph answering a single question with async nodes on first use"""
+    return async_workflow.compile()
+
+
+async def split_email(state):
+    """
+    Async version of split_email
+    """
+    logger.info("---SPLIT QUESTION---")
+    questions, llm_calls = await asplit_question(state["question"])
+    if len(questions) > 1:
+        logger.info(f"---SPLIT INTO {len(questions)} QUESTIONS---")
+    return {"questions": questions, "llm_calls": state.get("llm_calls", 0) + llm_calls}
+
+
+async def answer_sub_question(state):
+    """
+    Async version of answer_sub_question
+    """
+    inputs = sub_question_inputs(state)
+    result = None
+    async for result in get_async_question_graph().astream(inputs, stream_mode="values"):
+        pass
+    return sub_answer(state["question"], result)
+
+
+async_email_workflow = build_email_workflow(
+    split_email=split_email,
+    answer_sub_question=answer_sub_question,
+    merge_answers=merge_answers,
+)
@@ -0,0 +1,146 @@
+import json
+import time
+import hashlib
+import logging
+import threading
+
+from config import settings
+from database.sqlite_cache import LastUsed, connect
+
+logger = logging.getLogger(__name__)
+
+
+class LLMCache:
+    """
+    Persistent exact-match cache for deterministic LLM chains, shared by the router and graders.
+    Results are keyed by the model, its sampling parameters, the prompt template and the chain's
+    inputs, and the least recently used results are evicted past max_entries.
+    """
+
+    def __init__(self, path, max_entries=100_000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        self._last_used = LastUsed("llm_results")
+
+    @property
+    def conn(self):
+        """Opens the cache database on first use"""
+        if self._conn is None:
+            self._conn = connect(self.path)
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS llm_results (
+                    key TEXT PRIMARY KEY,
+                    result TEXT NOT NULL,
+                    last_used REAL NOT NULL
+                )"""
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS llm_results_last_used ON llm_results (last_used)"
+            )
+        return self._conn
+
+    @staticmethod
+    def key(llm, prompt, inputs):
+        """Returns the cache key of a chain invocation"""
+        model = {
+            "class": type(llm).__name__,
+            "model": getattr(llm, "model", None),
+            "format": getattr(llm, "format", None),
+            "temperature": getattr(llm, "temperature", None),
+        }
+        payload = json.dumps(
+            [model, prompt.template, inputs], sort_keys=True, default=str
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def invoke(self, chain, inputs, llm, prompt):
+        """Invokes a chain built from the llm and prompt, returning the cached result if there is one"""
+        return self.batch(chain, [inputs], llm, prompt)[0]
+
+    def batch(self, chain, inputs, llm, prompt, config=None):
+        """Invokes a chain on each of the inputs, only sending the inputs without a cached result to the LLM"""
+        keys, results, missing = self.partition(inputs, llm, prompt)
+        if missing:
+            computed = chain.batch(list(missing.values()), config=config)
+            self.complete(results, dict(zip(missing, computed)))
+        return [results[key] for key in keys]
+
+    async def ainvoke(self, chain, inputs, llm, prompt):
+        """Async version of invoke"""
+        return (await self.abatch(chain, [inputs], llm, prompt))[0]
+
+    async def abatch(self, chain, inputs, llm, prompt, config=None):
+        """Async version of batch"""
+        keys, results, missing = self.partition(inputs, llm, prompt)
+        if missing:
+            computed = await chain.abatch(list(missing.values()), config=config)
+            self.complete(results, dict(zip(missing, computed)))
+        return [results[key] for key in keys]
+
+    def partition(self, inputs, llm, prompt):
+        """
+        Looks up the cached results of the inputs, returning the inputs' keys, the cached results
+        and the distinct inputs without a cached result, keyed by cache key
+        """
+        keys = [self.key(llm, prompt, item) for item in inputs]
+        results = self.lookup(keys)
+
+        # identical inputs are only sent to the LLM once
+        missing = {}
+        for key, item in zip(keys, inputs):
+            if key not in results:
+                missing.setdefault(key, item)
+        with self._lock:
+            self.hits += len(inputs) - len(missing)
+            self.misses += len(missing)
+        return keys, results, missing
+
+    def complete(self, results, computed):
+        """Caches newly computed results and adds them to the results being returned"""
+        self.store(computed)
+        results.update(computed)
+
+    def lookup(self, keys):
+        """Returns the cached results of the given keys and marks them as recently used"""
+        results = {}
+        with self._lock:
+            for key in set(keys):
+                row = self.conn.execute(
+                    "SELECT result FROM llm_results WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    results[key] = json.loads(row[0])
+            self._last_used.touch(self.conn, results)
+        return results
+
+    def store(self, results):
+        """Caches the given results, evicting the least recently used ones if the cache is full"""
+        now = time.time()
+        with self._lock:
+            self._last_used.flush(self.conn)
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO llm_results (key, result, last_used) VALUES (?, ?, ?)",
+                [(key, json.dumps(result), now) for key, result in results.items()],
+            )
+            (count,) = self.conn.execute("SELECT COUNT(*) FROM llm_results").fetchone()
+            if count > self.max_entries:
+                logger.debug(f"evicting {count - self.max_entries} cached llm results")
+                self.conn.execute(
+                    """DELETE FROM llm_results WHERE key IN (
+                        SELECT key FROM llm_results ORDER BY last_used LIMIT ?
+                    )""",
+                    (count - self.max_entries,),
+                )
+            self.conn.commit()
+
+    def stats(self):
+        """Returns the cache's hit and miss counters"""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+llm_cache = LLMCache(path=settings.LLM_CACHE_FILE, max_entries=settings.LLM_CACHE_SIZE)
@@ -0,0 +1,207 @@
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+
+from config import settings
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+_clients = {}
+_chains = {}
+_lock = threading.Lock()
+
+
+class ConcurrencyLimiter:
+    """
+    Limits how many requests are sent to Ollama at once, across threads and event loops. Requests over
+    the limit queue in arrival order, and the time they spend queued is recorded.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.acquired = 0
+        self.queued = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        """Takes a slot if one is free and nobody is queued, otherwise returns False"""
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            self.acquired += 1
+            return True
+        return False
+
+    def acquire(self):
+        """Takes a slot, waiting in the queue while none is free"""
+        with self._lock:
+            if self.try_acquire():
+                return
+            event = threading.Event()
+            self._waiters.append(event)
+            self.queued += 1
+        start = time.perf_counter()
+        with span("llm_queue"):
+            event.wait()
+        self.waited(time.perf_counter() - start)
+
+    async def aacquire(self):
+        """Async version of acquire, which waits without blocking the event loop"""
+        with self._lock:
+            if self.try_acquire():
+                return
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            waiter = (loop, future)
+            self._waiters.append(waiter)
+            self.queued += 1
+        start = time.perf_counter()
+        try:
+            with span("llm_queue"):
+                await future
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    raise
+            # the slot was already handed over, pass it on
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        self.waited(time.perf_counter() - start)
+
+    def release(self):
+        """Frees a slot, handing it over to the first queued request if there is one"""
+        with self._lock:
+            if not self._waiters:
+                self.active -= 1
+                return
+            waiter = self._waiters.popleft()
+            self.acquired += 1
+        if isinstance(waiter, threading.Event):
+            waiter.set()
+        else:
+            loop, future = waiter
+            loop.call_soon_threadsafe(self.wake, future)
+
+    def wake(self, future):
+        if future.cancelled():
+            self.release()
+        else:
+            future.set_result(None)
+
+    def waited(self, seconds):
+        with self._lock:
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+    def stats(self):
+        """Returns the limiter's queueing counters"""
+        with self._lock:
+            return {
+                "limit": self.limit,
+                "active": self.active,
+                "waiting": len(self._waiters),
+                "acquired": self.acquired,
+                "queued": self.queued,
+                "wait_seconds": self.wait_seconds,
+                "max_wait_seconds": self.max_wait_seconds,
+            }
+
+
+limiter = ConcurrencyLimiter(settings.LLM_CONCURRENCY)
+
+
+def create_llm(json_mode):
+    """
+    Creates a ChatOllama client whose requests hold a slot of the shared concurrency limiter. Each client
+    keeps a pool of HTTP connections to Ollama that all of its requests reuse.
+    """
+    from langchain_ollama import ChatOllama
+
+    class PooledChatOllama(ChatOllama):
+        def _generate(self, *args, **kwargs):
+            limiter.acquire()
+            try:
+                return super()._generate(*args, **kwargs)
+            finally:
+                limiter.release()
+
+        async def _agenerate(self, *args, **kwargs):
+            await limiter.aacquire()
+            try:
+                return await super()._agenerate(*args, **kwargs)
+            finally:
+                limiter.release()
+
+        def _stream(self, *args, **kwargs):
+            limiter.acquire()
+            try:
+                yield from super()._stream(*args, **kwargs)
+            finally:
+                limiter.release()
+
+        async def _astream(self, *args, **kwargs):
+            await limiter.aacquire()
+            try:
+                async for chunk in super()._astream(*args, **kwargs):
+                    yield chunk
+            finally:
+                limiter.release()
+
+    kwargs = {"format": "json"} if json_mode else {}
+    return PooledChatOllama(
+        model=settings.LLM_MODEL,
+        base_url=settings.OLLAMA_BASE_URL,
+        keep_alive=settings.LLM_KEEP_ALIVE,
+        temperature=0,
+        **kwargs,
+    )
+
+
+def get_llm(json_mode=False):
+    """
+    Returns the ChatOllama client shared by the llm modules, created on first use. JSON mode clients,
+    used by the router and graders, constrain the model to reply with JSON.
+    """
+    if json_mode not in _clients:
+        with _lock:
+            if json_mode not in _clients:
+                _clients[json_mode] = create_llm(json_mode)
+    return _clients[json_mode]
+
+
+def get_chain(prompt, llm, parser):
+    """Returns the prompt | llm | parser chain, built on first use and reused afterwards"""
+    key = (id(prompt), id(llm), parser)
+    if key not in _chains:
+        with _lock:
+            if key not in _chains:
+                # the prompt and llm are kept alive with the chain so their ids are not reused
+                _chains[key] = (prompt, llm, prompt | llm | parser())
+    return _chains[key][2]
+
+
+def warm_up():
+    """
+    Loads the model into Ollama's memory and keeps it resident for LLM_KEEP_ALIVE, so the first email
+    does not pay for loading it. Failures are logged, the model then loads on the first request.
+    """
+    from ollama import Client
+
+    start = time.perf_counter()
+    try:
+        Client(host=settings.OLLAMA_BASE_URL).generate(
+            model=settings.LLM_MODEL, prompt="", keep_alive=settings.LLM_KEEP_ALIVE
+        )
+    except Exception as e:
+        logger.warning(f"failed to warm up {settings.LLM_MODEL}: {e}")
+        return False
+    logger.info(f"warmed up {settings.LLM_MODEL} in {time.perf_counter() - start:.2f}s")
+    return True
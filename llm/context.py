@@ -0,0 +1,67 @@
+import re
+import logging
+
+from config import settings
+from database.vectorstore import get_encoder
+
+logger = logging.getLogger(__name__)
+
+SEPARATOR = "\n\n"
+# a passage cut to fit the budget is only kept if this many of its tokens fit
+MIN_PARTIAL_TOKENS = 32
+# shortest repeated text treated as overlap between the end of one chunk and the start of the next
+MIN_OVERLAP_CHARS = 20
+NOISE_LINE = re.compile(r"^[\W\d_]*$")
+
+
+def clean_text(text):
+    """Collapses runs of whitespace and drops lines that are only page numbers or punctuation"""
+    lines = (" ".join(line.split()) for line in text.splitlines())
+    return "\n".join(line for line in lines if not NOISE_LINE.match(line))
+
+
+def strip_overlap(text, passages):
+    """Removes the start of text that repeats the end of one of the passages already packed"""
+    head = text[:MIN_OVERLAP_CHARS]
+    if len(head) < MIN_OVERLAP_CHARS:
+        return text
+    longest = 0
+    for passage in passages:
+        start = passage.find(head)
+        while start != -1:
+            if text.startswith(passage[start:]):
+                longest = max(longest, len(passage) - start)
+                break
+            start = passage.find(head, start + 1)
+    return text[longest:].lstrip()
+
+
+def build_context(documents, max_tokens=settings.CONTEXT_MAX_TOKENS):
+    """
+    Packs the content of documents, which are ordered best first, into a context of at most max_tokens
+    tokens. Only page contents are included, cleaned of whitespace and page number noise, and chunks
+    that repeat text already packed are dropped or trimmed. The passage that crosses the budget is cut
+    at a token boundary and the documents after it are left out.
+    """
+    encoder = get_encoder()
+    separator_tokens = len(encoder.encode(SEPARATOR))
+    passages = []
+    used = 0
+    for document in documents:
+        text = getattr(document, "page_content", document)
+        text = strip_overlap(clean_text(str(text)), passages)
+        if not text or any(text in passage for passage in passages):
+            continue
+
+        tokens = encoder.encode(text)
+        remaining = max_tokens - used - (separator_tokens if passages else 0)
+        if len(tokens) > remaining:
+            if remaining >= MIN_PARTIAL_TOKENS:
+                passages.append(encoder.decode(tokens[:remaining]))
+                used += remaining
+            logger.debug(f"context truncated at {max_tokens} tokens")
+            break
+        passages.append(text)
+        used += len(tokens) + (separator_tokens if len(passages) > 1 else 0)
+
+    return SEPARATOR.join(passages)
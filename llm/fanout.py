@@ -0,0 +1,105 @@
+import re
+import logging
+from config import settings
+from llm.client import get_chain, get_llm
+from llm.cache import llm_cache
+from services.distill import GREETING, strip_signature
+
+from langchain_core.prompts import PromptTemplate
+from langchain_core.output_parsers import JsonOutputParser
+
+logger = logging.getLogger(__name__)
+
+prompt = PromptTemplate(
+    template="""<|begin_of_text|><|start_header_id|>system<|end_header_id|> You split a customer email into the
+    separate, unrelated questions it asks. Questions about the same topic, or follow-ups to another question, are one
+    question. Rewrite each question so it can be answered on its own, keeping the details it needs from the email.
+    Provide the questions as a JSON with a single key 'questions' holding a list of strings, and no premable or
+    explanation. <|eot_id|><|start_header_id|>user<|end_header_id|>
+    Here is the email: {question} <|eot_id|><|start_header_id|>assistant<|end_header_id|>""",
+    input_variables=["question"],
+)
+
+QUESTION_SENTENCE = re.compile(r"[^.!?\n]*\?")
+# the body of a sub-question's section in a merged reply when it has no grounded answer
+UNANSWERED = "I could not find a reliable answer to this question in the available information."
+
+
+def count_questions(question):
+    """Returns the number of sentences in the question that end in a question mark"""
+    return len(QUESTION_SENTENCE.findall(question))
+
+
+def split_question(question, llm=None, prompt=prompt, max_questions=settings.MAX_SUB_QUESTIONS):
+    """
+    Splits an email that asks several unrelated questions into standalone sub-questions. Emails asking
+    fewer than two questions are not sent to the LLM. Returns the sub-questions and the number of LLM calls
+    made, falling back to the whole email as the only question if the LLM's reply is not usable.
+    """
+    if count_questions(question) < 2:
+        return [question], 0
+    llm = llm or get_llm(json_mode=True)
+    splitter = get_chain(prompt, llm, JsonOutputParser)
+    try:
+        result = llm_cache.invoke(splitter, {"question": question}, llm, prompt)
+        return check_questions(result, question, max_questions), 1
+    except Exception as e:
+        logger.warning(f"splitting the question failed, answering it whole: {e}")
+        return [question], 1
+
+
+async def asplit_question(
+    question, llm=None, prompt=prompt, max_questions=settings.MAX_SUB_QUESTIONS
+):
+    """Async version of split_question"""
+    if count_questions(question) < 2:
+        return [question], 0
+    llm = llm or get_llm(json_mode=True)
+    splitter = get_chain(prompt, llm, JsonOutputParser)
+    try:
+        result = await llm_cache.ainvoke(splitter, {"question": question}, llm, prompt)
+        return check_questions(result, question, max_questions), 1
+    except Exception as e:
+        logger.warning(f"splitting the question failed, answering it whole: {e}")
+        return [question], 1
+
+
+def check_questions(result, question, max_questions):
+    """
+    Returns the sub-questions in the splitter's reply, raising a ValueError unless it is a list of
+    strings. More than max_questions sub-questions are not split, the email is answered whole.
+    """
+    logger.debug(result)
+    questions = result.get("questions") if isinstance(result, dict) else None
+    if not isinstance(questions, list) or not all(isinstance(q, str) for q in questions):
+        raise ValueError(f"expected a list of questions, got {result}")
+    questions = list(dict.fromkeys(q.strip() for q in questions if q.strip()))
+    if not questions or len(questions) > max_questions:
+        return [question]
+    return questions
+
+
+def answer_body(generation):
+    """Returns the body of an email formatted answer, without its greeting and sign-off"""
+    lines = generation.strip().splitlines()
+    if lines and GREETING.match(lines[0].strip()):
+        lines = lines[1:]
+    return "\n".join(strip_signature(lines)).strip()
+
+
+def compose_reply(answers):
+    """
+    Merges the answers to the sub-questions of an email into one reply, in the order the questions were
+    asked. A single answer is returned as generated.
+    """
+    if len(answers) == 1:
+        return answers[0]["generation"]
+
+    sections = []
+    for i, answer in enumerate(answers, start=1):
+        if answer.get("grade") == "not supported" or not answer.get("generation"):
+            body = UNANSWERED
+        else:
+            body = answer_body(answer["generation"])
+        sections.append(f"{i}. {answer['question']}\n\n{body}")
+    return "Hi,\n\n" + "\n\n".join(sections) + "\n\nBest regards"
@@ -1,14 +1,13 @@
 import logging
-from config import settings
+from llm.client import get_chain, get_llm
+from llm.cache import llm_cache
+from llm.context import build_context
 
-from langchain_community.chat_models import ChatOllama
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import JsonOutputParser
 
 logger = logging.getLogger(__name__)
 
-llm = ChatOllama(model=settings.LLM_MODEL, format="json", temperature=0)
-
 prompt = PromptTemplate(
     template=""" <|begin_of_text|><|start_header_id|>system<|end_header_id|> You are a grader assessing whether 
     an answer is grounded in / supported by a set of facts. Give a binary 'yes' or 'no' score to indicate 
@@ -23,14 +22,32 @@ prompt = PromptTemplate(
 )
 
 
-def grade_hallucination(documents, generation, llm=llm, prompt=prompt):
+def grade_hallucination(documents, generation, llm=None, prompt=prompt):
     """
     Grades whether the answer generated is grounded in the documents or facts found.
     Returns "yes" if the answer is derived from a source of truth and "no" if it is a hallucination.
     """
-    hallucination_grader = prompt | llm | JsonOutputParser()
-    score = hallucination_grader.invoke(
-        {"documents": documents, "generation": generation}
+    llm = llm or get_llm(json_mode=True)
+    hallucination_grader = get_chain(prompt, llm, JsonOutputParser)
+    score = llm_cache.invoke(
+        hallucination_grader,
+        {"documents": build_context(documents), "generation": generation},
+        llm,
+        prompt,
+    )
+    logger.debug(score)
+    return score["score"]
+
+
+async def agrade_hallucination(documents, generation, llm=None, prompt=prompt):
+    """Async version of grade_hallucination"""
+    llm = llm or get_llm(json_mode=True)
+    hallucination_grader = get_chain(prompt, llm, JsonOutputParser)
+    score = await llm_cache.ainvoke(
+        hallucination_grader,
+        {"documents": build_context(documents), "generation": generation},
+        llm,
+        prompt,
     )
     logger.debug(score)
     return score["score"]
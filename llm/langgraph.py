@@ -1,20 +1,24 @@
+import time
 import logging
-from typing import List
+import operator
+from typing import Annotated, Dict, List
 from typing_extensions import TypedDict
 
 from langgraph.graph import END, StateGraph
+from langgraph.types import Send
 from langchain_core.documents import Document
 
-from database.vectorstore import retriever
+from database.vectorstore import get_retriever
 
-from llm.retrieval_grader import grade_retrieval
+from llm.retrieval_grader import grade_retrievals, grade_retrievals_in_one_call
 from llm.rag import generate_response
 from llm.hallucination_grader import grade_hallucination
 from llm.answer_grader import grade_answer
-from llm.router import route
+from llm.router import route, fast_route
+from llm.fanout import split_question, compose_reply
 
-from config import setup_logging
-from llm.tools import web_search_tool
+from config import settings, setup_logging, singleton
+from llm.tools import search_cache
 
 setup_logging("langgraph_svc")
 logger = logging.getLogger(__name__)
@@ -27,12 +31,101 @@ class GraphState(TypedDict):
     - generation: the response generated by the LLM
     - web_search: whether to use the search tool
     - documents: list of documents retrieved by the rag application
+    - retrievals: memo of the documents retrieved for each question during the run, shared by all nodes
+    - datasource: where the question was routed to ("vectorstore" or "web_search")
+    - route_path: what decided the route ("embedding" or "llm")
+    - generation_grade: the grade of the latest generation ("useful", "not useful" or "not supported")
+    - best_generation: the best graded generation so far, answered if the run's budget runs out
+    - best_grade: the grade of the best generation so far
+    - generations: number of generations made during the run
+    - web_searches: number of web searches made during the run
+    - llm_calls: number of LLM calls made during the run
+    - max_llm_calls: how many LLM calls the run may make, its share of MAX_LLM_CALLS for a sub-question
+    - deadline: wall clock time (epoch seconds) by which the run should finish
     """
 
     question: str
     generation: str
     web_search: str
     documents: List[str]
+    retrievals: Dict[str, List[Document]]
+    datasource: str
+    route_path: str
+    generation_grade: str
+    best_generation: str
+    best_grade: str
+    generations: int
+    web_searches: int
+    llm_calls: int
+    max_llm_calls: int
+    deadline: float
+
+
+class EmailState(TypedDict):
+    """
+    Represents the state of the graph answering a whole email, which runs the question graph for each
+    of the email's questions in parallel:
+    - question: the question asked by the email
+    - questions: the standalone sub-questions the email was split into
+    - answers: the outcome of each sub-question's run, added as the runs finish
+    - generation: the reply merged from the answers
+    - generation_grade: the lowest grade of the answers
+    - datasource, route_path: where each sub-question was routed to and what decided it, joined by "+"
+    - generations, web_searches, llm_calls: totals over the email's runs
+    - max_llm_calls: the LLM call budget of a sub-question's run, in the states sent to its run
+    - deadline: wall clock time (epoch seconds) by which every run should finish
+    """
+
+    question: str
+    questions: List[str]
+    answers: Annotated[List[dict], operator.add]
+    generation: str
+    generation_grade: str
+    datasource: str
+    route_path: str
+    generations: int
+    web_searches: int
+    llm_calls: int
+    max_llm_calls: int
+    deadline: float
+
+
+GRADE_RANKS = {"not supported": 0, "not useful": 1, "useful": 2}
+
+
+def initial_state(question):
+    """Returns the input state of a run, with the run's budgets reset"""
+    return {
+        "question": question,
+        "generations": 0,
+        "web_searches": 0,
+        "llm_calls": 0,
+        "max_llm_calls": settings.MAX_LLM_CALLS,
+        "deadline": time.time() + settings.RUN_TIMEOUT,
+    }
+
+
+def budget_exhausted(state):
+    """Returns why the run's retry, LLM call or wall clock budget ran out, or None if it has not"""
+    if state.get("generations", 0) >= settings.MAX_GENERATIONS:
+        return f"reached {settings.MAX_GENERATIONS} generations"
+    max_llm_calls = state.get("max_llm_calls", settings.MAX_LLM_CALLS)
+    if state.get("llm_calls", 0) >= max_llm_calls:
+        return f"reached {max_llm_calls} llm calls"
+    if time.time() >= state.get("deadline", float("inf")):
+        return f"exceeded {settings.RUN_TIMEOUT}s deadline"
+    return None
+
+
+def retrieve_documents(state, question):
+    """
+    Returns the documents retrieved for the question from the run's retrieval memo, only querying
+    the vectorstore on a miss, along with the updated memo
+    """
+    retrievals = state.get("retrievals") or {}
+    if question not in retrievals:
+        retrievals = {**retrievals, question: get_retriever().invoke(question)}
+    return retrievals[question], retrievals
 
 
 def retrieve(state):
@@ -42,25 +135,39 @@ def retrieve(state):
     logger.info("---RETRIEVING DOCUMENTS---")
     question = state["question"]
 
-    documents = retriever.invoke(question)
-    return {"documents": documents, "question": question}
+    documents, retrievals = retrieve_documents(state, question)
+    return {"documents": list(documents), "question": question, "retrievals": retrievals}
 
 
 def generate(state):
     """
-    Generate answer using RAG on retrieved documents and add generation to graph state
+    Generate answer using RAG on the graded documents in graph state and add generation to graph state
     """
     logger.info("---GENERATING RESPONSE---")
     question = state["question"]
     documents = state["documents"]
 
-    generation = generate_response(question=question)
-    return {"documents": documents, "question": question, "generation": generation}
+    generation = generate_response(question=question, documents=documents)
+    return generated(state, generation)
+
+
+def generated(state, generation):
+    """
+    Returns the graph state updates adding a new generation
+    """
+    return {
+        "documents": state["documents"],
+        "question": state["question"],
+        "generation": generation,
+        "generations": state.get("generations", 0) + 1,
+        "llm_calls": state.get("llm_calls", 0) + 1,
+    }
 
 
 def grade_documents(state):
     """
-    Determines whether the retrieved documents are relevant to the question
+    Determines whether the retrieved documents are relevant to the question, grading the documents
+    concurrently or, if GRADE_DOCUMENTS_IN_ONE_CALL is set, all in a single LLM call
     If any document is not relevant, set a flag to run web search
     """
 
@@ -68,17 +175,44 @@ def grade_documents(state):
     question = state["question"]
     documents = state["documents"]
 
+    contents = [d.page_content for d in documents]
+    grades = None
+    llm_calls = 0
+    if settings.GRADE_DOCUMENTS_IN_ONE_CALL:
+        llm_calls += 1
+        try:
+            grades = grade_retrievals_in_one_call(question=question, documents=contents)
+        except Exception as e:
+            logger.warning(f"grading documents in one call failed, grading each: {e}")
+    if grades is None:
+        llm_calls += len(contents)
+        grades = grade_retrievals(question=question, documents=contents)
+    return filter_documents(state, grades, llm_calls)
+
+
+def filter_documents(state, grades, llm_calls):
+    """
+    Keeps the documents graded as relevant, setting the web search flag if any document is not relevant.
+    llm_calls is the number of LLM calls the grading made, including a failed single call grading.
+    """
+    question = state["question"]
+    documents = state["documents"]
+
     filtered_docs = []
     web_search = "No"
-    for d in documents:
-        grade = grade_retrieval(question=question, document=d.page_content)
+    for d, grade in zip(documents, grades):
         if grade.lower() == "yes":
             logger.info("---GRADE: DOCUMENT RELEVANT---")
             filtered_docs.append(d)
         else:  # Document not relevant
             logger.info("---GRADE: DOCUMENT NOT RELEVANT---")
             web_search = "Yes"
-    return {"documents": filtered_docs, "question": question, "web_search": web_search}
+    return {
+        "documents": filtered_docs,
+        "question": question,
+        "web_search": web_search,
+        "llm_calls": state.get("llm_calls", 0) + llm_calls,
+    }
 
 
 def web_search(state):
@@ -86,34 +220,96 @@ def web_search(state):
     Web search based on the question and add results to documents of graph's current state
     """
     logger.info("---WEB SEARCH---")
+    docs = search_cache.search(state["question"])
+    return add_web_results(state, docs)
+
+
+def add_web_results(state, docs):
+    """
+    Merges web search results into a document and adds it to the documents of graph's current state
+    """
     question = state["question"]
-    documents = state["documents"]
+    # a question routed straight to web search has no documents yet
+    documents = state.get("documents") or []
 
-    docs = web_search_tool.invoke({"query": question})
     web_results = "\n".join([d["content"] for d in docs])
     web_results = Document(page_content=web_results)
-    if documents is not None:
-        documents.append(web_results)
-    else:
-        documents = [web_results]
-    return {"documents": documents, "question": question}
+    return {
+        "documents": [*documents, web_results],
+        "question": question,
+        "web_searches": state.get("web_searches", 0) + 1,
+    }
 
 
 def route_question(state):
     """
-    Given the current graph state, route question to web search or RAG.
-    Returns the next node to call.
+    Given the current graph state, route question to web search or RAG. The route is decided from the
+    question's similarity to the vectorstore when it is clear cut, and by the LLM router otherwise.
+    The chunks found while routing are added to the retrieval memo, unless retrieval is hybrid.
     """
     logger.info("---ROUTE QUESTION---")
     question = state["question"]
     logger.debug(f"Question: {question}")
-    source = route(question=question)
-    logger.debug(source)
+    retrievals = state.get("retrievals") or {}
+    llm_calls = state.get("llm_calls", 0)
+
+    datasource = None
+    if settings.FAST_ROUTER:
+        datasource, documents = fast_route(question=question)
+        # vector hits only stand in for retrieval when retrieval is not hybrid
+        if not settings.HYBRID_RETRIEVAL:
+            retrievals = {**retrievals, question: documents}
+
+    if datasource is not None:
+        route_path = "embedding"
+    else:
+        source = route(question=question)
+        logger.debug(source)
+        datasource = source["datasource"]
+        route_path = "llm"
+        llm_calls += 1
+    speculate_web_search(question, datasource, route_path)
+    return routed(question, datasource, route_path, retrievals, llm_calls)
+
+
+def speculate_web_search(question, datasource, route_path):
+    """
+    Prefetches the web search for a question routed to the vectorstore by the LLM because its
+    similarity to the vectorstore was ambiguous. Such questions are the likeliest to fall back to
+    web search after grading, which then finds the results cached or in flight. Results that are
+    not needed are only kept in the search cache.
+    """
+    if (
+        settings.SPECULATIVE_WEB_SEARCH
+        and settings.FAST_ROUTER
+        and datasource == "vectorstore"
+        and route_path == "llm"
+    ):
+        search_cache.prefetch(question)
+
+
+def routed(question, datasource, route_path, retrievals, llm_calls):
+    """
+    Returns the graph state updates recording how the question was routed
+    """
+    logger.info(f"---ROUTE DECIDED BY {route_path.upper()}---")
+    return {
+        "question": question,
+        "datasource": datasource,
+        "route_path": route_path,
+        "retrievals": retrievals,
+        "llm_calls": llm_calls,
+    }
+
 
-    if source["datasource"] == "web_search":
+def decide_route(state):
+    """
+    Given the routed datasource, returns the next node to call
+    """
+    if state["datasource"] == "web_search":
         logger.info("---ROUTE QUESTION TO WEB SEARCH---")
         return "websearch"
-    elif source["datasource"] == "vectorstore":
+    elif state["datasource"] == "vectorstore":
         logger.info("---ROUTE QUESTION TO RAG---")
         return "vectorstore"
 
@@ -140,65 +336,277 @@ def decide_to_generate(state):
 
 def grade_generation(state):
     """
-    Determines whether the generation is grounded in the document and answers question.
-    Returns decision for next node to call
+    Grades whether the generation is grounded in the document and answers question,
+    and keeps track of the best graded generation of the run
     """
 
     logger.info("---CHECK HALLUCINATIONS---")
     question = state["question"]
     documents = state["documents"]
     generation = state["generation"]
+    llm_calls = state.get("llm_calls", 0) + 1
 
     grade = grade_hallucination(documents=documents, generation=generation)
 
     if grade == "yes":
         logger.info("---DECISION: GENERATION IS GROUNDED IN DOCUMENTS---")
         logger.info("---GRADE GENERATION vs QUESTION---")
+        llm_calls += 1
         grade = grade_answer(question=question, generation=generation)
         if grade == "yes":
             logger.info("---DECISION: GENERATION ADDRESSES QUESTION---")
-            return "useful"
+            generation_grade = "useful"
         else:
             logger.info("---DECISION: GENERATION DOES NOT ADDRESS QUESTION---")
-            return "not useful"
+            generation_grade = "not useful"
     else:
         logger.info("---DECISION: GENERATION IS NOT GROUNDED IN DOCUMENTS, RE-TRY---")
-        return "not supported"
+        generation_grade = "not supported"
+    return record_grade(state, generation_grade, llm_calls)
 
 
-workflow = StateGraph(GraphState)
+def record_grade(state, generation_grade, llm_calls):
+    """
+    Records the grade of the latest generation, keeping it as the best generation if it is graded higher
+    """
+    generation = state["generation"]
+    updates = {"generation_grade": generation_grade, "llm_calls": llm_calls}
+    best_grade = state.get("best_grade")
+    if best_grade is None or GRADE_RANKS[generation_grade] > GRADE_RANKS[best_grade]:
+        updates.update(best_generation=generation, best_grade=generation_grade)
+    return updates
 
-# Define the nodes
-workflow.add_node("websearch", web_search)
-workflow.add_node("retrieve", retrieve)
-workflow.add_node("grade_documents", grade_documents)
-workflow.add_node("generate", generate)
 
-# Build graph
-workflow.set_conditional_entry_point(
-    route_question,
-    {
-        "websearch": "websearch",
-        "vectorstore": "retrieve",
-    },
-)
+def decide_after_grading(state):
+    """
+    Determines whether to finish with the generation, retry or add web search, finishing with the
+    best graded generation so far if the run's budget has run out.
+    Returns decision for next node to call
+    """
+    grade = state["generation_grade"]
+    if grade == "useful":
+        return "useful"
+
+    reason = budget_exhausted(state)
+    if reason is None and grade == "not useful":
+        if state.get("web_searches", 0) >= settings.MAX_WEB_SEARCHES:
+            reason = f"reached {settings.MAX_WEB_SEARCHES} web searches"
+    if reason is not None:
+        logger.warning(f"---DECISION: BUDGET EXHAUSTED ({reason}), USE BEST GENERATION---")
+        return "exhausted"
+    return grade
+
+
+def use_best_generation(state):
+    """
+    Finish the run with the best graded generation so far
+    """
+    best_grade = state["best_grade"]
+    logger.info(f"---ANSWER WITH BEST GENERATION (GRADE: {best_grade.upper()})---")
+    return {
+        "generation": state["best_generation"],
+        "generation_grade": best_grade,
+    }
+
 
-workflow.add_edge("retrieve", "grade_documents")
-workflow.add_conditional_edges(
-    "grade_documents",
-    decide_to_generate,
-    {
-        "websearch": "websearch",
-        "generate": "generate",
-    },
+def build_workflow(
+    route_question, web_search, retrieve, grade_documents, generate, grade_generation
+):
+    """
+    Builds the graph from the given node functions, so the same graph can run with sync or async nodes
+    """
+    workflow = StateGraph(GraphState)
+
+    # Define the nodes
+    workflow.add_node("route_question", route_question)
+    workflow.add_node("websearch", web_search)
+    workflow.add_node("retrieve", retrieve)
+    workflow.add_node("grade_documents", grade_documents)
+    workflow.add_node("generate", generate)
+    workflow.add_node("grade_generation", grade_generation)
+    workflow.add_node("use_best_generation", use_best_generation)
+
+    # Build graph
+    workflow.set_entry_point("route_question")
+    workflow.add_conditional_edges(
+        "route_question",
+        decide_route,
+        {
+            "websearch": "websearch",
+            "vectorstore": "retrieve",
+        },
+    )
+
+    workflow.add_edge("retrieve", "grade_documents")
+    workflow.add_conditional_edges(
+        "grade_documents",
+        decide_to_generate,
+        {
+            "websearch": "websearch",
+            "generate": "generate",
+        },
+    )
+    workflow.add_edge("websearch", "generate")
+    workflow.add_edge("generate", "grade_generation")
+    workflow.add_conditional_edges(
+        "grade_generation",
+        decide_after_grading,
+        {
+            "not supported": "generate",
+            "useful": END,
+            "not useful": "websearch",
+            "exhausted": "use_best_generation",
+        },
+    )
+    workflow.add_edge("use_best_generation", END)
+    return workflow
+
+
+workflow = build_workflow(
+    route_question=route_question,
+    web_search=web_search,
+    retrieve=retrieve,
+    grade_documents=grade_documents,
+    generate=generate,
+    grade_generation=grade_generation,
 )
-workflow.add_edge("websearch", "generate")
-workflow.add_conditional_edges(
-    "generate",
-    grade_generation,
-    {
-        "not supported": "generate",
-        "useful": END,
-        "not useful": "websearch",
-    },
+
+
+# == FAN OUT OVER THE QUESTIONS OF AN EMAIL == #
+@singleton
+def get_question_graph():
+    """Compiles the graph answering a single question on first use"""
+    return workflow.compile()
+
+
+def split_email(state):
+    """
+    Splits the email's question into standalone sub-questions if it asks several unrelated ones
+    """
+    logger.info("---SPLIT QUESTION---")
+    questions, llm_calls = split_question(state["question"])
+    if len(questions) > 1:
+        logger.info(f"---SPLIT INTO {len(questions)} QUESTIONS---")
+    return {"questions": questions, "llm_calls": state.get("llm_calls", 0) + llm_calls}
+
+
+def min_sub_question_llm_calls():
+    """
+    Returns the LLM calls a run needs to answer a question and retry once: routing, grading the
+    retrieved documents, and two generations each graded for grounding and usefulness
+    """
+    grading = 1 if settings.GRADE_DOCUMENTS_IN_ONE_CALL else settings.RETRIEVER_K
+    return 1 + grading + 2 * 3
+
+
+def fan_out(state):
+    """
+    Sends each sub-question to its own run of the question graph, all of which run in parallel. The LLM
+    calls the email has left are split evenly between the runs, but each run gets at least enough to
+    answer its question and retry once. MAX_LLM_CALLS is therefore a soft cap for an email asking
+    several questions, which may take up to MAX_SUB_QUESTIONS times that minimum. Like a single run's,
+    the budget is checked after grading a generation, so a run can overshoot it by one attempt.
+    """
+    questions = state["questions"]
+    remaining = max(0, settings.MAX_LLM_CALLS - state.get("llm_calls", 0))
+    share, extra = divmod(remaining, len(questions))
+    minimum = min_sub_question_llm_calls()
+    return [
+        Send(
+            "answer_sub_question",
+            {
+                "question": question,
+                "max_llm_calls": max(minimum, share + (1 if i < extra else 0)),
+                "deadline": state["deadline"],
+            },
+        )
+        for i, question in enumerate(questions)
+    ]
+
+
+def sub_question_inputs(state):
+    """Returns the input state of a sub-question's run, within the budget it was sent with"""
+    return {
+        **initial_state(state["question"]),
+        "max_llm_calls": state["max_llm_calls"],
+        "deadline": state["deadline"],
+    }
+
+
+def answer_sub_question(state):
+    """
+    Answers one sub-question by streaming it through the question graph
+    """
+    inputs = sub_question_inputs(state)
+    result = None
+    for result in get_question_graph().stream(inputs, stream_mode="values"):
+        pass
+    return sub_answer(state["question"], result)
+
+
+def sub_answer(question, result):
+    """
+    Returns the graph state updates adding the outcome of a sub-question's run
+    """
+    result = result or {}
+    return {
+        "answers": [
+            {
+                "question": question,
+                "generation": result.get("generation"),
+                "grade": result.get("generation_grade"),
+                "datasource": result.get("datasource"),
+                "route_path": result.get("route_path"),
+                "generations": result.get("generations", 0),
+                "web_searches": result.get("web_searches", 0),
+                "llm_calls": result.get("llm_calls", 0),
+            }
+        ]
+    }
+
+
+def merge_answers(state):
+    """
+    Merges the answers to the sub-questions into one reply, graded by its lowest graded answer
+    """
+    logger.info("---MERGE ANSWERS---")
+    order = {question: i for i, question in enumerate(state["questions"])}
+    answers = sorted(state["answers"], key=lambda answer: order.get(answer["question"], 0))
+    grade = min(
+        (answer["grade"] or "not supported" for answer in answers),
+        key=GRADE_RANKS.get,
+        default="not supported",
+    )
+    return {
+        "generation": compose_reply(answers) if answers else None,
+        "generation_grade": grade,
+        "datasource": "+".join(str(answer["datasource"]) for answer in answers),
+        "route_path": "+".join(str(answer["route_path"]) for answer in answers),
+        "generations": sum(answer["generations"] for answer in answers),
+        "web_searches": sum(answer["web_searches"] for answer in answers),
+        "llm_calls": state.get("llm_calls", 0) + sum(answer["llm_calls"] for answer in answers),
+    }
+
+
+def build_email_workflow(split_email, answer_sub_question, merge_answers):
+    """
+    Builds the graph answering a whole email from the given node functions, so the same graph can run
+    with sync or async nodes
+    """
+    workflow = StateGraph(EmailState)
+    workflow.add_node("split_email", split_email)
+    workflow.add_node("answer_sub_question", answer_sub_question)
+    workflow.add_node("merge_answers", merge_answers)
+
+    workflow.set_entry_point("split_email")
+    workflow.add_conditional_edges("split_email", fan_out, ["answer_sub_question"])
+    workflow.add_edge("answer_sub_question", "merge_answers")
+    workflow.add_edge("merge_answers", END)
+    return workflow
+
+
+email_workflow = build_email_workflow(
+    split_email=split_email,
+    answer_sub_question=answer_sub_question,
+    merge_answers=merge_answers,
 )
@@ -1,15 +1,12 @@
 import logging
-from config import settings
-from database.vectorstore import retriever
+from llm.client import get_chain, get_llm
+from llm.context import build_context
 
-from langchain_community.chat_models import ChatOllama
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import PromptTemplate
 
 logger = logging.getLogger(__name__)
 
-llm = ChatOllama(model=settings.LLM_MODEL, temperature=0)
-
 prompt = PromptTemplate(
     template="""<|begin_of_text|><|start_header_id|>system<|end_header_id|> You are an assistant for question-answering tasks. 
     Use the following pieces of retrieved context to answer the question. If you don't know the answer, just say that you don't know. 
@@ -17,21 +14,28 @@ prompt = PromptTemplate(
     Question: {question} 
     Context: {context} 
     Answer: <|eot_id|><|start_header_id|>assistant<|end_header_id|>""",
-    input_variables=["question", "document"],
+    input_variables=["question", "context"],
 )
 
 
-def generate_response(question, llm=llm, prompt=prompt):
+def generate_response(question, documents, llm=None, prompt=prompt):
     """
-    Given a question, generate a response using a RAG LLM which retrieves documents from a vectorstore and attempts
+    Given a question and the documents retrieved for it, generate a response using a RAG LLM which attempts
     to answer the question from the context provided by those documents
     """
-    rag_chain = prompt | llm | StrOutputParser()
-    docs = retriever.invoke(question)
-    generation = rag_chain.invoke({"context": docs, "question": question})
+    llm = llm or get_llm()
+    rag_chain = get_chain(prompt, llm, StrOutputParser)
+    generation = rag_chain.invoke({"context": build_context(documents), "question": question})
     logger.debug(generation)
     return generation
 
 
-def format_docs(docs):
-    return "\n\n".join(doc.page_content for doc in docs)
+async def agenerate_response(question, documents, llm=None, prompt=prompt):
+    """Async version of generate_response"""
+    llm = llm or get_llm()
+    rag_chain = get_chain(prompt, llm, StrOutputParser)
+    generation = await rag_chain.ainvoke(
+        {"context": build_context(documents), "question": question}
+    )
+    logger.debug(generation)
+    return generation
@@ -1,15 +1,14 @@
 import logging
 from config import settings
+from llm.client import get_chain, get_llm
+from llm.cache import llm_cache
 
-from langchain_community.chat_models import ChatOllama
 from langchain_core.output_parsers import JsonOutputParser
 from langchain_core.prompts import PromptTemplate
 
 
 logger = logging.getLogger(__name__)
 
-llm = ChatOllama(model=settings.LLM_MODEL, format="json", temperature=0)
-
 prompt = PromptTemplate(
     template="""<|begin_of_text|><|start_header_id|>system<|end_header_id|> You are a grader assessing relevance 
     of a retrieved document to a user question. If the document contains keywords related to the user question, 
@@ -23,13 +22,107 @@ prompt = PromptTemplate(
     input_variables=["question", "document"],
 )
 
+batch_prompt = PromptTemplate(
+    template="""<|begin_of_text|><|start_header_id|>system<|end_header_id|> You are a grader assessing relevance 
+    of each of a numbered list of retrieved documents to a user question. If a document contains keywords related to the 
+    user question, grade it as relevant. It does not need to be a stringent test. The goal is to filter out erroneous 
+    retrievals. \n
+    Give a binary score 'yes' or 'no' for every document to indicate whether it is relevant to the question. \n
+    Provide the scores as a JSON with a single key 'scores' holding a list with one score per document, in the order 
+    the documents are numbered, and no premable or explanation.
+     <|eot_id|><|start_header_id|>user<|end_header_id|>
+    Here are the {count} retrieved documents: \n\n {documents} \n\n
+    Here is the user question: {question} \n <|eot_id|><|start_header_id|>assistant<|end_header_id|>
+    """,
+    input_variables=["question", "documents", "count"],
+)
+
 
-def grade_retrieval(question, document, llm=llm, prompt=prompt):
+def grade_retrieval(question, document, llm=None, prompt=prompt):
     """
     Grades whether the documents pulled from the vectorstore is relevant to the question asked by the user.
     Returns "yes" if the document is relevant to the question and "no" otherwise.
     """
-    retrieval_grader = prompt | llm | JsonOutputParser()
-    score = retrieval_grader.invoke({"question": question, "document": document})
+    llm = llm or get_llm(json_mode=True)
+    retrieval_grader = get_chain(prompt, llm, JsonOutputParser)
+    score = llm_cache.invoke(
+        retrieval_grader, {"question": question, "document": document}, llm, prompt
+    )
     logger.debug(score)
     return score["score"]
+
+
+def grade_retrievals(
+    question, documents, llm=None, prompt=prompt, max_concurrency=settings.GRADER_CONCURRENCY
+):
+    """
+    Grades the relevance of each document to the question, sending up to max_concurrency grading requests
+    to the LLM at once. Returns a "yes" or "no" score for each document, in order.
+    """
+    llm = llm or get_llm(json_mode=True)
+    retrieval_grader = get_chain(prompt, llm, JsonOutputParser)
+    scores = llm_cache.batch(
+        retrieval_grader,
+        [{"question": question, "document": document} for document in documents],
+        llm,
+        prompt,
+        config={"max_concurrency": max_concurrency},
+    )
+    logger.debug(scores)
+    return [score["score"] for score in scores]
+
+
+async def agrade_retrievals(
+    question, documents, llm=None, prompt=prompt, max_concurrency=settings.GRADER_CONCURRENCY
+):
+    """Async version of grade_retrievals"""
+    llm = llm or get_llm(json_mode=True)
+    retrieval_grader = get_chain(prompt, llm, JsonOutputParser)
+    scores = await llm_cache.abatch(
+        retrieval_grader,
+        [{"question": question, "document": document} for document in documents],
+        llm,
+        prompt,
+        config={"max_concurrency": max_concurrency},
+    )
+    logger.debug(scores)
+    return [score["score"] for score in scores]
+
+
+def grade_retrievals_in_one_call(question, documents, llm=None, prompt=batch_prompt):
+    """
+    Grades the relevance of all documents to the question in a single LLM call.
+    Returns a "yes" or "no" score for each document, in order, and raises a ValueError
+    if the LLM does not return exactly one score per document.
+    """
+    llm = llm or get_llm(json_mode=True)
+    retrieval_grader = get_chain(prompt, llm, JsonOutputParser)
+    score = llm_cache.invoke(retrieval_grader, number_documents(question, documents), llm, prompt)
+    return check_scores(score, documents)
+
+
+async def agrade_retrievals_in_one_call(question, documents, llm=None, prompt=batch_prompt):
+    """Async version of grade_retrievals_in_one_call"""
+    llm = llm or get_llm(json_mode=True)
+    retrieval_grader = get_chain(prompt, llm, JsonOutputParser)
+    score = await llm_cache.ainvoke(
+        retrieval_grader, number_documents(question, documents), llm, prompt
+    )
+    return check_scores(score, documents)
+
+
+def number_documents(question, documents):
+    """Returns the single call grading prompt's inputs, with the documents numbered in order"""
+    numbered = "\n\n".join(
+        f"Document {i}:\n{document}" for i, document in enumerate(documents, start=1)
+    )
+    return {"question": question, "documents": numbered, "count": len(documents)}
+
+
+def check_scores(score, documents):
+    """Returns the scores of a single call grading, raising a ValueError unless there is one per document"""
+    logger.debug(score)
+    scores = score.get("scores") if isinstance(score, dict) else None
+    if not isinstance(scores, list) or len(scores) != len(documents):
+        raise ValueError(f"expected {len(documents)} scores, got {score}")
+    return [str(s) for s in scores]
@@ -1,13 +1,13 @@
-from langchain_community.chat_models import ChatOllama
 from langchain_core.output_parsers import JsonOutputParser
 from langchain_core.prompts import PromptTemplate
 from config import settings
+from llm.client import get_chain, get_llm
+from database.vectorstore import get_vectorstore
+from llm.cache import llm_cache
 import logging
 
 logger = logging.getLogger(__name__)
 
-llm = ChatOllama(model=settings.LLM_MODEL, format="json", temperature=0)
-
 prompt = PromptTemplate(
     template="""<|begin_of_text|><|start_header_id|>system<|end_header_id|> You are an expert at routing a 
     user question to a vectorstore or web search. Use the vectorstore for questions on cybersecurity, software vulnerabilities 
@@ -19,13 +19,67 @@ prompt = PromptTemplate(
 )
 
 
-def route(question, llm=llm, prompt=prompt):
+def route(question, llm=None, prompt=prompt):
     """
     Given the question and routes the to the appropriate datasource based on the question's subject matter.
     Questions pertain to cybersecurity and software vulnerabilities are answerable from the documents loaded
     in by the RAG application, all other questions will be answered via web sesarch.
     """
-    question_router = prompt | llm | JsonOutputParser()
-    source = question_router.invoke({"question": question})
+    llm = llm or get_llm(json_mode=True)
+    question_router = get_chain(prompt, llm, JsonOutputParser)
+    source = llm_cache.invoke(question_router, {"question": question}, llm, prompt)
+    logger.debug(source)
+    return source
+
+
+async def aroute(question, llm=None, prompt=prompt):
+    """Async version of route"""
+    llm = llm or get_llm(json_mode=True)
+    question_router = get_chain(prompt, llm, JsonOutputParser)
+    source = await llm_cache.ainvoke(question_router, {"question": question}, llm, prompt)
     logger.debug(source)
     return source
+
+
+def fast_route(question, vectorstore=None):
+    """
+    Routes the question by how close it is to the documents in the vectorstore, without calling the LLM.
+    Returns the datasource, or None if the nearest chunk's relevance score is in the ambiguous band, along
+    with the chunks found so they can be reused for retrieval.
+    """
+    vectorstore = vectorstore or get_vectorstore()
+    # the public method warns about every score outside [0, 1], which classify_route clamps instead
+    results = vectorstore._similarity_search_with_relevance_scores(
+        question, k=settings.RETRIEVER_K
+    )
+    return classify_route(results)
+
+
+async def afast_route(question, vectorstore=None):
+    """Async version of fast_route"""
+    vectorstore = vectorstore or get_vectorstore()
+    results = await vectorstore._asimilarity_search_with_relevance_scores(
+        question, k=settings.RETRIEVER_K
+    )
+    return classify_route(results)
+
+
+def clamp_relevance(score):
+    """
+    Clamps a relevance score to [0, 1]. Scores derived from euclidean distances, as Chroma's and the
+    numpy store's are, fall below 0 for vectors further apart than orthogonal ones.
+    """
+    return min(1.0, max(0.0, score))
+
+
+def classify_route(results):
+    """Given the (document, relevance score) pairs nearest to a question, returns the datasource and documents"""
+    documents = [document for document, _ in results]
+    score = max((clamp_relevance(score) for _, score in results), default=0.0)
+    logger.debug(f"nearest chunk relevance: {score:.3f}")
+
+    if score >= settings.ROUTER_VECTORSTORE_THRESHOLD:
+        return "vectorstore", documents
+    if score <= settings.ROUTER_WEB_SEARCH_THRESHOLD:
+        return "web_search", documents
+    return None, documents
@@ -1,9 +1,140 @@
+import re
+import time
+import asyncio
 import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from dotenv import load_dotenv
-from langchain_community.tools.tavily_search import TavilySearchResults
+
+from config import settings, singleton
 
 
 logger = logging.getLogger(__name__)
 
 load_dotenv()
-web_search_tool = TavilySearchResults(max_results=3)
+
+
+@singleton
+def get_web_search_tool():
+    """Returns the shared Tavily search tool, created on first use"""
+    from langchain_community.tools.tavily_search import TavilySearchResults
+
+    return TavilySearchResults(max_results=3)
+
+
+def normalize_query(query):
+    """Normalizes a search query so that queries differing only in case, spacing or punctuation match"""
+    return " ".join(re.findall(r"\w+", query.lower()))
+
+
+class SearchCache:
+    """
+    In-memory cache of web search results keyed by the normalized query. Results expire after ttl
+    seconds and the least recently used results are evicted past max_entries. A query that is already
+    being searched, e.g. by a speculative prefetch, is not searched again: callers wait for its result.
+    Failed searches are not cached.
+    """
+
+    def __init__(self, ttl=3600, max_entries=1000, max_workers=2):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_workers = max_workers
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.pending = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    @property
+    def executor(self):
+        """Starts the threads running prefetched searches on first use"""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="web-search"
+                )
+        return self._executor
+
+    def claim(self, query):
+        """
+        Returns a future for the results of the query and whether the caller owns it, i.e. has to run
+        the search and complete the future. Cached and in flight searches are returned unowned.
+        """
+        key = normalize_query(query)
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                future = Future()
+                future.set_result(entry[1])
+                return future, False
+            if key in self.pending:
+                self.hits += 1
+                return self.pending[key], False
+            self.misses += 1
+            future = self.pending[key] = Future()
+            return future, True
+
+    def complete(self, query, future, results=None, error=None):
+        """Caches the results of an owned search, or drops it if the search failed"""
+        key = normalize_query(query)
+        with self._lock:
+            self.pending.pop(key, None)
+            if error is None:
+                self.entries[key] = (time.time() + self.ttl, results)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        if error is None:
+            future.set_result(results)
+        else:
+            future.set_exception(error)
+
+    def run(self, query, future):
+        try:
+            results = get_web_search_tool().invoke({"query": query})
+        except Exception as e:
+            logger.error(f"web search failed: {e}")
+            self.complete(query, future, error=e)
+        else:
+            self.complete(query, future, results)
+
+    def search(self, query):
+        """Returns the web search results of the query"""
+        future, owner = self.claim(query)
+        if owner:
+            self.run(query, future)
+        return future.result()
+
+    async def asearch(self, query):
+        """Async version of search"""
+        future, owner = self.claim(query)
+        if owner:
+            try:
+                results = await get_web_search_tool().ainvoke({"query": query})
+            except Exception as e:
+                logger.error(f"web search failed: {e}")
+                self.complete(query, future, error=e)
+            else:
+                self.complete(query, future, results)
+        return await asyncio.wrap_future(future)
+
+    def prefetch(self, query):
+        """Starts searching the query in the background unless it is cached or already in flight"""
+        future, owner = self.claim(query)
+        if owner:
+            logger.info("---SPECULATIVE WEB SEARCH---")
+            self.executor.submit(self.run, query, future)
+
+    def stats(self):
+        """Returns the cache's hit and miss counters"""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries)}
+
+
+search_cache = SearchCache(
+    ttl=settings.WEB_SEARCH_CACHE_TTL, max_entries=settings.WEB_SEARCH_CACHE_SIZE
+)
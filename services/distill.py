@@ -0,0 +1,138 @@
+import re
+import logging
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# lines where the quoted history of a reply or forward starts
+QUOTE_HEADERS = [
+    re.compile(r"^on\b.{0,200}\bwrote:\s*$", re.IGNORECASE),
+    re.compile(r"^-{2,}\s*(original|forwarded) message\s*-{2,}", re.IGNORECASE),
+    re.compile(r"^begin forwarded message:?", re.IGNORECASE),
+    re.compile(r"^_{10,}\s*$"),
+]
+# an Outlook style quoted header block: From: followed closely by Sent:/Date: and To:/Subject:
+QUOTE_FROM = re.compile(r"^\*?from:\*?\s", re.IGNORECASE)
+QUOTE_FIELDS = re.compile(r"^\*?(sent|date|to|subject|cc):\*?\s", re.IGNORECASE)
+# greeting lines, which do not count as content above a sign-off
+GREETING = re.compile(
+    r"^(hi|hello|hey|dear|greetings|good (morning|afternoon|evening))\b[^\n]{0,60}[,!:.]?\s*$",
+    re.IGNORECASE,
+)
+# lines where the signature starts, when only a signature follows them
+SIGNATURES = [
+    re.compile(r"^--\s*$"),
+    re.compile(r"^sent from my \w+", re.IGNORECASE),
+    re.compile(r"^get outlook for \w+", re.IGNORECASE),
+]
+# sign-off lines, which only start the signature when no more than a name and contact details follow
+SIGN_OFF = re.compile(
+    r"^(best|(best|kind|warm)\s+(regards|wishes)|many thanks|regards|thanks|thank you|cheers"
+    r"|sincerely|yours (truly|sincerely))( in advance| so much)?[,.!]*\s*$",
+    re.IGNORECASE,
+)
+# the signature below a sign-off: at most a few short lines, none of them a question
+MAX_SIGNATURE_LINES = 6
+MAX_SIGNATURE_LINE_CHARS = 80
+# lines where legal or unsubscribe footers start, when they end the message and ask nothing
+MAX_FOOTER_LINES = 15
+FOOTERS = re.compile(
+    r"^(confidentiality notice|disclaimer|this (e-?mail|message)( and any attachments)? (is|are|may)"
+    r"|the information (contained )?in this (e-?mail|message)|to unsubscribe)",
+    re.IGNORECASE,
+)
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+def strip_history(lines):
+    """Returns the lines before the quoted history of a reply or forward, dropping > quoted lines"""
+    kept = []
+    for i, line in enumerate(lines):
+        stripped = line.strip()
+        # "On <date>, <name> wrote:" is often wrapped over two lines
+        joined = f"{stripped} {lines[i + 1].strip()}" if i + 1 < len(lines) else stripped
+        if any(p.match(stripped) or p.match(joined) for p in QUOTE_HEADERS):
+            break
+        if QUOTE_FROM.match(stripped) and any(
+            QUOTE_FIELDS.match(following.strip()) for following in lines[i + 1 : i + 4]
+        ):
+            break
+        if not stripped.startswith(">"):
+            kept.append(line)
+    return kept
+
+
+def is_signature(lines):
+    """Returns whether the lines below a sign-off look like a name and contact details only"""
+    lines = [line.strip() for line in lines if line.strip()]
+    return len(lines) <= MAX_SIGNATURE_LINES and all(
+        len(line) <= MAX_SIGNATURE_LINE_CHARS and not line.endswith("?") for line in lines
+    )
+
+
+def is_footer(lines):
+    """Returns whether the lines from a footer's first line on are near the end and ask no question"""
+    lines = [line.strip() for line in lines if line.strip()]
+    return len(lines) <= MAX_FOOTER_LINES and not any("?" in line for line in lines)
+
+
+def strip_signature(lines):
+    """
+    Returns the lines before the signature, sign-off or footer, if one follows some content other than
+    a greeting. A line that only looks like one, such as "Thanks!" or "Disclaimer: ...", followed by
+    more of the message is kept.
+    """
+    for i, line in enumerate(lines):
+        stripped = line.strip()
+        if not any(l.strip() and not GREETING.match(l.strip()) for l in lines[:i]):
+            continue
+        if any(p.match(stripped) for p in SIGNATURES) and is_signature(lines[i + 1 :]):
+            return lines[:i]
+        if FOOTERS.match(stripped) and is_footer(lines[i:]):
+            return lines[:i]
+        if SIGN_OFF.match(stripped) and is_signature(lines[i + 1 :]):
+            return lines[:i]
+    return lines
+
+
+def cap_length(text, max_chars):
+    """
+    Shortens text to at most max_chars, keeping the sentences that ask questions, each with the sentence
+    before it for context, and cutting at a sentence boundary otherwise
+    """
+    if len(text) <= max_chars:
+        return text
+    sentences = SENTENCE_END.split(text)
+    questions = [i for i, sentence in enumerate(sentences) if sentence.rstrip().endswith("?")]
+    if questions:
+        indices = sorted({j for i in questions for j in (i - 1, i) if j >= 0})
+        kept = []
+        for i in indices:
+            if len(" ".join([*kept, sentences[i]])) > max_chars:
+                break
+            kept.append(sentences[i])
+        if kept:
+            return " ".join(kept)
+    shortened = text[:max_chars]
+    boundary = max(shortened.rfind(". "), shortened.rfind("? "), shortened.rfind("! "))
+    return shortened[: boundary + 1] if boundary > max_chars // 2 else shortened
+
+
+def distill_question(body, max_chars=settings.MAX_QUESTION_CHARS):
+    """
+    Extracts the question from an email body: the new content above the quoted history, without the
+    signature and legal footers, with whitespace collapsed and capped at max_chars characters. Falls
+    back to the whole body if nothing is left.
+    """
+    lines = body.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    lines = strip_signature(strip_history(lines))
+    paragraphs = re.split(r"\n\s*\n", "\n".join(lines))
+    text = "\n".join(" ".join(p.split()) for p in paragraphs if p.strip())
+    if not text:
+        text = " ".join(body.split())
+
+    question = cap_length(text, max_chars)
+    if len(question) < len(body):
+        logger.debug(f"distilled a {len(body)} character body into {len(question)} characters")
+    return question
@@ -1,7 +1,9 @@
 import os.path
+import json
+import asyncio
 import logging
 import base64
-from bs4 import BeautifulSoup
+import threading
 
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
@@ -11,6 +13,7 @@ from googleapiclient.errors import HttpError
 from email.message import EmailMessage
 
 from config import settings, setup_logging
+from services.mime import extract_body, header_value
 
 setup_logging("gmail_svc")
 logger = logging.getLogger(__name__)
@@ -18,17 +21,29 @@ logger = logging.getLogger(__name__)
 BASE_DIR = os.path.dirname(__file__)
 CREDENTIALS_FILE = os.path.join(BASE_DIR, "credentials.json")
 TOKEN_FILE = os.path.join(BASE_DIR, "token.json")
+HISTORY_FILE = os.path.join(BASE_DIR, "history.json")
+# the parts of a message resource that are parsed, leaving out e.g. the snippet and label ids
+MESSAGE_FIELDS = "id,payload(mimeType,filename,headers,body(data,attachmentId),parts)"
 
 
 class GmailAPI:
     creds = None
+    service = None
+    # the underlying HTTP client is not thread safe, so calls from threads are serialized
+    lock = threading.Lock()
 
     @classmethod
     def authenticate(cls):
-        """Authenticates the user to get access to their gmail inbox"""
-        if os.path.exists("token.json"):
+        """
+        Authenticates the user to get access to their gmail inbox. A service that was set without
+        credentials, e.g. one built against a local fake of the discovery service, is used as is.
+        """
+        if cls.service is not None and (cls.creds is None or cls.creds.valid):
+            return
+
+        if cls.creds is None and os.path.exists(TOKEN_FILE):
             cls.creds = Credentials.from_authorized_user_file(
-                "token.json", settings.SCOPES
+                TOKEN_FILE, settings.SCOPES
             )
 
         if not cls.creds or not cls.creds.valid:
@@ -43,66 +58,207 @@ class GmailAPI:
             with open(TOKEN_FILE, "w") as token:
                 token.write(cls.creds.to_json())
 
-            cls.service = build("gmail", "v1", credentials=cls.creds)
+        cls.service = cls.build_service(credentials=cls.creds)
+
+    @staticmethod
+    def build_service(**kwargs):
+        """
+        Builds the Gmail service. When GMAIL_DISCOVERY_URL is set, the discovery document (and
+        therefore the REST and batch endpoints) is read from that url instead of Google's.
+        """
+        if settings.GMAIL_DISCOVERY_URL:
+            kwargs.update(
+                discoveryServiceUrl=settings.GMAIL_DISCOVERY_URL,
+                static_discovery=False,
+            )
+        return build("gmail", "v1", **kwargs)
 
     @classmethod
-    def get_messages(cls, max_results=3):
-        """Gets the most recent email messages from the authenticated user's inbox. The number of messages to return are limited by max_results."""
+    def get_messages(cls, max_results=3, incremental=False):
+        """
+        Gets the most recent email messages from the authenticated user's inbox. The number of messages to
+        return are limited by max_results. When incremental is set and a history id was stored by a previous
+        run, only the messages added to the inbox since that run are returned, regardless of max_results.
+        Messages that fail to parse are logged and skipped. Returns the messages and the history id reached,
+        or None, None if listing or fetching failed; see list_messages.
+        """
+        message_ids, history_id = cls.list_messages(max_results, incremental)
+        if message_ids is None:
+            return None, None
+        if (messages := cls.get_messages_by_id(message_ids)) is None:
+            return None, None
+        return messages, history_id
+
+    @classmethod
+    def list_messages(cls, max_results=3, incremental=False):
+        """
+        Lists the ids of the most recent messages in the authenticated user's inbox, or, when incremental is
+        set, of the messages added since the stored history id. Returns the ids and the history id reached,
+        or None, None on failure. The history id is not stored here: callers store it with save_history once
+        the messages are handled, so messages that fail are listed again by the next incremental listing.
+        """
         try:
             cls.authenticate()
 
-            inbox_info = (
-                cls.service.users()
-                .messages()
-                .list(userId="me", maxResults=max_results)
-                .execute()
-            )
-            logger.info(f"inbox: {inbox_info}")
+            history_id = load_history_id() if incremental else None
+            message_ids = None
+            if history_id is not None:
+                message_ids, latest_history_id = cls.list_new_message_ids(history_id)
+            if message_ids is None:
+                message_ids, latest_history_id = cls.list_message_ids(max_results)
+            logger.info(f"messages: {message_ids}")
+
+        except HttpError as error:
+            logger.error(f"An error occurred: {error}")
+            return None, None
+        return message_ids, latest_history_id
+
+    @staticmethod
+    def save_history(history_id):
+        """Stores the history id that the next incremental listing starts from"""
+        save_history_id(history_id)
+
+    @staticmethod
+    def drafted_ids():
+        """Returns the ids of the messages drafted since the stored history id"""
+        return load_drafted_ids()
+
+    @staticmethod
+    def save_drafted(message_ids):
+        """Records messages drafted without advancing the history id, so later runs skip them"""
+        save_drafted_ids(message_ids)
+
+    @classmethod
+    def get_messages_by_id(cls, message_ids):
+        """Gets and parses the messages with the given ids. Messages that fail to parse are logged and skipped."""
+        try:
+            cls.authenticate()
+            contents = cls.fetch_messages(list(message_ids))
+        except HttpError as error:
+            logger.error(f"An error occurred: {error}")
+            return None
+
+        responses = []
+        for content in contents:
+            try:
+                responses.append(cls.parse_message(content))
+            except Exception as e:
+                logger.error(f"Error parsing message {content.get('id')}: {e}")
+        return responses
+
+    @classmethod
+    def list_message_ids(cls, max_results):
+        """
+        Lists the ids of the most recent messages in the inbox, along with the mailbox's current
+        history id which marks where the next incremental sync starts from
+        """
+        profile = cls.service.users().getProfile(userId="me").execute()
+        inbox_info = (
+            cls.service.users()
+            .messages()
+            .list(userId="me", labelIds=["INBOX"], maxResults=max_results)
+            .execute()
+        )
+        logger.debug(f"inbox: {inbox_info}")
+
+        message_ids = [msg["id"] for msg in inbox_info.get("messages", [])]
+        return message_ids, profile["historyId"]
+
+    @classmethod
+    def list_new_message_ids(cls, start_history_id):
+        """
+        Lists the ids of messages added to the inbox since start_history_id, along with the latest
+        history id. Returns None for the ids if the start history id is too old to sync from.
+        """
+        message_ids = []
+        latest_history_id = start_history_id
+        history = cls.service.users().history()
+        request = history.list(
+            userId="me",
+            startHistoryId=start_history_id,
+            historyTypes=["messageAdded"],
+            labelId="INBOX",
+        )
+        try:
+            while request is not None:
+                response = request.execute()
+                for record in response.get("history", []):
+                    for added in record.get("messagesAdded", []):
+                        if added["message"]["id"] not in message_ids:
+                            message_ids.append(added["message"]["id"])
+                latest_history_id = response.get("historyId", latest_history_id)
+                request = history.list_next(request, response)
+        except HttpError as error:
+            if error.resp.status != 404:
+                raise
+            logger.warning(f"history id {start_history_id} expired, running full sync")
+            return None, None
+        return message_ids, latest_history_id
 
-            messages = inbox_info.get("messages")
-            logger.info(f"messages: {messages}")
+    @classmethod
+    def fetch_messages(cls, message_ids):
+        """
+        Fetches the given messages through Gmail's batch endpoint, sending up to GMAIL_BATCH_SIZE
+        requests per HTTP round trip. Only the fields that are parsed are requested, and attachment
+        bodies are left on the server. Messages that fail to fetch are logged and skipped.
+        """
+        contents = {}
 
-            for msg in messages:
-                content = (
+        def callback(request_id, response, exception):
+            if exception is not None:
+                logger.error(f"Error getting message {request_id}: {exception}")
+            else:
+                contents[request_id] = response
+
+        for start in range(0, len(message_ids), settings.GMAIL_BATCH_SIZE):
+            batch = cls.service.new_batch_http_request(callback=callback)
+            for message_id in message_ids[start : start + settings.GMAIL_BATCH_SIZE]:
+                batch.add(
                     cls.service.users()
                     .messages()
-                    .get(userId="me", id=msg["id"])
-                    .execute()
+                    .get(userId="me", id=message_id, format="full", fields=MESSAGE_FIELDS),
+                    request_id=message_id,
                 )
+            batch.execute()
 
-                try:
-                    payload = content["payload"]
-                    headers = payload["headers"]
-
-                    subject = None
-                    sender = None
-                    for header in headers:
-                        match header["name"]:
-                            case "Subject":
-                                subject = header["value"]
-                            case "From":
-                                sender = header["value"]
-
-                    parts = payload.get("parts")[0]
-                    data = parts["body"]["data"]
-                    data = data.replace("-", "+").replace("_", "/")
-                    decoded_data = base64.b64decode(data)
-
-                    soup = BeautifulSoup(decoded_data, "lxml")
-                    body = soup.get_text()
-
-                    response = {
-                        "Sender": sender,
-                        "Subject": subject,
-                        "Body": body,
-                    }
-                    return response
-
-                except Exception as e:
-                    logger.error(f"Error getting inbox messages: {e}")
+        return [contents[i] for i in message_ids if i in contents]
 
-        except HttpError as error:
-            logger.error(f"An error occurred: {error}")
+    @staticmethod
+    def parse_message(content):
+        """
+        Parses a Gmail message resource into its id, sender, subject and plain text body. The body is
+        the message's text/plain content, or its text/html content converted to text if it has none.
+        """
+        payload = content["payload"]
+        headers = payload.get("headers", [])
+
+        return {
+            "Id": content["id"],
+            "Sender": header_value(headers, "From"),
+            "Subject": header_value(headers, "Subject"),
+            "Body": extract_body(payload),
+        }
+
+    @classmethod
+    def locked(cls, method, *args, **kwargs):
+        """Calls one of the class's methods while holding the client lock"""
+        with cls.lock:
+            return method(*args, **kwargs)
+
+    @classmethod
+    async def aget_messages(cls, max_results=3, incremental=False):
+        """Async version of get_messages, which runs the blocking Gmail client in a worker thread"""
+        return await asyncio.to_thread(cls.locked, cls.get_messages, max_results, incremental)
+
+    @classmethod
+    async def aget_messages_by_id(cls, message_ids):
+        """Async version of get_messages_by_id, which runs the blocking Gmail client in a worker thread"""
+        return await asyncio.to_thread(cls.locked, cls.get_messages_by_id, message_ids)
+
+    @classmethod
+    async def acreate_draft(cls, receiver: str, subject: str, content: str):
+        """Async version of create_draft, which runs the blocking Gmail client in a worker thread"""
+        return await asyncio.to_thread(cls.locked, cls.create_draft, receiver, subject, content)
 
     @classmethod
     def create_draft(cls, receiver: str, subject: str, content: str):
@@ -133,3 +289,40 @@ class GmailAPI:
             logger.error(f"An error occurred: {error}")
             draft = None
         return draft
+
+
+def load_history():
+    """Loads what the last sync stored: its history id and the ids of the messages drafted since"""
+    if not os.path.exists(HISTORY_FILE):
+        return {}
+    with open(HISTORY_FILE) as f:
+        return json.load(f)
+
+
+def load_history_id():
+    """Loads the history id stored by the last sync, if there is one"""
+    return load_history().get("historyId")
+
+
+def save_history_id(history_id):
+    """
+    Stores the history id that the next incremental sync starts from, forgetting the messages drafted
+    before it
+    """
+    if history_id is None:
+        return
+    with open(HISTORY_FILE, "w") as f:
+        json.dump({"historyId": history_id}, f)
+
+
+def load_drafted_ids():
+    """Loads the ids of the messages drafted since the stored history id"""
+    return set(load_history().get("drafted", []))
+
+
+def save_drafted_ids(message_ids):
+    """Adds to the ids of the messages drafted since the stored history id"""
+    history = load_history()
+    history["drafted"] = sorted(set(history.get("drafted", [])) | set(message_ids))
+    with open(HISTORY_FILE, "w") as f:
+        json.dump(history, f)
@@ -0,0 +1,116 @@
+import re
+import base64
+import logging
+from html import unescape
+from html.parser import HTMLParser
+
+logger = logging.getLogger(__name__)
+
+# tags whose content is never part of the visible text
+SKIPPED_TAGS = {"head", "script", "style", "title", "template", "noscript"}
+# tags that start a new line in the visible text
+BLOCK_TAGS = {
+    "address", "article", "blockquote", "br", "div", "dl", "dt", "dd", "footer", "h1", "h2",
+    "h3", "h4", "h5", "h6", "header", "hr", "li", "ol", "p", "pre", "section", "table", "td",
+    "th", "tr", "ul",
+}
+
+
+class TextExtractor(HTMLParser):
+    """Collects the visible text of an HTML document, with a line break for every block element"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.chunks = []
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIPPED_TAGS:
+            self.skipping += 1
+        elif tag in BLOCK_TAGS:
+            self.chunks.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in SKIPPED_TAGS:
+            self.skipping = max(0, self.skipping - 1)
+        elif tag in BLOCK_TAGS:
+            self.chunks.append("\n")
+
+    def handle_data(self, data):
+        if not self.skipping:
+            self.chunks.append(data)
+
+
+def html_to_text(html):
+    """Returns the visible text of an HTML document"""
+    extractor = TextExtractor()
+    try:
+        extractor.feed(html)
+        extractor.close()
+        text = "".join(extractor.chunks)
+    except Exception as e:
+        logger.warning(f"failed to parse html, stripping tags: {e}")
+        text = unescape(re.sub(r"<[^>]+>", " ", html))
+    lines = (" ".join(line.split()) for line in text.splitlines())
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+
+def header_value(headers, name):
+    """Returns the value of the first header with the given name, ignoring case"""
+    name = name.lower()
+    return next((h["value"] for h in headers or [] if h["name"].lower() == name), None)
+
+
+def charset(part):
+    """Returns the charset declared in a part's Content-Type header, defaulting to utf-8"""
+    content_type = header_value(part.get("headers"), "Content-Type") or ""
+    match = re.search(r'charset="?([\w.:-]+)"?', content_type, re.IGNORECASE)
+    return match.group(1) if match else "utf-8"
+
+
+def is_attachment(part):
+    """Returns whether a MIME part is an attachment rather than a body"""
+    disposition = header_value(part.get("headers"), "Content-Disposition") or ""
+    return bool(
+        part.get("filename")
+        or part.get("body", {}).get("attachmentId")
+        or disposition.lower().startswith("attachment")
+    )
+
+
+def decode_part(part):
+    """Decodes the base64url data of a MIME part's body into text"""
+    data = part.get("body", {}).get("data")
+    if not data:
+        return ""
+    raw = base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+    try:
+        return raw.decode(charset(part), errors="replace")
+    except LookupError:
+        return raw.decode("utf-8", errors="replace")
+
+
+def extract_body(payload):
+    """
+    Walks the MIME tree of a Gmail message payload and returns the plain text of its body. The text/plain
+    parts are used when there are any, otherwise the text/html parts are converted to text. Attachments
+    are skipped without being decoded. Handles single part messages and nested multiparts.
+    """
+    plain, html = [], []
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        mime_type = (part.get("mimeType") or "").lower()
+        if mime_type.startswith("multipart/"):
+            # pushed in reverse so parts are visited in order
+            stack.extend(reversed(part.get("parts") or []))
+        elif is_attachment(part):
+            continue
+        elif mime_type == "text/plain":
+            plain.append(part)
+        elif mime_type == "text/html":
+            html.append(part)
+
+    if plain:
+        return "\n".join(decode_part(part) for part in plain).strip()
+    return "\n\n".join(html_to_text(decode_part(part)) for part in html).strip()
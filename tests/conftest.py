@@ -0,0 +1,159 @@
+import os
+import json
+import base64
+import threading
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+BOUNDARY = "batch_fake_gmail"
+
+
+def gmail_message(message_id, sender, subject, body):
+    """Returns a Gmail message resource with a text/plain body"""
+    return {
+        "id": message_id,
+        "payload": {
+            "mimeType": "text/plain",
+            "headers": [{"name": "From", "value": sender}, {"name": "Subject", "value": subject}],
+            "body": {"data": base64.urlsafe_b64encode(body.encode()).decode()},
+        },
+    }
+
+
+def error(code, message):
+    return code, {"error": {"code": code, "message": message, "errors": [{"message": message}]}}
+
+
+class FakeGmail:
+    """
+    In-memory fake of the Gmail API serving its own discovery document, so the real client can be built
+    against it with GMAIL_DISCOVERY_URL. Supports the profile, message list and get, history list and
+    batch endpoints, and records the requests it receives.
+    """
+
+    def __init__(self, discovery, history_page_size=2):
+        self.discovery = discovery
+        self.history_page_size = history_page_size
+        self.messages = {}
+        # (history id, message id) of every message added, oldest first
+        self.history = []
+        self.history_id = 100
+        # history ids older than this have expired and are answered with a 404
+        self.oldest_history_id = 0
+        self.requests = []
+        self.batches = []
+
+    def add_message(self, message_id, sender="Jo <jo@example.com>", subject="Hello", body="Hi"):
+        self.history_id += 1
+        self.messages[message_id] = gmail_message(message_id, sender, subject, body)
+        self.history.append((self.history_id, message_id))
+
+    def route(self, method, url):
+        """Returns the status and JSON body of a request"""
+        parts = urlsplit(url)
+        query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+        path = parts.path.strip("/").split("/")
+        self.requests.append((method, parts.path, query))
+
+        if path[:4] == ["discovery", "v1", "apis", "gmail"]:
+            return 200, self.discovery
+        if path[:4] != ["gmail", "v1", "users", "me"]:
+            return error(404, "not found")
+        resource = path[4:]
+        if resource == ["profile"]:
+            return 200, {"emailAddress": "me@example.com", "historyId": str(self.history_id)}
+        if resource == ["messages"]:
+            newest = [message_id for _, message_id in reversed(self.history)]
+            limit = int(query.get("maxResults", 100))
+            return 200, {"messages": [{"id": i, "threadId": i} for i in newest[:limit]]}
+        if len(resource) == 2 and resource[0] == "messages":
+            if resource[1] not in self.messages:
+                return error(404, "Requested entity was not found.")
+            return 200, self.messages[resource[1]]
+        if resource == ["history"]:
+            start = int(query["startHistoryId"])
+            if start < self.oldest_history_id:
+                return error(404, "Requested entity was not found.")
+            records = [(h, i) for h, i in self.history if h > start]
+            offset = int(query.get("pageToken", 0))
+            page = records[offset : offset + self.history_page_size]
+            response = {
+                "history": [
+                    {"id": str(h), "messagesAdded": [{"message": {"id": i}}]} for h, i in page
+                ],
+                "historyId": str(self.history_id),
+            }
+            if offset + self.history_page_size < len(records):
+                response["nextPageToken"] = str(offset + self.history_page_size)
+            return 200, response
+        return error(404, "not found")
+
+    def batch(self, content_type, body):
+        """Answers a multipart/mixed batch request, routing each of its parts"""
+        message = BytesParser().parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        parts = []
+        for part in message.get_payload():
+            method, url, _ = part.get_payload().split("\n", 1)[0].split(" ", 2)
+            status, payload = self.route(method, url)
+            content_id = part["Content-ID"].strip("<>")
+            parts.append(
+                f"--{BOUNDARY}\r\nContent-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                f"Content-Type: application/json\r\n\r\n{json.dumps(payload)}\r\n"
+            )
+        self.batches.append(len(parts))
+        return "".join(parts) + f"--{BOUNDARY}--\r\n"
+
+
+@pytest.fixture
+def fake_gmail():
+    """Serves a FakeGmail on a local port, yielding it with its discovery url"""
+    from googleapiclient import discovery as google_discovery
+
+    path = os.path.join(
+        os.path.dirname(google_discovery.__file__), "discovery_cache", "documents", "gmail.v1.json"
+    )
+    with open(path) as f:
+        document = json.load(f)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.respond(*fake.route("GET", self.path))
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.path.strip("/") != "batch":
+                return self.respond(*error(404, "not found"))
+            payload = fake.batch(self.headers["Content-Type"], body).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", f"multipart/mixed; boundary={BOUNDARY}")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def respond(self, status, payload):
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    root = f"http://127.0.0.1:{server.server_address[1]}/"
+    document.update(rootUrl=root, baseUrl=root, mtlsRootUrl=root)
+    fake = FakeGmail(document)
+    fake.discovery_url = f"{root}discovery/v1/apis/{{api}}/{{apiVersion}}/rest"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield fake
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,41 @@
+import pytest
+
+pytest.importorskip("langgraph")
+
+import app
+from benchmarks.fakes import FakeGmailAPI
+
+
+@pytest.mark.parametrize(
+    "sender, expected",
+    [
+        ("Jo Smith <jo@example.com>", ("Jo Smith", "jo@example.com")),
+        ('"Smith, Jo" <jo@example.com>', ("Smith, Jo", "jo@example.com")),
+        ("jo@example.com", ("jo@example.com", "jo@example.com")),
+        ("<jo@example.com>", ("jo@example.com", "jo@example.com")),
+    ],
+)
+def test_parse_sender(sender, expected):
+    assert app.parse_sender(sender) == expected
+
+
+@pytest.mark.parametrize("sender", [None, "", "Jo Smith"])
+def test_parse_sender_without_an_address_raises(sender):
+    with pytest.raises(ValueError):
+        app.parse_sender(sender)
+
+
+def test_messages_that_cannot_be_parsed_are_left_out(monkeypatch):
+    message = {"Sender": "jo@example.com", "Subject": "Hello", "Body": "How do I reset my password?"}
+    messages = [
+        {**message, "Id": "m0"},
+        {**message, "Id": "m1", "Sender": None},
+        {**message, "Id": "m2", "Sender": "Jo <jo@example.com>"},
+    ]
+    monkeypatch.setattr(FakeGmailAPI, "messages", messages)
+    monkeypatch.setattr(app, "GmailAPI", FakeGmailAPI)
+
+    parsed, _ = app.get_email_messages(max_results=3)
+
+    assert [message_id for message_id, *_ in parsed] == ["m0", "m2"]
+    assert parsed[1][1] == ("Jo", "jo@example.com")
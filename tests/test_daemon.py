@@ -0,0 +1,92 @@
+import threading
+
+import pytest
+
+pytest.importorskip("langgraph")
+
+import daemon
+from daemon import Daemon
+
+
+class FakeGmail:
+    """Stand-in for GmailAPI listing scripted message ids and recording the saved history ids"""
+
+    lock = threading.Lock()
+
+    def __init__(self, listings):
+        self.listings = list(listings)
+        self.saved = []
+
+    def list_messages(self, max_results=3, incremental=False):
+        listing = self.listings.pop(0) if len(self.listings) > 1 else self.listings[0]
+        if isinstance(listing, Exception):
+            raise listing
+        return listing
+
+    def save_history(self, history_id):
+        self.saved.append(history_id)
+
+
+@pytest.fixture
+def service(monkeypatch):
+    """Runs a daemon without the HTTP endpoint whose replies fail for the ids in its failing set"""
+    service = Daemon(workers=2, poll_interval=0.01)
+    service.failing = set()
+    service.replies = []
+
+    def reply(message_id):
+        service.replies.append(message_id)
+        if message_id in service.failing:
+            raise RuntimeError("LLM unavailable")
+        return True
+
+    monkeypatch.setattr(service, "reply", reply)
+    monkeypatch.setattr(service, "warm_up", lambda: None)
+    yield service
+    service.stop()
+
+
+def test_history_advances_only_once_the_listed_messages_are_drafted(service, monkeypatch):
+    gmail = FakeGmail([(["m0", "m1"], "101")])
+    monkeypatch.setattr(daemon, "GmailAPI", gmail)
+    service.failing.add("m1")
+    service.start(poll=False, port=0)
+
+    service.sync()
+    assert gmail.saved == []
+    assert "m1" not in service.seen
+
+    service.failing.clear()
+    service.sync()
+    assert gmail.saved == ["101"]
+    # the drafted message is skipped when listed again
+    assert sorted(service.replies) == ["m0", "m1", "m1"]
+
+
+def test_failed_message_can_be_pushed_again(service):
+    service.failing.add("m0")
+    service.start(poll=False, port=0)
+
+    assert service.enqueue("m0")
+    service.queue.join()
+    service.failing.clear()
+    assert service.enqueue("m0")
+    service.queue.join()
+
+    assert service.replies == ["m0", "m0"]
+    assert service.status()["processed"] == 1
+
+
+def test_poller_survives_errors(service, monkeypatch):
+    gmail = FakeGmail([ConnectionError("network down"), (["m0"], "101")])
+    monkeypatch.setattr(daemon, "GmailAPI", gmail)
+    monkeypatch.setattr(daemon.settings, "MAX_POLL_BACKOFF", 2)
+    service.start(poll=True, port=0)
+
+    for _ in range(500):
+        if gmail.saved:
+            break
+        service.poll_now.wait(0.01)
+
+    assert gmail.saved[0] == "101"
+    assert service.replies[0] == "m0"
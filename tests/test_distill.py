@@ -0,0 +1,117 @@
+from services.distill import cap_length, distill_question, strip_history
+
+
+def test_greeting_and_thanks_before_the_question_are_kept():
+    body = "Hi team,\n\nThanks!\n\nHow do I report a phishing email?\n\nBest,\nJo"
+    question = distill_question(body)
+    assert "How do I report a phishing email?" in question
+    assert "Jo" not in question.split("\n")
+
+
+def test_sign_off_and_signature_are_stripped():
+    body = (
+        "Hello,\n\nMy laptop shows a ransomware note. What should I do?\n\n"
+        "Kind regards,\nJo Smith\nIT Department\n+1 555 0100"
+    )
+    assert distill_question(body) == "Hello,\nMy laptop shows a ransomware note. What should I do?"
+
+
+def test_footer_is_stripped():
+    body = (
+        "Is my account affected by the breach?\n\n"
+        "CONFIDENTIALITY NOTICE: This email and any attachments are confidential."
+    )
+    assert distill_question(body) == "Is my account affected by the breach?"
+
+
+def test_message_starting_like_a_footer_is_kept():
+    body = (
+        "Hi,\n\nI got a weird text today.\n"
+        "This message is asking for my bank PIN, is it phishing?\n\nThanks,\nJo"
+    )
+    assert distill_question(body) == (
+        "Hi,\nI got a weird text today. This message is asking for my bank PIN, is it phishing?"
+    )
+
+
+def test_question_after_a_disclaimer_is_kept():
+    body = (
+        "Hello,\n\nWe run a few Java services.\n"
+        "Disclaimer: I am not an engineer. Which versions of log4j are affected?"
+    )
+    assert distill_question(body).endswith("Which versions of log4j are affected?")
+
+
+def test_question_after_a_signature_delimiter_is_kept():
+    body = "Quick one:\n--\nhow do I enable MFA?"
+    assert distill_question(body) == "Quick one: -- how do I enable MFA?"
+
+
+def test_signature_delimiter_ends_the_question():
+    body = "How do I enable MFA?\n\n-- \nJo Smith\nIT Department"
+    assert distill_question(body) == "How do I enable MFA?"
+
+
+def test_quoted_reply_is_dropped():
+    lines = [
+        "Does that also apply to my phone?",
+        "",
+        "On Mon, Jan 1, 2024 at 10:00 AM Support <support@example.com>",
+        "wrote:",
+        "> Please reset your password.",
+    ]
+    assert strip_history(lines) == ["Does that also apply to my phone?", ""]
+
+
+def test_quoted_lines_are_dropped():
+    lines = ["> earlier message", "My question is below.", "> more quoting", "How do I enable 2FA?"]
+    assert strip_history(lines) == ["My question is below.", "How do I enable 2FA?"]
+
+
+def test_outlook_header_block_is_dropped():
+    lines = [
+        "Can you check this link?",
+        "",
+        "From: Jo Smith <jo@example.com>",
+        "Sent: Monday, January 1, 2024 10:00 AM",
+        "To: Support <support@example.com>",
+        "Subject: Suspicious link",
+        "Earlier message",
+    ]
+    assert strip_history(lines) == ["Can you check this link?", ""]
+
+
+def test_from_line_without_header_block_is_kept():
+    lines = ["From: the look of it, this is phishing.", "Should I delete it?"]
+    assert strip_history(lines) == lines
+
+
+def test_distill_question_drops_forwarded_message():
+    body = (
+        "Is this email legitimate?\n\n"
+        "---------- Forwarded message ---------\n"
+        "From: Bank <bank@example.com>\n"
+        "Please confirm your password."
+    )
+    assert distill_question(body) == "Is this email legitimate?"
+
+
+def test_cap_length_keeps_short_text():
+    assert cap_length("How do I report phishing?", 100) == "How do I report phishing?"
+
+
+def test_cap_length_keeps_questions_with_their_context():
+    text = (
+        "I work in accounting. Yesterday I got an odd invoice. It had a macro attachment. "
+        "Should I open it? Our office is in Berlin."
+    )
+    assert cap_length(text, 80) == "It had a macro attachment. Should I open it?"
+
+
+def test_cap_length_cuts_at_a_sentence_boundary():
+    text = "First sentence here. Second sentence here. Third sentence here."
+    assert cap_length(text, 50) == "First sentence here. Second sentence here."
+
+
+def test_distill_question_falls_back_to_the_body():
+    assert distill_question("> only quoted text") == "> only quoted text"
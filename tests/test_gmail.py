@@ -0,0 +1,98 @@
+import json
+
+import pytest
+
+pytest.importorskip("googleapiclient")
+
+import httplib2
+
+from config import settings
+from services import gmail
+from services.gmail import GmailAPI
+
+
+@pytest.fixture
+def api(fake_gmail, monkeypatch, tmp_path):
+    """Points GmailAPI at the fake Gmail service, storing the history id under tmp_path"""
+    monkeypatch.setattr(settings, "GMAIL_DISCOVERY_URL", fake_gmail.discovery_url)
+    monkeypatch.setattr(gmail, "HISTORY_FILE", str(tmp_path / "history.json"))
+    monkeypatch.setattr(GmailAPI, "creds", None)
+    monkeypatch.setattr(GmailAPI, "service", GmailAPI.build_service(http=httplib2.Http()))
+    return GmailAPI
+
+
+def requests_to(fake_gmail, resource):
+    return [query for _, path, query in fake_gmail.requests if path.endswith(f"/me/{resource}")]
+
+
+def test_messages_are_fetched_in_batches(api, fake_gmail, monkeypatch):
+    monkeypatch.setattr(settings, "GMAIL_BATCH_SIZE", 2)
+    for i in range(5):
+        fake_gmail.add_message(f"m{i}", subject=f"Subject {i}", body=f"Question {i}?")
+
+    messages, history_id = api.get_messages(max_results=5)
+
+    assert [m["Id"] for m in messages] == ["m4", "m3", "m2", "m1", "m0"]
+    assert messages[0]["Subject"] == "Subject 4"
+    assert messages[0]["Body"] == "Question 4?"
+    assert fake_gmail.batches == [2, 2, 1]
+    assert history_id == str(fake_gmail.history_id)
+
+
+def test_messages_that_fail_to_fetch_are_skipped(api, fake_gmail):
+    fake_gmail.add_message("m0")
+
+    messages = api.get_messages_by_id(["m0", "missing"])
+
+    assert [m["Id"] for m in messages] == ["m0"]
+
+
+def test_incremental_listing_pages_through_the_history(api, fake_gmail):
+    fake_gmail.add_message("old")
+    gmail.save_history_id(str(fake_gmail.history_id))
+    for i in range(5):
+        fake_gmail.add_message(f"new{i}")
+
+    message_ids, history_id = api.list_messages(max_results=1, incremental=True)
+
+    assert message_ids == [f"new{i}" for i in range(5)]
+    assert history_id == str(fake_gmail.history_id)
+    assert len(requests_to(fake_gmail, "history")) == 3
+    assert requests_to(fake_gmail, "messages") == []
+
+
+def test_expired_history_id_falls_back_to_a_full_sync(api, fake_gmail):
+    gmail.save_history_id("50")
+    fake_gmail.oldest_history_id = 100
+    for i in range(3):
+        fake_gmail.add_message(f"m{i}")
+
+    message_ids, history_id = api.list_messages(max_results=2, incremental=True)
+
+    assert message_ids == ["m2", "m1"]
+    assert history_id == str(fake_gmail.history_id)
+    assert requests_to(fake_gmail, "messages")[0]["maxResults"] == "2"
+
+
+def test_history_id_is_only_stored_when_saved(api, fake_gmail, tmp_path):
+    fake_gmail.add_message("m0")
+
+    _, history_id = api.list_messages(max_results=1)
+    assert not (tmp_path / "history.json").exists()
+
+    api.save_history(history_id)
+    assert json.loads((tmp_path / "history.json").read_text()) == {"historyId": history_id}
+
+
+def test_drafted_ids_are_kept_until_the_history_advances(api, fake_gmail):
+    fake_gmail.add_message("m0")
+    _, history_id = api.list_messages(max_results=1)
+    api.save_history(history_id)
+
+    api.save_drafted(["m1"])
+    api.save_drafted(["m2"])
+    assert api.drafted_ids() == {"m1", "m2"}
+    assert gmail.load_history_id() == history_id
+
+    api.save_history(str(int(history_id) + 1))
+    assert api.drafted_ids() == set()
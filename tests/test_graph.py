@@ -0,0 +1,155 @@
+import asyncio
+from collections import OrderedDict
+
+import pytest
+
+pytest.importorskip("langgraph")
+
+from config import settings
+from benchmarks.fakes import FakeChatModel, FakeEncoder, FakeSearchTool, LatencyModel, Script
+
+TICKET = "0001"
+
+
+@pytest.fixture
+def fakes(monkeypatch, tmp_path):
+    """
+    Replaces the LLM clients, web search tool and token encoder with the benchmark's fakes, keeping the
+    LLM cache under tmp_path and starting with no cached searches. Returns a function setting the
+    scenario the fake LLM answers in, which returns the fake search tool.
+    """
+    import llm.client
+    import llm.context
+    import llm.tools
+    from llm.cache import llm_cache
+    from llm.tools import search_cache
+
+    monkeypatch.setattr(llm_cache, "path", str(tmp_path / "llm.sqlite"))
+    monkeypatch.setattr(llm_cache, "_conn", None)
+    monkeypatch.setattr(search_cache, "entries", OrderedDict())
+    encoder = FakeEncoder()
+    monkeypatch.setattr(llm.context, "get_encoder", lambda: encoder)
+    search = FakeSearchTool()
+    monkeypatch.setattr(llm.tools, "get_web_search_tool", lambda: search)
+
+    def use_scenario(scenario):
+        script = Script({TICKET: scenario})
+        for json_mode in (False, True):
+            model = FakeChatModel(
+                script=script, latency=LatencyModel(), format="json" if json_mode else None
+            )
+            monkeypatch.setitem(llm.client._clients, json_mode, model)
+        return search
+
+    return use_scenario
+
+
+def run(question):
+    from llm.langgraph import workflow, initial_state
+
+    state = None
+    for state in workflow.compile().stream(initial_state(question), stream_mode="values"):
+        pass
+    return state
+
+
+def arun(question):
+    from llm.async_langgraph import async_workflow
+    from llm.langgraph import initial_state
+
+    async def stream():
+        state = None
+        async for state in async_workflow.compile().astream(
+            initial_state(question), stream_mode="values"
+        ):
+            pass
+        return state
+
+    return asyncio.run(stream())
+
+
+@pytest.mark.parametrize("run", [run, arun], ids=["sync", "async"])
+def test_question_routed_to_web_search_is_answered(fakes, monkeypatch, run):
+    monkeypatch.setattr(settings, "FAST_ROUTER", False)
+    search = fakes("websearch")
+
+    state = run(f"About ticket #{TICKET}: is there a patch for the new VPN exploit?")
+
+    assert state["datasource"] == "web_search"
+    assert state["web_searches"] == 1
+    assert search.calls == 1
+    assert len(state["documents"]) == 1
+    assert f"ticket #{TICKET}" in state["generation"]
+    assert state["generation_grade"] == "useful"
+
+
+@pytest.fixture
+def vectorstore(monkeypatch, tmp_path):
+    """Routes questions against a numpy store of the benchmark's hashed embeddings under tmp_path"""
+    import llm.router
+    from benchmarks.fakes import HashEmbeddings
+    from database.numpy_store import NumpyVectorStore
+
+    store = NumpyVectorStore(str(tmp_path / "numpy"), HashEmbeddings())
+    store.add_texts(
+        [
+            "Phishing: report suspicious emails and never enter credentials from a link.",
+            "Ransomware: isolate infected machines, keep offline backups and do not pay.",
+        ],
+        metadatas=[{"source": "phishing.md"}, {"source": "ransomware.md"}],
+        ids=["phishing", "ransomware"],
+    )
+    monkeypatch.setattr(llm.router, "get_vectorstore", lambda: store)
+    monkeypatch.setattr(settings, "FAST_ROUTER", True)
+    monkeypatch.setattr(settings, "HYBRID_RETRIEVAL", False)
+    return store
+
+
+@pytest.mark.parametrize("run", [run, arun], ids=["sync", "async"])
+def test_fast_router_routes_close_questions_to_the_vectorstore(fakes, vectorstore, run):
+    fakes("vectorstore")
+    question = (
+        f"Ticket #{TICKET} phishing: report suspicious emails and never enter credentials from a link?"
+    )
+    [(_, score)] = vectorstore._similarity_search_with_relevance_scores(question, k=1)
+    assert score >= settings.ROUTER_VECTORSTORE_THRESHOLD
+
+    state = run(question)
+
+    assert state["datasource"] == "vectorstore"
+    assert state["route_path"] == "embedding"
+    assert state["web_searches"] == 0
+    assert state["generation_grade"] == "useful"
+
+
+@pytest.mark.parametrize("run", [run, arun], ids=["sync", "async"])
+def test_fast_router_routes_negative_scores_to_web_search(fakes, vectorstore, run):
+    # the LLM would route to the vectorstore, so web search can only be chosen by the fast router
+    search = fakes("vectorstore")
+    question = f"About ticket #{TICKET}: who won the football world cup in 2022?"
+    scores = [s for _, s in vectorstore._similarity_search_with_relevance_scores(question, k=2)]
+    assert max(scores) < 0
+
+    state = run(question)
+
+    assert state["datasource"] == "web_search"
+    assert state["route_path"] == "embedding"
+    assert search.calls == 1
+    assert state["generation_grade"] == "useful"
+
+
+def test_fan_out_leaves_every_sub_question_room_to_retry(monkeypatch):
+    from llm.langgraph import fan_out, min_sub_question_llm_calls
+
+    monkeypatch.setattr(settings, "MAX_LLM_CALLS", 20)
+    monkeypatch.setattr(settings, "RETRIEVER_K", 4)
+    monkeypatch.setattr(settings, "GRADE_DOCUMENTS_IN_ONE_CALL", False)
+    state = {"question": "", "llm_calls": 1, "deadline": 0}
+
+    [whole] = fan_out({**state, "questions": ["a"]})
+    assert whole.arg["max_llm_calls"] == 19
+
+    sends = fan_out({**state, "questions": ["a", "b", "c"]})
+    # routing, 4 document grades and two graded generations
+    assert min_sub_question_llm_calls() == 11
+    assert [send.arg["max_llm_calls"] for send in sends] == [11, 11, 11]
@@ -0,0 +1,9 @@
+import pytest
+
+pytest.importorskip("langgraph")
+
+from benchmarks.import_time import BUDGET, check_import_time
+
+
+def test_app_imports_within_budget_without_heavy_modules():
+    assert check_import_time(BUDGET) == []
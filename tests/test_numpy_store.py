@@ -0,0 +1,43 @@
+import json
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from benchmarks.fakes import HashEmbeddings
+from database.numpy_store import NumpyVectorStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return NumpyVectorStore(str(tmp_path), HashEmbeddings())
+
+
+def test_save_writes_a_new_matrix_version_named_by_the_sidecar(store, tmp_path):
+    store.add_texts(["phishing", "ransomware"], ids=["a", "b"])
+    first = json.loads((tmp_path / "index.json").read_text())["matrix"]
+    store.add_texts(["malware"], ids=["c"])
+    second = json.loads((tmp_path / "index.json").read_text())["matrix"]
+
+    assert first != second
+    assert sorted(p.name for p in tmp_path.glob("vectors*.npy")) == [second]
+    assert NumpyVectorStore(str(tmp_path), HashEmbeddings()).get()["ids"] == ["a", "b", "c"]
+
+
+def test_other_instances_pick_up_new_versions(store, tmp_path):
+    reader = NumpyVectorStore(str(tmp_path), HashEmbeddings())
+    store.add_texts(["phishing"], ids=["a"])
+    assert reader.similarity_search("phishing", k=1)[0].id == "a"
+
+    store.delete(["a"])
+    assert reader.similarity_search("phishing", k=1) == []
+
+
+def test_matrix_without_a_row_per_id_is_rejected(store, tmp_path):
+    store.add_texts(["phishing", "ransomware"], ids=["a", "b"])
+    sidecar = json.loads((tmp_path / "index.json").read_text())
+    np.save(tmp_path / sidecar["matrix"], np.zeros((1, 384), np.float16))
+    (tmp_path / "index.json").write_text(json.dumps(sidecar))
+
+    with pytest.raises(ValueError, match="1 rows"):
+        NumpyVectorStore(str(tmp_path), HashEmbeddings())
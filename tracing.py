@@ -0,0 +1,295 @@
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+logger = logging.getLogger(__name__)
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class Trace:
+    """Timings and counts recorded while answering one question"""
+
+    def __init__(self, **fields):
+        self.run_id = uuid.uuid4().hex
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.fields = fields
+        self.nodes = []
+        self.llm_calls = []
+        self.retrievals = []
+        self.tools = []
+        self.spans = []
+        self.outcome = None
+        self.duration = None
+        self._lock = threading.Lock()
+        self.callbacks = TraceCallbackHandler(self)
+
+    def add(self, kind, entry):
+        """Records an entry of the given kind, e.g. a node or an LLM call"""
+        with self._lock:
+            getattr(self, kind).append(entry)
+
+    def config(self):
+        """Returns the runnable config that reports a graph run's callbacks to this trace"""
+        return {"callbacks": [self.callbacks]}
+
+    def record_state(self, state):
+        """Records the retry counts and grade in a graph's final state"""
+        state = state or {}
+        self.fields.update(
+            generations=state.get("generations"),
+            web_searches=state.get("web_searches"),
+            llm_calls=state.get("llm_calls"),
+            datasource=state.get("datasource"),
+            route_path=state.get("route_path"),
+        )
+        self.outcome = state.get("generation_grade") or "failed"
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "run_id": self.run_id,
+                "started": self.started,
+                "duration": self.duration,
+                "outcome": self.outcome,
+                **self.fields,
+                "path": [node["node"] for node in self.nodes],
+                "nodes": list(self.nodes),
+                "llm": list(self.llm_calls),
+                "retrievals": list(self.retrievals),
+                "tools": list(self.tools),
+                "spans": list(self.spans),
+            }
+
+
+class TraceCallbackHandler(BaseCallbackHandler):
+    """Records the LangGraph nodes, LLM calls, retrievals and tool calls of a graph run in a trace"""
+
+    run_inline = True
+
+    def __init__(self, trace):
+        self.trace = trace
+        self.starts = {}
+
+    def started(self, run_id, **entry):
+        self.starts[run_id] = (time.perf_counter(), entry)
+
+    def ended(self, run_id, kind, **fields):
+        if (started := self.starts.pop(run_id, None)) is None:
+            return
+        start, entry = started
+        self.trace.add(kind, {**entry, "duration": time.perf_counter() - start, **fields})
+
+    def on_chain_start(self, serialized, inputs, *, run_id, metadata=None, **kwargs):
+        node = (metadata or {}).get("langgraph_node")
+        name = kwargs.get("name") or (serialized or {}).get("name")
+        # nested runnables inherit the node's metadata, only the node's own run is recorded
+        if node is not None and name == node:
+            self.started(run_id, node=node)
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self.ended(run_id, "nodes")
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self.ended(run_id, "nodes", error=type(error).__name__)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs):
+        self.on_llm_start(serialized, [], run_id=run_id, metadata=metadata, **kwargs)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, metadata=None, **kwargs):
+        params = kwargs.get("invocation_params") or {}
+        self.started(
+            run_id,
+            node=(metadata or {}).get("langgraph_node"),
+            model=params.get("model"),
+        )
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        prompt_tokens = completion_tokens = None
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                info = generation.generation_info or {}
+                if usage:
+                    prompt_tokens = usage.get("input_tokens")
+                    completion_tokens = usage.get("output_tokens")
+                else:
+                    prompt_tokens = info.get("prompt_eval_count", prompt_tokens)
+                    completion_tokens = info.get("eval_count", completion_tokens)
+        self.ended(
+            run_id, "llm_calls", prompt_tokens=prompt_tokens, completion_tokens=completion_tokens
+        )
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self.ended(run_id, "llm_calls", error=type(error).__name__)
+
+    def on_retriever_start(self, serialized, query, *, run_id, metadata=None, **kwargs):
+        self.started(run_id, node=(metadata or {}).get("langgraph_node"))
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs):
+        self.ended(run_id, "retrievals", documents=len(documents))
+
+    def on_retriever_error(self, error, *, run_id, **kwargs):
+        self.ended(run_id, "retrievals", error=type(error).__name__)
+
+    def on_tool_start(self, serialized, input_str, *, run_id, metadata=None, **kwargs):
+        self.started(
+            run_id,
+            node=(metadata or {}).get("langgraph_node"),
+            tool=kwargs.get("name") or (serialized or {}).get("name"),
+        )
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        self.ended(run_id, "tools")
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self.ended(run_id, "tools", error=type(error).__name__)
+
+
+@contextmanager
+def span(name, **fields):
+    """Times the enclosed block in the trace of the question being answered, if there is one"""
+    if (trace := current_trace.get()) is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add("spans", {"name": name, "duration": time.perf_counter() - start, **fields})
+
+
+class Metrics:
+    """Counters and summaries aggregated over traces, rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self.values = defaultdict(float)
+        self.types = {}
+        self.gauges = []
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, kind="counter", **labels):
+        with self._lock:
+            self.types[name] = kind
+            self.values[name, tuple(sorted(labels.items()))] += value
+
+    def add_gauges(self, collect):
+        """Adds a function returning gauge values by metric name, which is called on every render"""
+        self.gauges.append(collect)
+
+    def observe(self, name, value, **labels):
+        """Adds an observation to a summary, which is exported as its sum and count"""
+        self.inc(f"{name}_sum", value, kind="summary", **labels)
+        self.inc(f"{name}_count", 1, kind="summary", **labels)
+
+    def add_trace(self, trace):
+        """Aggregates a finished trace"""
+        self.inc("ragmail_runs_total", outcome=trace.outcome)
+        self.observe("ragmail_run_seconds", trace.duration)
+        for node in trace.nodes:
+            self.observe("ragmail_node_seconds", node["duration"], node=node["node"])
+        for call in trace.llm_calls:
+            self.observe("ragmail_llm_seconds", call["duration"], node=call["node"])
+            self.inc("ragmail_llm_prompt_tokens_total", call.get("prompt_tokens") or 0)
+            self.inc("ragmail_llm_completion_tokens_total", call.get("completion_tokens") or 0)
+        for retrieval in trace.retrievals:
+            self.observe("ragmail_retrieval_seconds", retrieval["duration"])
+        for tool in trace.tools:
+            self.observe("ragmail_tool_seconds", tool["duration"], tool=tool["tool"])
+        for entry in trace.spans:
+            self.observe("ragmail_span_seconds", entry["duration"], span=entry["name"])
+        self.inc("ragmail_generations_total", trace.fields.get("generations") or 0)
+        self.inc("ragmail_web_searches_total", trace.fields.get("web_searches") or 0)
+
+    def render(self):
+        lines = []
+        typed = set()
+        with self._lock:
+            for (name, labels), value in sorted(self.values.items()):
+                family = name.removesuffix("_sum").removesuffix("_count")
+                family = family if self.types[name] == "summary" else name
+                if family not in typed:
+                    typed.add(family)
+                    lines.append(f"# TYPE {family} {self.types[name]}")
+                label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+                lines.append(f"{name}{{{label_text}}} {value}" if labels else f"{name} {value}")
+        for collect in self.gauges:
+            for name, value in collect().items():
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class Tracer:
+    """
+    Traces each question answered, writing one JSON line per run to path and aggregating the runs into
+    metrics that can be served to Prometheus
+    """
+
+    def __init__(self, path, enabled=True):
+        self.path = path
+        self.enabled = enabled
+        self.metrics = Metrics()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def run(self, **fields):
+        """Traces the enclosed block as one run, yielding the run's trace"""
+        trace = Trace(**fields)
+        token = current_trace.set(trace)
+        try:
+            yield trace
+        except Exception as e:
+            trace.outcome = f"error: {type(e).__name__}"
+            raise
+        finally:
+            current_trace.reset(token)
+            trace.duration = time.perf_counter() - trace.start
+            if self.enabled:
+                self.finish(trace)
+
+    def finish(self, trace):
+        """Writes a finished trace and adds it to the metrics"""
+        self.metrics.add_trace(trace)
+        try:
+            with self._lock:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(trace.to_dict(), default=str) + "\n")
+        except OSError as e:
+            logger.error(f"failed to write trace: {e}")
+        logger.debug(f"run {trace.run_id}: {trace.outcome} in {trace.duration:.2f}s")
+
+
+def serve_metrics(tracer, host, port):
+    """Serves the tracer's metrics in the Prometheus text format on http://host:port/metrics"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            payload = tracer.metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"serving metrics on http://{host}:{port}/metrics")
+    return server